@@ -30,7 +30,9 @@ kwargs = dict(
     url="https://github.com/BD2KGenomics/toil-scripts",
     install_requires=[
         'toil-lib==1.2.0a1.dev126',
-        'pyyaml==3.11'],
+        'boto==2.38.0',
+        'pyyaml==3.11',
+        'numpy==1.11.2'],
     tests_require=[
         'pytest==2.8.3'],
     package_dir={'': 'src'},
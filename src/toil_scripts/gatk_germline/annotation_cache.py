@@ -0,0 +1,338 @@
+#!/usr/bin/env python2.7
+"""
+Persistent cache of Oncotator annotations shared across samples and pipeline runs.
+
+Most variants in a cohort are found in more than one sample, so the annotations Oncotator adds
+to a variant are cached in an SQLite database keyed by the normalized variant (contig, position,
+reference allele, and alternate alleles) and the version of the Oncotator database. Before
+annotation, variants that are already in the cache are removed from the VCF, so Oncotator only
+annotates new variants. The annotated variants are then matched to the input records by their
+normalized variant, so Oncotator may reorder them, and merged with the cached annotations.
+
+An annotation is the list of INFO fields that Oncotator added to the record, so the cached
+annotation can be applied to the same variant in another sample without changing the sample
+specific INFO fields. The ##INFO header lines that Oncotator adds are cached as well.
+
+The cache is a single SQLite file on a local path or a shared filesystem that is mounted on
+every worker. SQLite locking is not reliable on network filesystems, so jobs never open the
+shared file. A snapshot of the cache is written to the FileStore when annotation starts, and
+each job reads its own node-local copy. The new annotations of each sample are written to the
+FileStore, and a single job adds them to a copy of the cache that atomically replaces the
+shared file. If two runs update the cache at the same time, the annotations added by one of them
+are lost and are computed again by a later run.
+"""
+from collections import namedtuple
+import hashlib
+import sqlite3
+
+from toil_scripts.gatk_germline.bundle_cache import url_fingerprint
+
+# Configuration for the annotation cache. Path is the SQLite database file and version identifies
+# the Oncotator database that the annotations were computed with.
+AnnotationCache = namedtuple('AnnotationCache', 'path version')
+
+# Number of records looked up or added to the cache per query
+BATCH_SIZE = 10000
+
+# Alternate alleles that are not normalized
+SYMBOLIC_ALLELES = ('<', '[', ']', '*', '.')
+
+
+def database_version(url, s3_key_path=None):
+    """
+    Returns a version for an Oncotator database from its URL and fingerprint, so annotations from
+    a different or updated database are not reused
+
+    :param str url: URL of the Oncotator database
+    :param str s3_key_path: Path to SSE-C key file
+    :return: Database version
+    :rtype: str
+    """
+    fingerprint = url_fingerprint(url, s3_key_path=s3_key_path) or ''
+    return hashlib.sha256('\n'.join([url, fingerprint])).hexdigest()[:32]
+
+
+def open_annotation_cache(path):
+    """
+    Opens an annotation cache, creating it if it does not exist. The path must be on a node-local
+    filesystem.
+
+    :param str path: Path to the SQLite database file, or ':memory:' for an empty cache
+    :return: Database connection
+    :rtype: sqlite3.Connection
+    """
+    db = sqlite3.connect(path)
+    db.text_factory = str
+    with db:
+        db.execute('CREATE TABLE IF NOT EXISTS annotations (version TEXT, contig TEXT, pos INTEGER, '
+                   'ref TEXT, alt TEXT, info TEXT, PRIMARY KEY (version, contig, pos, ref, alt))')
+        db.execute('CREATE TABLE IF NOT EXISTS headers (version TEXT, line TEXT, PRIMARY KEY (version, line))')
+    return db
+
+
+def record_key(fields):
+    """
+    Returns the normalized variant of a VCF record. Alleles are upper case, and bases that are
+    shared by the end and then the start of every allele are trimmed, leaving at least one base,
+    so the same variant has the same key when it is written with different padding bases.
+
+    :param list[str] fields: Tab separated fields of a VCF record
+    :return: Contig, position, reference allele, and alternate alleles
+    :rtype: tuple(str, int, str, str)
+    """
+    pos, ref, alts = int(fields[1]), fields[3].upper(), fields[4].upper().split(',')
+    if not any(alt.startswith(SYMBOLIC_ALLELES) or alt.endswith(SYMBOLIC_ALLELES) for alt in alts):
+        while len(ref) > 1 and all(len(alt) > 1 and alt[-1] == ref[-1] for alt in alts):
+            ref, alts = ref[:-1], [alt[:-1] for alt in alts]
+        while len(ref) > 1 and all(len(alt) > 1 and alt[0] == ref[0] for alt in alts):
+            ref, alts, pos = ref[1:], [alt[1:] for alt in alts], pos + 1
+    return fields[0], pos, ref, ','.join(alts)
+
+
+def _batches(records):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def lookup(db, table, keys, version=None):
+    """
+    Looks up a batch of variants in a single query by joining them to a table
+
+    :param sqlite3.Connection db: Database with the table
+    :param str table: Table with contig, pos, ref, alt, and info columns, and a version column if
+                      version is given
+    :param list[tuple] keys: Variant keys from record_key
+    :param str version: Oncotator database version, default is None
+    :return: INFO fields for the variants that are in the table, or None for the others
+    :rtype: list[str|None]
+    """
+    db.execute('CREATE TEMP TABLE IF NOT EXISTS batch (i INTEGER PRIMARY KEY, contig TEXT, pos INTEGER, '
+               'ref TEXT, alt TEXT)')
+    db.execute('DELETE FROM temp.batch')
+    db.executemany('INSERT INTO temp.batch VALUES (?, ?, ?, ?, ?)', [(i,) + key for i, key in enumerate(keys)])
+    query = 'SELECT b.i, t.info FROM temp.batch AS b JOIN {} AS t USING (contig, pos, ref, alt)'.format(table)
+    if version is None:
+        rows = db.execute(query)
+    else:
+        rows = db.execute(query + ' WHERE t.version=?', (version,))
+    infos = [None] * len(keys)
+    for i, info in rows:
+        infos[i] = info
+    return infos
+
+
+def find_cached_records(vcf, db, version):
+    """
+    Looks up every record of a VCF file in the annotation cache
+
+    :param file vcf: Open file handle for a VCF file
+    :param sqlite3.Connection db: Annotation cache
+    :param str version: Oncotator database version
+    :return: 1 for each cached record and 0 for each record that is not cached, in file order
+    :rtype: bytearray
+    """
+    cached = bytearray()
+    keys = (record_key(line.split('\t', 5)) for line in vcf if not line.startswith('#'))
+    for batch in _batches(keys):
+        cached.extend(info is not None for info in lookup(db, 'annotations', batch, version))
+    return cached
+
+
+def uncached_records(vcf, cached):
+    """
+    Yields the header and the records that are not in the annotation cache
+
+    :param file vcf: Open file handle for a VCF file
+    :param bytearray cached: Cached records from find_cached_records
+    """
+    i = 0
+    for line in vcf:
+        if line.startswith('#'):
+            yield line
+            continue
+        if not cached[i]:
+            yield line
+        i += 1
+
+
+def added_info(info, annotated_info):
+    """
+    :param str info: INFO field of the input record
+    :param str annotated_info: INFO field of the annotated record
+    :return: INFO fields that were added by annotation
+    :rtype: str
+    """
+    keys = {entry.split('=', 1)[0] for entry in info.split(';')}
+    return ';'.join(entry for entry in annotated_info.split(';')
+                    if entry != '.' and entry.split('=', 1)[0] not in keys)
+
+
+def add_info(info, annotation):
+    """
+    :param str info: INFO field of a record
+    :param str annotation: INFO fields to add
+    :return: INFO field with the annotation
+    :rtype: str
+    """
+    if not annotation:
+        return info
+    if info in ('', '.'):
+        return annotation
+    return info + ';' + annotation
+
+
+def merge_annotations(vcf, annotated, db, version, output, new_annotations, work_path=':memory:'):
+    """
+    Writes the records of a VCF file with their annotations. Records that Oncotator annotated are
+    matched to the input records by their normalized variant, and all other records are annotated
+    from the cache. New annotations and header lines are written to new_annotations, so they can
+    be added to the cache by update_annotation_cache.
+
+    :param file vcf: Open file handle for the input VCF file
+    :param iter annotated: Lines of the Oncotator output for the records that were not cached. The
+                           output of several chunks can be chained, since header lines after the
+                           first record are skipped.
+    :param sqlite3.Connection db: Annotation cache
+    :param str version: Oncotator database version
+    :param file output: Open file handle for the annotated VCF file
+    :param file new_annotations: Open file handle for the new header lines and annotations
+    :param str work_path: Path to a temporary database for the annotated records, default is in memory
+    :return: Number of records annotated from the cache and by Oncotator
+    :rtype: tuple(int, int)
+    """
+    annotated_header = []
+    db.execute('ATTACH DATABASE ? AS work', (work_path,))
+    try:
+        db.execute('CREATE TABLE work.annotated (contig TEXT, pos INTEGER, ref TEXT, alt TEXT, info TEXT, '
+                   'used INTEGER DEFAULT 0, PRIMARY KEY (contig, pos, ref, alt))')
+        records = []
+        for line in annotated:
+            if line.startswith('#'):
+                if not records:
+                    annotated_header.append(line)
+                continue
+            fields = line.rstrip('\n').split('\t')
+            records.append(record_key(fields) + (fields[7],))
+            if len(records) >= BATCH_SIZE:
+                _store_annotated(db, records)
+                records = []
+        _store_annotated(db, records)
+        counts = _merge_records(vcf, annotated_header, db, version, output, new_annotations)
+        unused = db.execute('SELECT contig, pos, ref, alt FROM work.annotated WHERE NOT used LIMIT 1').fetchone()
+        if unused:
+            raise ValueError('Annotated variant {}:{} {}>{} is not in the input VCF'.format(*unused))
+    finally:
+        db.commit()
+        db.execute('DETACH DATABASE work')
+    return counts
+
+
+def _store_annotated(db, records):
+    with db:
+        db.executemany('INSERT OR REPLACE INTO work.annotated (contig, pos, ref, alt, info) VALUES (?, ?, ?, ?, ?)',
+                       records)
+
+
+def _merge_records(vcf, annotated_header, db, version, output, new_annotations):
+    header = []
+    batch = []
+    num_cached = num_annotated = 0
+    for line in vcf:
+        if line.startswith('#'):
+            header.append(line)
+            continue
+        if header:
+            _write_header(header, annotated_header, db, version, output, new_annotations)
+            header = []
+        batch.append(line)
+        if len(batch) >= BATCH_SIZE:
+            num_annotated += _merge_batch(batch, db, version, output, new_annotations)
+            num_cached += len(batch)
+            batch = []
+    if header:
+        _write_header(header, annotated_header, db, version, output, new_annotations)
+    num_annotated += _merge_batch(batch, db, version, output, new_annotations)
+    num_cached += len(batch)
+    return num_cached - num_annotated, num_annotated
+
+
+def _merge_batch(batch, db, version, output, new_annotations):
+    """
+    Annotates a batch of records with two queries, one for the annotated records and one for the
+    cache, and returns the number of records that Oncotator annotated
+    """
+    keys = [record_key(line.split('\t', 5)) for line in batch]
+    annotated_infos = lookup(db, 'work.annotated', keys)
+    cached_annotations = lookup(db, 'annotations', keys, version)
+    used = []
+    for line, key, annotated_info, annotation in zip(batch, keys, annotated_infos, cached_annotations):
+        fields = line.rstrip('\n').split('\t')
+        if annotated_info is not None:
+            annotation = added_info(fields[7], annotated_info)
+            new_annotations.write('\t'.join(map(str, key)) + '\t' + annotation + '\n')
+            used.append(key)
+        elif annotation is None:
+            raise ValueError('Variant {}:{} {}>{} was not annotated'.format(*key))
+        fields[7] = add_info(fields[7], annotation)
+        output.write('\t'.join(fields) + '\n')
+    db.executemany('UPDATE work.annotated SET used=1 WHERE contig=? AND pos=? AND ref=? AND alt=?', used)
+    return len(used)
+
+
+def _write_header(header, annotated_header, db, version, output, new_annotations):
+    """
+    Writes the input header with the header lines added by Oncotator, which are cached so they
+    can be added when every record is annotated from the cache
+    """
+    known = set(header)
+    new_lines = []
+    for line in annotated_header:
+        if line.startswith('##') and line not in known:
+            new_lines.append(line)
+            known.add(line)
+    new_annotations.writelines(new_lines)
+    if not annotated_header:
+        new_lines = [line for line, in db.execute('SELECT line FROM headers WHERE version=? ORDER BY rowid',
+                                                   (version,))
+                     if line not in known]
+    output.writelines(line for line in header if line.startswith('##'))
+    output.writelines(new_lines)
+    output.writelines(line for line in header if not line.startswith('##'))
+
+
+def update_annotation_cache(db, version, new_annotations):
+    """
+    Adds the header lines and annotations from merge_annotations to the annotation cache
+
+    :param sqlite3.Connection db: Annotation cache
+    :param str version: Oncotator database version
+    :param iter new_annotations: Lines of new header lines and annotations from merge_annotations
+    :return: Number of annotations read
+    :rtype: int
+    """
+    num_annotations = 0
+    rows = []
+    for line in new_annotations:
+        if line.startswith('##'):
+            with db:
+                db.execute('INSERT OR IGNORE INTO headers VALUES (?, ?)', (version, line))
+            continue
+        contig, pos, ref, alt, info = line.rstrip('\n').split('\t')
+        rows.append((version, contig, int(pos), ref, alt, info))
+        num_annotations += 1
+        if len(rows) >= BATCH_SIZE:
+            _store_annotations(db, rows)
+            rows = []
+    _store_annotations(db, rows)
+    return num_annotations
+
+
+def _store_annotations(db, annotations):
+    with db:
+        db.executemany('INSERT OR REPLACE INTO annotations VALUES (?, ?, ?, ?, ?, ?)', annotations)
@@ -0,0 +1,263 @@
+#!/usr/bin/env python2.7
+"""
+Persistent, content-addressed cache for reference bundle files shared across pipeline runs.
+
+Reference files are keyed by their URL and a fingerprint of the remote file: the ETag, size,
+and modification time reported by the server, or the size and modification time of a local
+file. If the remote file changes, then its key changes and the file is downloaded again. Each
+cache entry is a directory that holds the file and a JSON manifest with the URL, fingerprint,
+size, and MD5 checksum computed when the file was added. Entries are only added by an atomic
+rename, so partially written files are never visible to other runs. The MD5 checksum of a cached
+file is verified before it is used, and entries that do not match their manifest are evicted.
+
+The cache directory can be a local path or a shared filesystem that is mounted on every worker.
+"""
+import errno
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import uuid
+from urlparse import urlparse
+
+from toil_lib.urls import download_url
+
+_log = logging.getLogger(__name__)
+
+
+def url_fingerprint(url, s3_key_path=None):
+    """
+    Returns a fingerprint that changes whenever the file at a URL changes.
+
+    :param str url: file://, http(s)://, ftp://, or s3:// URL
+    :param str s3_key_path: Path to SSE-C key file. SSE-C encrypted S3 files are not fingerprinted.
+    :return: Fingerprint string or None if the URL cannot be fingerprinted
+    :rtype: str|None
+    """
+    parsed_url = urlparse(url)
+    if parsed_url.scheme in ('file', ''):
+        try:
+            st = os.stat(parsed_url.path)
+        except OSError:
+            return None
+        return 'size={};mtime={}'.format(st.st_size, int(st.st_mtime))
+
+    if parsed_url.scheme == 's3':
+        # The encryption key for each file is derived from the master key by S3AM
+        if s3_key_path:
+            return None
+        from boto.s3.connection import S3Connection
+        s3 = S3Connection()
+        try:
+            key = s3.get_bucket(parsed_url.netloc, validate=False).get_key(parsed_url.path[1:])
+            if key is None:
+                return None
+            return 'etag={};size={}'.format(key.etag.strip('"'), key.size)
+        except Exception:
+            _log.warning('Unable to fingerprint %s', url, exc_info=True)
+            return None
+        finally:
+            s3.close()
+
+    try:
+        response = subprocess.check_output(['curl', '-fsIL', '--retry', '5', url])
+    except subprocess.CalledProcessError:
+        return None
+    # Only use the headers of the final response if curl followed redirects
+    headers = {}
+    for line in response.splitlines():
+        if line.startswith('HTTP/'):
+            headers = {}
+        elif ':' in line:
+            field, value = line.split(':', 1)
+            headers[field.strip().lower()] = value.strip()
+    fields = [(name, headers[name]) for name in ('etag', 'content-length', 'last-modified') if name in headers]
+    if not any(name in ('etag', 'last-modified') for name, _ in fields):
+        return None
+    return ';'.join('{}={}'.format(name, value) for name, value in fields)
+
+
+def cache_key(url, fingerprint, suffix=''):
+    """
+    :param str url: URL of the source file
+    :param str fingerprint: Fingerprint from url_fingerprint
+    :param str suffix: Suffix for files derived from the source file, such as .fai
+    :return: Cache key
+    :rtype: str
+    """
+    return hashlib.sha256('\n'.join([url, fingerprint, suffix])).hexdigest()
+
+
+def lookup(cache_dir, key):
+    """
+    Returns the path to a cached file if the entry is complete and its size and MD5 checksum
+    match its manifest. An entry that does not match is evicted, so the file is cached again.
+
+    :param str cache_dir: Path to the cache directory
+    :param str key: Cache key
+    :return: Path to the cached file or None
+    :rtype: str|None
+    """
+    entry = os.path.join(cache_dir, key)
+    if not os.path.isdir(entry):
+        return None
+    path = os.path.join(entry, 'data')
+    try:
+        with open(os.path.join(entry, 'manifest.json'), 'r') as f:
+            manifest = json.load(f)
+        if os.path.getsize(path) == manifest['size'] and _md5(path) == manifest['md5']:
+            return path
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+    _log.warning('Evicting bundle cache entry %s, which does not match its manifest', entry)
+    evict(cache_dir, key)
+    return None
+
+
+def evict(cache_dir, key):
+    """
+    Removes an entry from the cache. The entry is renamed before it is removed, so other runs
+    never see a partially removed entry.
+
+    :param str cache_dir: Path to the cache directory
+    :param str key: Cache key
+    """
+    tmp_entry = os.path.join(cache_dir, '.%s.evicted' % uuid.uuid4())
+    try:
+        os.rename(os.path.join(cache_dir, key), tmp_entry)
+    except OSError as e:
+        # Another run evicted the entry first
+        if e.errno != errno.ENOENT:
+            raise
+        return
+    shutil.rmtree(tmp_entry, ignore_errors=True)
+
+
+def _md5(path):
+    """
+    :param str path: Path to a file
+    :return: Hex MD5 checksum of the file
+    :rtype: str
+    """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(16 * 1024 * 1024), ''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def store(cache_dir, key, path, **metadata):
+    """
+    Adds a file to the cache. The file is copied and checksummed in one pass, then the entry is
+    added with an atomic rename.
+
+    :param str cache_dir: Path to the cache directory
+    :param str key: Cache key
+    :param str path: Path to the file
+    :param metadata: Additional fields recorded in the manifest
+    :return: Path to the cached file
+    :rtype: str
+    """
+    tmp_entry = os.path.join(cache_dir, '.%s.tmp' % uuid.uuid4())
+    os.makedirs(tmp_entry)
+    try:
+        md5 = hashlib.md5()
+        with open(path, 'rb') as src, open(os.path.join(tmp_entry, 'data'), 'wb') as dst:
+            for chunk in iter(lambda: src.read(16 * 1024 * 1024), ''):
+                md5.update(chunk)
+                dst.write(chunk)
+        metadata.update({'size': os.path.getsize(path), 'md5': md5.hexdigest()})
+        with open(os.path.join(tmp_entry, 'manifest.json'), 'w') as f:
+            json.dump(metadata, f, indent=2, sort_keys=True)
+        try:
+            os.rename(tmp_entry, os.path.join(cache_dir, key))
+        except OSError as e:
+            # Another run added the same entry first
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+            return lookup(cache_dir, key)
+    finally:
+        if os.path.exists(tmp_entry):
+            shutil.rmtree(tmp_entry)
+    return os.path.join(cache_dir, key, 'data')
+
+
+def _mkdir(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def cached_download_url_job(job, url, cache_dir, name=None, s3_key_path=None):
+    """
+    Downloads a URL into the FileStore, using the bundle cache if the file was downloaded by a
+    previous run. Files that are downloaded are added to the cache.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param str url: URL to download
+    :param str cache_dir: Path to the bundle cache directory
+    :param str name: Name of the downloaded file
+    :param str s3_key_path: Path to SSE-C key file
+    :return: FileStoreID for the downloaded file
+    :rtype: str
+    """
+    _mkdir(cache_dir)
+    fingerprint = url_fingerprint(url, s3_key_path=s3_key_path)
+    key = cache_key(url, fingerprint) if fingerprint else None
+    path = lookup(cache_dir, key) if key else None
+    if path:
+        job.fileStore.logToMaster('Bundle cache hit for {}: imported {} bytes from {}'.format(
+            url, os.path.getsize(path), cache_dir))
+        return job.fileStore.writeGlobalFile(path)
+
+    work_dir = job.fileStore.getLocalTempDir()
+    path = download_url(job=job, url=url, work_dir=work_dir, name=name, s3_key_path=s3_key_path)
+    if key:
+        store(cache_dir, key, path, url=url, fingerprint=fingerprint)
+        job.fileStore.logToMaster('Bundle cache miss for {}: downloaded and cached {} bytes'.format(
+            url, os.path.getsize(path)))
+    else:
+        job.fileStore.logToMaster('Unable to fingerprint {}, so it was not cached'.format(url))
+    return job.fileStore.writeGlobalFile(path)
+
+
+def cached_derived_files_job(job, cache_dir, url, suffixes, source_id, derive_job, *args, **kwargs):
+    """
+    Returns files derived from a cached source file, such as a fasta index. If any derived file
+    is not in the bundle cache, then the files are created by calling derive_job and added to the cache.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param str cache_dir: Path to the bundle cache directory
+    :param str url: URL of the source file
+    :param list[str] suffixes: Suffixes that identify the derived files, such as .fai
+    :param str source_id: FileStoreID of the source file
+    :param function derive_job: Job function that takes the source FileStoreID and returns the
+                                derived FileStoreIDs in suffix order
+    :param args: Additional arguments for derive_job
+    :param kwargs: Additional keyword arguments for derive_job
+    :return: FileStoreIDs for the derived files in suffix order
+    :rtype: tuple[str]
+    """
+    _mkdir(cache_dir)
+    fingerprint = url_fingerprint(url)
+    keys = [cache_key(url, fingerprint, suffix) if fingerprint else None for suffix in suffixes]
+    paths = [lookup(cache_dir, key) if key else None for key in keys]
+    if all(paths):
+        for suffix, path in zip(suffixes, paths):
+            job.fileStore.logToMaster('Bundle cache hit for {}{}: imported {} bytes from {}'.format(
+                url, suffix, os.path.getsize(path), cache_dir))
+        return tuple(job.fileStore.writeGlobalFile(path) for path in paths)
+
+    derived_ids = derive_job(job, source_id, *args, **kwargs)
+    if fingerprint:
+        work_dir = job.fileStore.getLocalTempDir()
+        for suffix, key, derived_id in zip(suffixes, keys, derived_ids):
+            path = job.fileStore.readGlobalFile(derived_id, os.path.join(work_dir, 'derived' + suffix))
+            store(cache_dir, key, path, url=url, fingerprint=fingerprint, suffix=suffix)
+            job.fileStore.logToMaster('Bundle cache miss for {}{}: created and cached {} bytes'.format(
+                url, suffix, os.path.getsize(path)))
+    return tuple(derived_ids)
@@ -0,0 +1,41 @@
+#!/usr/bin/env python2.7
+"""
+Plans the hierarchical CombineGVCFs tree that merges a cohort of GVCFs into a single GVCF.
+
+The first level combines the sample GVCFs in consecutive batches of the initial batch size. Each
+following level combines the GVCFs of the level below in batches of the fan-out, until a single
+GVCF remains. A batch with a single GVCF is passed up to the next level without a CombineGVCFs job.
+"""
+
+
+def batch_gvcfs(gvcfs, batch_size):
+    """
+    Splits GVCFs into consecutive batches, so combined GVCFs keep the order of the samples
+
+    :param list gvcfs: GVCFs in sample order
+    :param int batch_size: Maximum number of GVCFs in a batch
+    :return: Batches of GVCFs
+    :rtype: list[list]
+    """
+    if batch_size < 2:
+        raise ValueError('GVCFs must be combined in batches of at least 2, got %s' % batch_size)
+    return [gvcfs[i:i + batch_size] for i in xrange(0, len(gvcfs), batch_size)]
+
+
+def combine_tree(num_gvcfs, batch_size, fan_out):
+    """
+    Returns the batch sizes of each level of the combine tree
+
+    :param int num_gvcfs: Number of sample GVCFs
+    :param int batch_size: Maximum number of GVCFs combined by each job at the first level
+    :param int fan_out: Maximum number of GVCFs combined by each job above the first level
+    :return: Batch sizes at each level, empty if there is a single GVCF
+    :rtype: list[list[int]]
+    """
+    levels = []
+    while num_gvcfs > 1:
+        batches = [len(batch) for batch in batch_gvcfs(range(num_gvcfs), batch_size)]
+        levels.append(batches)
+        num_gvcfs = len(batches)
+        batch_size = fan_out
+    return levels
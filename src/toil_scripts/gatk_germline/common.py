@@ -1,15 +1,39 @@
 #!/usr/bin/env python2.7
+import base64
+import hashlib
 import os
+from StringIO import StringIO
 from urlparse import urlparse
 
 from bd2k.util.files import mkdir_p
-from toil_lib.files import copy_files
-from toil_lib.urls import s3am_upload
+from toil_lib import require
+
+from toil_scripts.gatk_germline.reference_cache import read_reference_files
+from toil_scripts.gatk_germline.resources import docker_call
+from toil_scripts.gatk_germline.vcf import compress_vcf, COMPRESSION_RATIO, IndexedVcf, IndexedVcfWriter, open_vcf
+
+
+# Scratch disk for jobs that stream a file from the FileStore to the output directory
+OUTPUT_DISK = '64M'
+
+# Size of each streamed block. S3 requires every part of a multipart upload except the last to be
+# at least 5 MB, and allows at most 10000 parts, so parts are 64 MB up to 625 GB.
+COPY_BUFFER_SIZE = 1024 * 1024
+UPLOAD_PART_SIZE = 64 * 1024 * 1024
+
+GATK_TOOL = 'quay.io/ucsc_cgl/gatk:3.5--dba6dae49156168a909c43330350c6161dc7ecc2'
+
+# Compressed VCF files smaller than this are compressed and indexed in Python. The Python BGZF
+# writer compresses about 12 MB/s, so larger VCF files are written uncompressed, then compressed
+# with bgzip and indexed with tabix in the htslib container.
+SMALL_VCF_SIZE = 64 * 1024 * 1024
+HTSLIB_TOOL = 'quay.io/biocontainers/htslib:1.9--ha228f0b_7'
 
 
 def output_file_job(job, filename, file_id, output_dir, s3_key_path=None):
     """
-    Uploads a file from the FileStore to an output directory on the local filesystem or S3.
+    Streams a file from the FileStore to an output directory on the local filesystem or S3
+    without a local copy, so the job needs almost no disk.
 
     :param JobFunctionWrappingJob job: passed automatically by Toil
     :param str filename: basename for file
@@ -19,15 +43,361 @@ def output_file_job(job, filename, file_id, output_dir, s3_key_path=None):
     :return:
     """
     job.fileStore.logToMaster('Writing {} to {}'.format(filename, output_dir))
-    work_dir = job.fileStore.getLocalTempDir()
-    filepath = job.fileStore.readGlobalFile(file_id, os.path.join(work_dir, filename))
-    if urlparse(output_dir).scheme == 's3':
-        s3am_upload(job,
-                    fpath=os.path.join(work_dir, filepath),
-                    s3_dir=output_dir,
-                    s3_key_path=s3_key_path)
-    elif os.path.exists(os.path.join(output_dir, filename)):
+    if file_exists(os.path.join(output_dir, filename)):
         job.fileStore.logToMaster("File already exists: {}".format(filename))
+        return
+    if urlparse(output_dir).scheme == 's3':
+        with job.fileStore.readGlobalFileStream(file_id) as f:
+            size, md5 = upload_stream(f, os.path.join(output_dir, filename), s3_key_path=s3_key_path)
     else:
         mkdir_p(output_dir)
-        copy_files([filepath], output_dir)
+        with job.fileStore.readGlobalFileStream(file_id) as f:
+            size, md5 = copy_stream(f, os.path.join(output_dir, filename))
+    job.fileStore.logToMaster('Wrote {} bytes with MD5 {} to {}'.format(size, md5, os.path.join(output_dir, filename)))
+
+
+def copy_stream(src, path):
+    """
+    Copies a stream to a local file in blocks and computes its MD5 checksum while it is copied.
+    The file is written under a temporary name and renamed once it is complete, so an incomplete
+    file never has the final name.
+
+    :param file src: Readable file handle
+    :param str path: Destination path
+    :return: Size in bytes and MD5 checksum of the file
+    :rtype: tuple(int, str)
+    """
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    md5 = hashlib.md5()
+    size = 0
+    try:
+        with open(tmp_path, 'wb') as f:
+            for block in iter(lambda: src.read(COPY_BUFFER_SIZE), ''):
+                md5.update(block)
+                size += len(block)
+                f.write(block)
+        os.rename(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return size, md5.hexdigest()
+
+
+def file_exists(path):
+    """
+    :param str path: Amazon S3 URL or local path of a file
+    :return: True if the file exists
+    :rtype: bool
+    """
+    parsed_url = urlparse(path)
+    if parsed_url.scheme == 's3':
+        # List the key, because SSE-C encrypted objects cannot be read without their key
+        from boto.s3.connection import S3Connection
+        key_name = parsed_url.path.lstrip('/')
+        s3 = S3Connection()
+        try:
+            return any(key.name == key_name
+                       for key in s3.get_bucket(parsed_url.netloc, validate=False).list(prefix=key_name))
+        finally:
+            s3.close()
+    return os.path.exists(parsed_url.path)
+
+
+def sse_headers(s3_key_path, url):
+    """
+    Returns the SSE-C request headers for an S3 object. The object key is derived from the master
+    key and the S3 URL of the object, the same way as s3am, so outputs can be downloaded with s3am.
+
+    :param str s3_key_path: Path to 32-byte master key for SSE-C encryption
+    :param str url: S3 URL of the object
+    :return: Request headers
+    :rtype: dict
+    """
+    with open(s3_key_path, 'r') as f:
+        master_key = f.read()
+    require(len(master_key) == 32, 'Invalid SSE-C key, must be 32 bytes: {}'.format(s3_key_path))
+    key = hashlib.sha256(master_key + url).digest()
+    return {'x-amz-server-side-encryption-customer-algorithm': 'AES256',
+            'x-amz-server-side-encryption-customer-key': base64.b64encode(key),
+            'x-amz-server-side-encryption-customer-key-MD5': base64.b64encode(hashlib.md5(key).digest())}
+
+
+def upload_stream(src, url, s3_key_path=None):
+    """
+    Uploads a stream to S3 with a multipart upload. Each part is buffered in memory and sent with
+    its MD5 checksum, which S3 verifies. The size of the uploaded object and, for objects that are
+    not encrypted with SSE-C, its multipart ETag are checked after the upload is completed.
+
+    :param file src: Readable file handle
+    :param str url: S3 URL of the object
+    :param str s3_key_path: (OPTIONAL) Path to 32-byte key to be used for SSE-C encryption
+    :return: Size in bytes and MD5 checksum of the uploaded data
+    :rtype: tuple(int, str)
+    """
+    from boto.s3.connection import S3Connection
+    parsed_url = urlparse(url)
+    key_name = parsed_url.path.lstrip('/')
+    headers = sse_headers(s3_key_path, url) if s3_key_path else {}
+    md5 = hashlib.md5()
+    part_digests = []
+    size = 0
+    s3 = S3Connection()
+    try:
+        bucket = s3.get_bucket(parsed_url.netloc, validate=False)
+        upload = bucket.initiate_multipart_upload(key_name, headers=headers)
+        try:
+            while True:
+                part = src.read(UPLOAD_PART_SIZE)
+                # An empty file is uploaded as a single empty part
+                if not part and part_digests:
+                    break
+                md5.update(part)
+                size += len(part)
+                digest = hashlib.md5(part).digest()
+                part_digests.append(digest)
+                upload.upload_part_from_file(StringIO(part), len(part_digests), headers=headers,
+                                             md5=(digest.encode('hex'), base64.b64encode(digest)), size=len(part))
+            upload.complete_upload()
+        except Exception:
+            upload.cancel_upload()
+            raise
+        key = bucket.get_key(key_name, headers=headers)
+    finally:
+        s3.close()
+
+    require(key is not None and key.size == size,
+            'Uploaded {} bytes to {}, but the object has {} bytes'.format(size, url, key.size if key else 0))
+    # The ETag of an object encrypted with SSE-C is not its MD5 checksum
+    etag = '"{}-{}"'.format(hashlib.md5(''.join(part_digests)).hexdigest(), len(part_digests))
+    require(s3_key_path or key.etag == etag, 'ETag of {} is {}, expected {}'.format(url, key.etag, etag))
+    return size, md5.hexdigest()
+
+
+def list_files(directory):
+    """
+    Lists the files in a directory on the local filesystem or S3
+
+    :param str directory: Amazon S3 URL or local path
+    :return: Size of each file in bytes {filename: size}, empty if the directory does not exist
+    :rtype: dict
+    """
+    parsed_url = urlparse(directory)
+    if parsed_url.scheme == 's3':
+        # List the prefix, because SSE-C encrypted objects cannot be read without their key
+        from boto.s3.connection import S3Connection
+        s3 = S3Connection()
+        try:
+            prefix = parsed_url.path.strip('/') + '/'
+            return {key.name[len(prefix):]: key.size
+                    for key in s3.get_bucket(parsed_url.netloc, validate=False).list(prefix=prefix)}
+        finally:
+            s3.close()
+    sizes = {}
+    if os.path.isdir(parsed_url.path):
+        for filename in os.listdir(parsed_url.path):
+            path = os.path.join(parsed_url.path, filename)
+            if os.path.isfile(path):
+                sizes[filename] = os.path.getsize(path)
+    return sizes
+
+
+def output_vcf_job(job, filename, vcf, output_dir, s3_key_path=None):
+    """
+    Uploads a compressed VCF file and its tabix index to an output directory
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param str filename: basename for the VCF file, the index is uploaded as filename + '.tbi'
+    :param IndexedVcf vcf: FileStoreIDs for the compressed VCF file and its index
+    :param str output_dir: Amazon S3 URL or local path
+    :param str s3_key_path: (OPTIONAL) Path to 32-byte key to be used for SSE-C encryption
+    """
+    output_file_job(job, filename, vcf.vcf, output_dir, s3_key_path=s3_key_path)
+    output_file_job(job, filename + '.tbi', vcf.tbi, output_dir, s3_key_path=s3_key_path)
+
+
+def vcf_output_disk(size):
+    """
+    Returns the scratch disk for writing a compressed VCF file with IndexedVcfOutput, which is
+    larger for VCF files that are written uncompressed before they are compressed
+
+    :param int size: Expected size of the compressed VCF file
+    :return: Scratch disk in bytes
+    :rtype: int
+    """
+    return int(size if size < SMALL_VCF_SIZE else (COMPRESSION_RATIO + 1) * size)
+
+
+def bgzip_vcf(job, path):
+    """
+    Compresses a VCF file with bgzip and indexes it with tabix in the htslib container. The
+    uncompressed VCF file is replaced by path + '.gz' and its index path + '.gz.tbi'.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param str path: Path to an uncompressed VCF file
+    """
+    work_dir, name = os.path.split(path)
+    docker_call(job=job, work_dir=work_dir,
+                parameters=['bgzip', '-f', '-@', str(int(job.cores)), os.path.join('/data', name)],
+                tool=HTSLIB_TOOL,
+                inputs=[name],
+                outputs={name + '.gz': None})
+    docker_call(job=job, work_dir=work_dir,
+                parameters=['tabix', '-f', '-p', 'vcf', os.path.join('/data', name + '.gz')],
+                tool=HTSLIB_TOOL,
+                inputs=[name + '.gz'],
+                outputs={name + '.gz.tbi': None})
+
+
+class IndexedVcfOutput(object):
+    """
+    Writes a VCF file that is compressed, indexed, and written to the FileStore when it is closed.
+    VCF files that are expected to be smaller than SMALL_VCF_SIZE are compressed and indexed as they
+    are written. Larger VCF files are written uncompressed and compressed with bgzip_vcf.
+    """
+
+    def __init__(self, job, path, size):
+        """
+        :param JobFunctionWrappingJob job: passed automatically by Toil
+        :param str path: Path to the compressed VCF file, which must end in .gz
+        :param int size: Expected size of the compressed VCF file
+        """
+        require(path.endswith('.gz'), 'Compressed VCF path must end in .gz: {}'.format(path))
+        self.job = job
+        self.path = path
+        self.ids = None
+        if size < SMALL_VCF_SIZE:
+            self._writer = IndexedVcfWriter(path)
+        else:
+            self._writer = open(path[:-3], 'w')
+
+    def write(self, data):
+        self._writer.write(data)
+
+    def writelines(self, lines):
+        self._writer.writelines(lines)
+
+    def close(self):
+        """
+        Compresses and indexes the VCF file if needed and writes it to the FileStore. The
+        FileStoreIDs are stored in the ids attribute.
+        """
+        if self.ids is not None:
+            return
+        self._writer.close()
+        if not isinstance(self._writer, IndexedVcfWriter):
+            bgzip_vcf(self.job, self._writer.name)
+        self.ids = IndexedVcf(self.job.fileStore.writeGlobalFile(self.path),
+                              self.job.fileStore.writeGlobalFile(self.path + '.tbi'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Only compress and upload complete VCF files
+        if exc_type is None:
+            self.close()
+        else:
+            self._writer.close()
+
+
+def write_indexed_vcf(job, path):
+    """
+    Compresses a local VCF file, indexes it, and writes both files to the FileStore. VCF files that
+    compress to less than about SMALL_VCF_SIZE are compressed in Python, and larger files with
+    bgzip_vcf.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param str path: Path to an uncompressed VCF file
+    :return: FileStoreIDs for the compressed VCF file and its index
+    :rtype: IndexedVcf
+    """
+    compressed = path + '.gz'
+    size = os.path.getsize(path)
+    if size < COMPRESSION_RATIO * SMALL_VCF_SIZE:
+        compress_vcf(path, compressed)
+        # Remove the uncompressed VCF file to free disk space
+        os.remove(path)
+    else:
+        bgzip_vcf(job, path)
+    job.fileStore.logToMaster('Compressed {} bytes of VCF records to {} bytes'.format(size,
+                                                                                 os.path.getsize(compressed)))
+    return IndexedVcf(job.fileStore.writeGlobalFile(compressed), job.fileStore.writeGlobalFile(compressed + '.tbi'))
+
+
+def compress_vcf_job(job, vcf_id):
+    """
+    Compresses and indexes an uncompressed VCF file from a tool that does not write compressed VCF files
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param str vcf_id: FileStoreID for an uncompressed VCF file
+    :return: FileStoreIDs for the compressed VCF file and its index
+    :rtype: IndexedVcf
+    """
+    work_dir = job.fileStore.getLocalTempDir()
+    path = job.fileStore.readGlobalFile(vcf_id, os.path.join(work_dir, 'input.vcf'), mutable=True)
+    return write_indexed_vcf(job, path)
+
+
+def decompress_vcf_job(job, vcf):
+    """
+    Decompresses a VCF file for a tool that does not read compressed VCF files. VCF files larger
+    than SMALL_VCF_SIZE are decompressed with bgzip in the htslib container.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param IndexedVcf vcf: FileStoreIDs for the compressed VCF file and its index
+    :return: FileStoreID for the uncompressed VCF file
+    :rtype: str
+    """
+    work_dir = job.fileStore.getLocalTempDir()
+    if vcf.vcf.size >= SMALL_VCF_SIZE:
+        # bgzip replaces the compressed file, so it must be a mutable copy
+        job.fileStore.readGlobalFile(vcf.vcf, os.path.join(work_dir, 'input.vcf.gz'), mutable=True)
+        docker_call(job=job, work_dir=work_dir,
+                    parameters=['bgzip', '-d', '-f', '/data/input.vcf.gz'],
+                    tool=HTSLIB_TOOL,
+                    inputs=['input.vcf.gz'],
+                    outputs={'input.vcf': None})
+        return job.fileStore.writeGlobalFile(os.path.join(work_dir, 'input.vcf'))
+    path = job.fileStore.readGlobalFile(vcf.vcf, os.path.join(work_dir, 'input.vcf.gz'))
+    output = os.path.join(work_dir, 'output.vcf')
+    with open_vcf(path) as f, open(output, 'w') as g:
+        for line in f:
+            g.write(line)
+    return job.fileStore.writeGlobalFile(output)
+
+
+def gatk_call(job, command, ref_fasta, ref_fai, ref_dict, inputs, outputs, resources=None, reference_cache=None):
+    """
+    Runs a GATK tool in its Docker container. The genome reference is localized as genome.fa,
+    genome.fa.fai, and genome.dict through the node-local reference cache, along with any resource
+    files that are the same for every sample. The other input files are copied from the FileStore.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param list[str] command: GATK parameters, with file paths relative to the work directory
+    :param str ref_fasta: FileStoreID for reference genome fasta
+    :param str ref_fai: FileStoreID for reference genome index file
+    :param str ref_dict: FileStoreID for reference genome sequence dictionary file
+    :param dict inputs: Dictionary of input files {filename: FileStoreID}
+    :param list[str] outputs: Filenames of the output files
+    :param dict resources: Dictionary of resource files {filename: FileStoreID}, default is None
+    :param ReferenceCache reference_cache: Node-local reference cache configuration, default is None
+    :return: Path to the work directory that holds the output files
+    :rtype: str
+    """
+    references = {'genome.fa': ref_fasta,
+                  'genome.fa.fai': ref_fai,
+                  'genome.dict': ref_dict}
+    references.update(resources or {})
+    work_dir = job.fileStore.getLocalTempDir()
+    read_reference_files(job, references, work_dir, cache=reference_cache)
+    for name, file_store_id in inputs.iteritems():
+        job.fileStore.readGlobalFile(file_store_id, os.path.join(work_dir, name))
+
+    docker_call(job=job, work_dir=work_dir,
+                env={'JAVA_OPTS': '-Djava.io.tmpdir=/data/ -Xmx{}'.format(job.memory)},
+                parameters=command,
+                tool=GATK_TOOL,
+                inputs=references.keys() + inputs.keys(),
+                outputs={name: None for name in outputs})
+    return work_dir
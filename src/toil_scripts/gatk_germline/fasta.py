@@ -0,0 +1,168 @@
+#!/usr/bin/env python2.7
+"""
+Builds the samtools fasta index (.fai) and Picard sequence dictionary (.dict) of a genome fasta
+file in a single pass.
+
+The fasta index stores the length of each sequence, the offset of its first base, and its line
+length, so every line except the last line of a sequence must have the same length. The sequence
+dictionary stores the length and the MD5 checksum of the upper case bases of each sequence.
+BGZF compressed files are read as a stream and the index stores offsets in the uncompressed file,
+which is how samtools indexes BGZF compressed fasta files. Plain gzip files are rejected, because
+samtools faidx refuses to index them and they cannot be read at random positions.
+"""
+import hashlib
+import re
+import zlib
+
+from toil_scripts.lib.bgzf import GzipReader, read_bgzf_block
+
+# Runs of N bases
+N_RUN = re.compile('[Nn]+')
+
+# SAM header version written by Picard CreateSequenceDictionary 1.x
+DICT_VERSION = '1.4'
+
+
+class FastaIndexEntry(object):
+    """
+    Fasta index fields and MD5 checksum of a sequence
+    """
+
+    def __init__(self, name, offset):
+        self.name = name
+        self.offset = offset
+        self.length = 0
+        self.line_bases = 0
+        self.line_width = 0
+        self.md5 = hashlib.md5()
+        # Set when a line is shorter than the first line, which must be the last line
+        self._last_line = False
+
+    def add_line(self, line):
+        bases = line.rstrip('\r\n')
+        if not bases:
+            # Blank lines are only allowed at the end of the sequence
+            self._last_line = True
+            return
+        if self._last_line:
+            raise ValueError('Different line length in sequence {}'.format(self.name))
+        if not self.line_bases:
+            self.line_bases = len(bases)
+            self.line_width = len(line)
+        elif len(bases) > self.line_bases or len(line) - len(bases) != self.line_width - self.line_bases:
+            raise ValueError('Different line length in sequence {}'.format(self.name))
+        if len(bases) < self.line_bases:
+            self._last_line = True
+        self.length += len(bases)
+        self.md5.update(bases.upper())
+
+    def fai_line(self):
+        return '{}\t{}\t{}\t{}\t{}\n'.format(self.name, self.length, self.offset, self.line_bases, self.line_width)
+
+    def dict_line(self, uri):
+        fields = ['@SQ', 'SN:' + self.name, 'LN:%d' % self.length, 'M5:' + self.md5.hexdigest()]
+        if uri:
+            fields.append('UR:' + uri)
+        return '\t'.join(fields) + '\n'
+
+
+def open_fasta(path):
+    """
+    Opens a fasta file that is either uncompressed or BGZF compressed
+
+    :param str path: Path to fasta file
+    :return: Iterable file object over the lines of the fasta file
+    :rtype: file|GzipReader
+    :raises ValueError: If the fasta file is gzip compressed but not BGZF compressed
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(2)
+        if magic != '\x1f\x8b':
+            return open(path, 'rb')
+        f.seek(0)
+        try:
+            read_bgzf_block(f)
+        except (ValueError, zlib.error):
+            raise ValueError('Fasta file {} is gzip compressed but not BGZF compressed. Recompress it '
+                             'with bgzip or decompress it.'.format(path))
+    return GzipReader(path)
+
+
+def index_fasta(fasta, fai, seq_dict, uri=None):
+    """
+    Writes the fasta index and sequence dictionary of a fasta file
+
+    :param file fasta: Open file handle for an uncompressed fasta file
+    :param file fai: Open file handle for the fasta index
+    :param file seq_dict: Open file handle for the sequence dictionary
+    :param str uri: URI of the fasta file recorded in the sequence dictionary
+    :return: Number of sequences
+    :rtype: int
+    """
+    seq_dict.write('@HD\tVN:{}\tSO:unsorted\n'.format(DICT_VERSION))
+    names = set()
+    entry = None
+    offset = 0
+    for line in fasta:
+        offset += len(line)
+        if line.startswith('>'):
+            if entry:
+                fai.write(entry.fai_line())
+                seq_dict.write(entry.dict_line(uri))
+            fields = line[1:].split()
+            name = fields[0] if fields else ''
+            if name in names:
+                raise ValueError('Duplicate sequence name {}'.format(name))
+            names.add(name)
+            entry = FastaIndexEntry(name, offset)
+        elif entry:
+            entry.add_line(line)
+    if entry:
+        fai.write(entry.fai_line())
+        seq_dict.write(entry.dict_line(uri))
+    return len(names)
+
+
+def find_gaps(fasta, min_length):
+    """
+    Finds the assembly gaps of a genome, which are the runs of N bases. No reads align to a gap,
+    so jobs that are split at a gap never see a read or an active region that spans the split.
+
+    :param file fasta: Iterable over the lines of an uncompressed fasta file
+    :param int min_length: Minimum number of bases in a gap
+    :return: List of (contig, start, end) gaps in 0-based, half-open coordinates
+    :rtype: list[tuple]
+    """
+    gaps = []
+    contig = None
+    position = 0
+    gap_start = None
+    for line in fasta:
+        if line.startswith('>'):
+            if gap_start is not None and position - gap_start >= min_length:
+                gaps.append((contig, gap_start, position))
+            fields = line[1:].split()
+            contig = fields[0] if fields else ''
+            position = 0
+            gap_start = None
+            continue
+        bases = line.rstrip('\r\n')
+        if 'N' in bases or 'n' in bases:
+            for match in N_RUN.finditer(bases):
+                # A run at the start of the line continues a gap from the previous line
+                if gap_start is None or match.start() > 0:
+                    if gap_start is not None and position - gap_start >= min_length:
+                        gaps.append((contig, gap_start, position))
+                    gap_start = position + match.start()
+                if match.end() < len(bases):
+                    if position + match.end() - gap_start >= min_length:
+                        gaps.append((contig, gap_start, position + match.end()))
+                    gap_start = None
+        elif gap_start is not None:
+            if position - gap_start >= min_length:
+                gaps.append((contig, gap_start, position))
+            gap_start = None
+        position += len(bases)
+    if gap_start is not None and position - gap_start >= min_length:
+        gaps.append((contig, gap_start, position))
+    return gaps
@@ -43,35 +43,63 @@ docker          - http://docs.docker.com/engine/installation/
 """
 from __future__ import print_function
 import argparse
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from copy import deepcopy
+from itertools import chain
 import logging
 import os
 import re
+import shutil
+import time
 from urlparse import urlparse
+from uuid import uuid4
 
 from bd2k.util.humanize import human2bytes
 from bd2k.util.processes import which
 from toil.job import Job, PromisedRequirement
 from toil_lib import require
 from toil_lib.files import generate_file
-from toil_lib.programs import docker_call
 from toil_lib.tools.aligners import run_bwakit
-from toil_lib.tools.indexing import run_samtools_faidx
-from toil_lib.tools.preprocessing import run_gatk_preprocessing, \
-    run_picard_create_sequence_dictionary, run_samtools_index, run_samtools_sort
-from toil_lib.tools.variant_annotation import gatk_genotype_gvcfs, run_oncotator
+from toil_lib.tools.preprocessing import run_gatk_preprocessing, run_samtools_index, run_samtools_sort
+from toil_lib.tools.variant_annotation import run_oncotator
 from toil_lib.urls import download_url_job
 import yaml
 
-from toil_scripts.gatk_germline.common import output_file_job
+from toil_scripts.gatk_germline.annotation_cache import AnnotationCache, database_version, find_cached_records, \
+    merge_annotations, open_annotation_cache, uncached_records, update_annotation_cache
+from toil_scripts.gatk_germline.bundle_cache import cached_derived_files_job, cached_download_url_job
+from toil_scripts.gatk_germline.combine import batch_gvcfs, combine_tree
+from toil_scripts.gatk_germline.common import IndexedVcfOutput, OUTPUT_DISK, output_file_job, output_vcf_job, \
+    vcf_output_disk, write_indexed_vcf
+from toil_scripts.gatk_germline.fasta import find_gaps, index_fasta, open_fasta
 from toil_scripts.gatk_germline.germline_config_manifest import generate_config, generate_manifest
+from toil_scripts.gatk_germline.gvcf_store import find_stored_gvcf, gvcf_options, gvcf_store_dir, \
+    import_stored_gvcf_job, sample_fingerprint
 from toil_scripts.gatk_germline.hard_filter import hard_filter_pipeline
+from toil_scripts.gatk_germline.intervals import genome_intervals, interval_size, parse_bed, \
+    parse_sequence_dictionary, partition_intervals, SHARD_GAP_LENGTH, sort_and_merge_intervals, write_bed
+from toil_scripts.gatk_germline.reference_cache import read_reference_files, ReferenceCache
+from toil_scripts.gatk_germline.resources import docker_call, GB, input_size, load_resource_model, profiled_job, \
+    Profiler, ResourceLimits, scaled_requirement, scaled_resources
+from toil_scripts.gatk_germline.resume import find_sample_outputs
+from toil_scripts.gatk_germline.vcf import chunk_vcf, COMPRESSION_RATIO, concatenate_vcfs, count_records, \
+    filter_stats, IndexedVcf, open_vcf, split_vcf
 from toil_scripts.gatk_germline.vqsr import vqsr_pipeline
+from toil_scripts.lib.bam import read_bam_header
 
 
 logging.basicConfig(level=logging.INFO)
 
+# bwakit -s runs samtools sort -m1G with a thread for every core
+BWAKIT_SORT_MEMORY = GB
+
+
+# Genomic shard for HaplotypeCaller
+#   bed: FileStoreID for the BED file of the shard intervals
+#   bases: Number of bases in the shard
+#   intervals: Number of intervals in the shard
+Shard = namedtuple('Shard', 'bed bases intervals')
+
 
 class GermlineSample(namedtuple('GermlineSample', 'uuid url paired_url rg_line')):
     """
@@ -96,6 +124,8 @@ def run_gatk_germline_pipeline(job, samples, config):
         config.preprocess_only      If True, then stops pipeline after preprocessing steps
         config.joint_genotype       If True, then joint genotypes cohort
         config.run_oncotator        If True, then adds Oncotator to pipeline
+        config.resume               If True, then skips complete samples and imports their GVCFs from the
+                                    output directory
         Additional parameters are needed for downstream steps. Refer to pipeline README for more information.
     """
     # Determine the available disk space on a worker node before any jobs have been run.
@@ -103,9 +133,32 @@ def run_gatk_germline_pipeline(job, samples, config):
     st = os.statvfs(work_dir)
     config.available_disk = st.f_bavail * st.f_frsize
 
-    # Check that there is a reasonable number of samples for joint genotyping
+    # Skip samples that were completed by a previous run and reuse the GVCFs of incomplete samples
+    resumed_gvcfs = {}
+    if config.resume:
+        complete = []
+        remaining = []
+        for sample in samples:
+            sample_complete, gvcf = find_sample_outputs(sample.uuid, config)
+            if sample_complete:
+                complete.append(sample.uuid)
+                continue
+            if gvcf:
+                resumed_gvcfs[sample.uuid] = gvcf
+            remaining.append(sample)
+        job.fileStore.logToMaster('Resuming run: skipping {} complete samples and reusing {} GVCFs from the '
+                                  'output directory'.format(len(complete), len(resumed_gvcfs)))
+        if complete:
+            job.fileStore.logToMaster('Complete samples:\n%s' % '\n'.join(complete))
+        samples = remaining
+        if not samples:
+            return
+
+    # Check that there is a reasonable number of samples for joint genotyping. Larger cohorts are
+    # supported by hierarchically combining GVCFs in batches.
     num_samples = len(samples)
-    if config.joint_genotype and not 30 < num_samples < 200:
+    max_samples = float('inf') if config.combine_batch_size else 200
+    if config.joint_genotype and not 30 < num_samples < max_samples:
         job.fileStore.logToMaster('WARNING: GATK recommends batches of '
                                   '30 to 200 samples for joint genotyping. '
                                   'The current cohort has %d samples.' % num_samples)
@@ -114,17 +167,21 @@ def run_gatk_germline_pipeline(job, samples, config):
     job.addChild(shared_files)
 
     if config.preprocess_only:
-        for sample in samples:
+        # Samples with the same input files and read group are preprocessed once
+        for group in group_samples_by_input(samples).itervalues():
+            sample = group[0]
             shared_files.addChildJobFn(prepare_bam,
                                        sample.uuid,
                                        sample.url,
                                        shared_files.rv(),
                                        paired_url=sample.paired_url,
-                                       rg_line=sample.rg_line)
+                                       rg_line=sample.rg_line,
+                                       aliases=group[1:])
     else:
         run_pipeline = Job.wrapJobFn(gatk_germline_pipeline,
                                      samples,
-                                     shared_files.rv()).encapsulate()
+                                     shared_files.rv(),
+                                     resumed_gvcfs=resumed_gvcfs).encapsulate()
         shared_files.addChild(run_pipeline)
 
         if config.run_oncotator:
@@ -132,7 +189,7 @@ def run_gatk_germline_pipeline(job, samples, config):
             run_pipeline.addChild(annotate)
 
 
-def gatk_germline_pipeline(job, samples, config):
+def gatk_germline_pipeline(job, samples, config, resumed_gvcfs=None):
     """
     Runs the GATK best practices pipeline for germline SNP and INDEL discovery.
 
@@ -160,7 +217,14 @@ def gatk_germline_pipeline(job, samples, config):
         config.ssec                 Path to key file for SSE-C encryption
         config.joint_genotype       If True, then joint genotype and filter cohort
         config.hc_output            URL or local path to HaplotypeCaller output for testing
-    :return: Dictionary of filtered VCF FileStoreIDs
+        config.hc_shards            Number of genomic shards for HaplotypeCaller
+        config.reference_cache      ReferenceCache namedtuple for the node-local reference cache or None
+        config.gvcf_store           Local path or S3 URL of the persistent GVCF store or None
+        config.gvcf_options         JSON encoded pipeline options that change the GVCF
+        config.resource_model       ResourceModel for job requirements or None
+        config.resource_limits      ResourceLimits for scaled job requirements or None
+    :param dict resumed_gvcfs: GVCFs in the output directory from a previous run {Sample ID: StoredGvcf}
+    :return: Dictionary of filtered VCF FileStoreIDs {Sample ID: IndexedVcf}
     :rtype: dict
     """
     require(len(samples) > 0, 'No samples were provided!')
@@ -172,45 +236,98 @@ def gatk_germline_pipeline(job, samples, config):
     # group preprocessing and variant calling steps in empty Job instance
     group_bam_jobs = Job()
     gvcfs = {}
+    reused = []
+    stored_gvcfs = {}
+    fingerprints = {}
+    resumed_gvcfs = resumed_gvcfs or {}
+    for sample in samples:
+        # Reuse the GVCF from a previous run if the sample is in the output directory or GVCF store
+        stored_gvcfs[sample.uuid] = resumed_gvcfs.get(sample.uuid)
+        if stored_gvcfs[sample.uuid] is None and config.gvcf_store:
+            fingerprints[sample.uuid] = sample_fingerprint(sample, config.gvcf_options, s3_key_path=config.ssec)
+            stored_gvcfs[sample.uuid] = find_stored_gvcf(config.gvcf_store, sample.uuid, fingerprints[sample.uuid])
+
+    # Samples with the same input files and read group share a single prepare_bam chain
+    input_groups = group_samples_by_input([sample for sample in samples if not stored_gvcfs[sample.uuid]])
+    bam_jobs = {}
     for sample in samples:
-        # 0: Generate processed BAM and BAI files for each sample
-        get_bam = group_bam_jobs.addChildJobFn(prepare_bam,
-                                               sample.uuid,
-                                               sample.url,
-                                               config,
-                                               paired_url=sample.paired_url,
-                                               rg_line=sample.rg_line)
-
-        # 1: Generate per sample gvcfs {uuid: gvcf_id}
-        # The HaplotypeCaller disk requirement depends on the input bam, bai, the genome reference
-        # files, and the output GVCF file. The output GVCF is smaller than the input BAM file.
-        hc_disk = PromisedRequirement(lambda bam, bai, ref_size:
-                                      2 * bam.size + bai.size + ref_size,
-                                      get_bam.rv(0),
-                                      get_bam.rv(1),
-                                      genome_ref_size)
-
-        get_gvcf = get_bam.addFollowOnJobFn(gatk_haplotype_caller,
-                                            get_bam.rv(0),
-                                            get_bam.rv(1),
-                                            config.genome_fasta, config.genome_fai, config.genome_dict,
-                                            intervals=config.intervals,
-                                            annotations=config.annotations,
-                                            cores=config.cores,
-                                            disk=hc_disk,
-                                            memory=config.xmx,
-                                            hc_output=config.hc_output)
+        stored_gvcf = stored_gvcfs[sample.uuid]
+        if stored_gvcf:
+            get_gvcf = group_bam_jobs.addChild(profiled_job(config.resource_model, import_stored_gvcf_job,
+                                                            stored_gvcf,
+                                                            s3_key_path=config.ssec,
+                                                            disk=stored_gvcf.size))
+            reused.append(sample.uuid)
+        else:
+            # 0: Generate processed BAM and BAI files once for each distinct input
+            key = sample_input(sample)
+            if key not in bam_jobs:
+                bam_jobs[key] = group_bam_jobs.addChildJobFn(prepare_bam,
+                                                             sample.uuid,
+                                                             sample.url,
+                                                             config,
+                                                             paired_url=sample.paired_url,
+                                                             rg_line=sample.rg_line,
+                                                             aliases=input_groups[key][1:])
+            get_bam = bam_jobs[key]
+
+            # 1: Generate per sample gvcfs {uuid: gvcf_id}
+            # Split variant calling across genomic shards. The pre-cooked HaplotypeCaller output used
+            # for testing covers the whole genome, so it is never sharded.
+            if config.hc_shards > 1 and not config.hc_output:
+                get_gvcf = Job.wrapJobFn(sharded_haplotype_caller,
+                                         get_bam.rv(0),
+                                         get_bam.rv(1),
+                                         config).encapsulate()
+            else:
+                # The HaplotypeCaller disk requirement depends on the input bam, bai, the genome reference
+                # files, and the output GVCF file. The output GVCF is smaller than the input BAM file.
+                hc_disk = PromisedRequirement(lambda bam, bai, ref_size:
+                                              2 * bam.size + bai.size + ref_size,
+                                              get_bam.rv(0),
+                                              get_bam.rv(1),
+                                              genome_ref_size)
+
+                get_gvcf = profiled_job(config.resource_model, gatk_haplotype_caller,
+                                        get_bam.rv(0),
+                                        get_bam.rv(1),
+                                        config.genome_fasta, config.genome_fai, config.genome_dict,
+                                        intervals=config.intervals,
+                                        annotations=config.annotations,
+                                        disk=hc_disk,
+                                        hc_output=config.hc_output,
+                                        reference_cache=config.reference_cache,
+                                        **scaled_resources(config, 'haplotype_caller', get_bam.rv(0)))
+            get_bam.addFollowOn(get_gvcf)
+
+            # Add the new GVCF to the GVCF store
+            if config.gvcf_store:
+                get_gvcf.addChildJobFn(output_vcf_job,
+                                       '%s.g.vcf.gz' % sample.uuid,
+                                       get_gvcf.rv(),
+                                       gvcf_store_dir(config.gvcf_store, sample.uuid, fingerprints[sample.uuid]),
+                                       s3_key_path=config.ssec,
+                                       disk=OUTPUT_DISK)
+
         # Store cohort GVCFs in dictionary
         gvcfs[sample.uuid] = get_gvcf.rv()
 
         # Upload individual sample GVCF before genotyping to a sample specific output directory
-        vqsr_name = '{}{}.g.vcf'.format(sample.uuid, config.suffix)
-        get_gvcf.addChildJobFn(output_file_job,
-                               vqsr_name,
-                               get_gvcf.rv(),
-                               os.path.join(config.output_dir, sample.uuid),
-                               s3_key_path=config.ssec,
-                               disk=PromisedRequirement(lambda x: x.size, get_gvcf.rv()))
+        if sample.uuid not in resumed_gvcfs:
+            vqsr_name = '{}{}.g.vcf.gz'.format(sample.uuid, config.suffix)
+            get_gvcf.addChildJobFn(output_vcf_job,
+                                   vqsr_name,
+                                   get_gvcf.rv(),
+                                   os.path.join(config.output_dir, sample.uuid),
+                                   s3_key_path=config.ssec,
+                                   disk=OUTPUT_DISK)
+
+    if config.gvcf_store:
+        job.fileStore.logToMaster('Reusing {} stored GVCFs and calling variants for {} samples'.format(
+            len(reused), len(samples) - len(reused)))
+    if len(bam_jobs) < len(samples) - len(reused):
+        job.fileStore.logToMaster('Preparing {} distinct inputs for {} samples'.format(
+            len(bam_jobs), len(samples) - len(reused)))
 
     # VQSR requires many variants in order to train a decent model. GATK recommends a minimum of
     # 30 exomes or one large WGS sample:
@@ -239,37 +356,114 @@ def joint_genotype_and_filter(job, gvcfs, config):
     Checks for enough disk space for joint genotyping, then calls the genotype and filter pipeline function.
 
     :param JobFunctionWrappingJob job: passed automatically by Toil
-    :param dict gvcfs: Dictionary of GVCFs {Sample ID: FileStoreID}
+    :param dict gvcfs: Dictionary of GVCFs {Sample ID: IndexedVcf}
     :param Namespace config: Input parameters and reference FileStoreIDs
         Requires the following config attributes:
         config.genome_fasta         FilesStoreID for reference genome fasta file
         config.genome_fai           FilesStoreID for reference genome fasta index file
         config.genome_dict          FilesStoreID for reference genome sequence dictionary file
         config.available_disk       Total available disk space
-    :returns: FileStoreID for the joint genotyped and filtered VCF file
-    :rtype: str
+        config.combine_batch_size   Maximum number of GVCFs combined in the first level of the tree
+        Additional attributes are required by combine_gvcfs and genotype_and_filter.
+    :returns: FileStoreIDs for the joint genotyped and filtered VCF file and its index
+    :rtype: IndexedVcf
     """
     # Get the total size of genome reference files
     genome_ref_size = config.genome_fasta.size + config.genome_fai.size + config.genome_dict.size
 
-    # Require at least 2.5x the sum of the individual GVCF files
+    # Require at least 2.5x the sum of the individual GVCF files. When genotyping is split into
+    # genomic shards, each genotyping job only requires its slice of the cohort GVCFs, but each
+    # GVCF must fit on a single worker while it is split.
     cohort_size = sum(gvcf.size for gvcf in gvcfs.values())
-    require(int(2.5 * cohort_size + genome_ref_size) < config.available_disk,
+    genotype_size = cohort_size / config.genotype_shards
+    if config.genotype_shards > 1:
+        genotype_size = max(genotype_size, max(gvcf.size for gvcf in gvcfs.values()))
+    require(int(2.5 * genotype_size + genome_ref_size) < config.available_disk,
             'There is not enough disk space to joint '
             'genotype samples:\n{}'.format('\n'.join(gvcfs.keys())))
 
     job.fileStore.logToMaster('Merging cohort into a single GVCF file')
 
+    # Combine large cohorts in batches, so that genotyping only opens the final cohort GVCF
+    if config.combine_batch_size and len(gvcfs) > config.combine_batch_size:
+        gvcf_ids = [gvcfs[uuid] for uuid in sorted(gvcfs)]
+        combine = Job.wrapJobFn(combine_gvcfs, gvcf_ids, config.combine_batch_size, config).encapsulate()
+        job.addChild(combine)
+        return combine.addFollowOnJobFn(genotype_and_filter, {'joint_genotyped': combine.rv()}, config).rv()
+
     return job.addChildJobFn(genotype_and_filter, gvcfs, config).rv()
 
 
+def combine_gvcfs(job, gvcf_ids, batch_size, config, level=0):
+    """
+    Hierarchically combines GVCF files into a single multi-sample GVCF file. GVCFs are combined
+    in parallel batches, then the batch GVCFs are combined again level by level until a single
+    cohort GVCF remains. The batches of each level are planned by combine.batch_gvcfs.
+
+    0: Combine batches of GVCFs     0 --> 1 --> ...
+    1: Combine batch GVCFs
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param list[IndexedVcf] gvcf_ids: FileStoreIDs for compressed GVCF files
+    :param int batch_size: Maximum number of GVCFs combined by each job at this level of the tree
+    :param Namespace config: Input parameters and shared FileStoreIDs
+        Requires the following config attributes:
+        config.genome_fasta         FilesStoreID for reference genome fasta file
+        config.genome_fai           FilesStoreID for reference genome fasta index file
+        config.genome_dict          FilesStoreID for reference genome sequence dictionary file
+        config.annotations          List of GATK variant annotations
+        config.xmx                  Java heap size in bytes
+        config.unsafe_mode          If True, then run GATK tools in UNSAFE mode
+        config.combine_fan_out      Maximum number of GVCFs combined by each job above the first level
+        config.reference_cache      ReferenceCache namedtuple for the node-local reference cache or None
+        config.resource_model       ResourceModel for job requirements or None
+        config.resource_limits      ResourceLimits for scaled job requirements or None
+    :param int level: Level of the combine tree, default is 0
+    :return: FileStoreIDs for the combined GVCF file and its index
+    :rtype: IndexedVcf
+    """
+    if len(gvcf_ids) == 1:
+        return gvcf_ids[0]
+
+    genome_ref_size = config.genome_fasta.size + config.genome_fai.size + config.genome_dict.size
+
+    batches = batch_gvcfs(gvcf_ids, batch_size)
+    job.fileStore.logToMaster('Combining {} GVCFs in {} batches at level {} of the combine tree'.format(
+        len(gvcf_ids), len(batches), level))
+    if level == 0:
+        job.fileStore.logToMaster('Combine tree batch sizes by level: {}'.format(
+            combine_tree(len(gvcf_ids), batch_size, config.combine_fan_out)))
+
+    combined = []
+    for batch in batches:
+        if len(batch) == 1:
+            combined.append(batch[0])
+            continue
+        # The CombineGVCFs disk requirement depends on the compressed input GVCFs, the genome
+        # reference files, and the compressed output GVCF file, which is smaller than the sum of
+        # the input GVCFs.
+        combined.append(job.addChild(profiled_job(config.resource_model, gatk_combine_gvcfs,
+                                                  batch,
+                                                  config.genome_fasta,
+                                                  config.genome_fai,
+                                                  config.genome_dict,
+                                                  annotations=config.annotations,
+                                                  unsafe_mode=config.unsafe_mode,
+                                                  reference_cache=config.reference_cache,
+                                                  disk=2 * sum(gvcf.size for gvcf in batch) + genome_ref_size,
+                                                  **scaled_resources(config, 'combine_gvcfs', batch,
+                                                                     num_samples=len(batch)))).rv())
+
+    return job.addFollowOnJobFn(combine_gvcfs, combined, config.combine_fan_out, config, level=level + 1).rv()
+
+
 def genotype_and_filter(job, gvcfs, config):
     """
     Genotypes one or more GVCF files and runs either the VQSR or hard filtering pipeline. Uploads the genotyped VCF file
     to the config output directory.
 
     :param JobFunctionWrappingJob job: passed automatically by Toil
-    :param dict gvcfs: Dictionary of GVCFs {Sample ID: FileStoreID}
+    :param dict gvcfs: Dictionary of GVCFs {Sample ID: IndexedVcf}
     :param Namespace config: Input parameters and shared FileStoreIDs
         Requires the following config attributes:
         config.genome_fasta         FilesStoreID for reference genome fasta file
@@ -281,29 +475,38 @@ def genotype_and_filter(job, gvcfs, config):
         config.cores                Number of cores for each job
         config.xmx                  Java heap size in bytes
         config.unsafe_mode          If True, then run GATK tools in UNSAFE mode
-    :return: FileStoreID for genotyped and filtered VCF file
-    :rtype: str
+        config.genotype_shards      Number of genomic shards for GenotypeGVCFs
+        config.resource_model       ResourceModel for job requirements or None
+        config.resource_limits      ResourceLimits for scaled job requirements or None
+    :return: FileStoreIDs for genotyped and filtered VCF file and its index
+    :rtype: IndexedVcf
     """
     # Get the total size of the genome reference
     genome_ref_size = config.genome_fasta.size + config.genome_fai.size + config.genome_dict.size
 
-    # GenotypeGVCF disk requirement depends on the input GVCF, the genome reference files, and
-    # the output VCF file. The output VCF is smaller than the input GVCF.
-    genotype_gvcf_disk = PromisedRequirement(lambda gvcf_ids, ref_size:
-                                             2 * sum(gvcf_.size for gvcf_ in gvcf_ids) + ref_size,
-                                             gvcfs.values(),
-                                             genome_ref_size)
-
-    genotype_gvcf = job.addChildJobFn(gatk_genotype_gvcfs,
-                                      gvcfs,
-                                      config.genome_fasta,
-                                      config.genome_fai,
-                                      config.genome_dict,
-                                      annotations=config.annotations,
-                                      unsafe_mode=config.unsafe_mode,
-                                      cores=config.cores,
-                                      disk=genotype_gvcf_disk,
-                                      memory=config.xmx)
+    if config.genotype_shards > 1:
+        genotype_gvcf = Job.wrapJobFn(sharded_genotype_gvcfs, gvcfs, config).encapsulate()
+        job.addChild(genotype_gvcf)
+
+    else:
+        # GenotypeGVCF disk requirement depends on the compressed input GVCF, the genome reference
+        # files, and the compressed output VCF file, which is smaller than the input GVCF.
+        genotype_gvcf_disk = PromisedRequirement(lambda gvcf_ids, ref_size:
+                                                 2 * sum(gvcf_.size for gvcf_ in gvcf_ids) + ref_size,
+                                                 gvcfs.values(),
+                                                 genome_ref_size)
+
+        genotype_gvcf = job.addChild(profiled_job(config.resource_model, gatk_genotype_gvcfs,
+                                                  gvcfs,
+                                                  config.genome_fasta,
+                                                  config.genome_fai,
+                                                  config.genome_dict,
+                                                  annotations=config.annotations,
+                                                  unsafe_mode=config.unsafe_mode,
+                                                  reference_cache=config.reference_cache,
+                                                  disk=genotype_gvcf_disk,
+                                                  **scaled_resources(config, 'genotype_gvcfs', gvcfs.values(),
+                                                                     num_samples=len(gvcfs))))
 
     # Determine if output GVCF has multiple samples
     if len(gvcfs) == 1:
@@ -311,13 +514,13 @@ def genotype_and_filter(job, gvcfs, config):
     else:
         uuid = 'joint_genotyped'
 
-    genotyped_filename = '%s.genotyped%s.vcf' % (uuid, config.suffix)
-    genotype_gvcf.addChildJobFn(output_file_job,
+    genotyped_filename = '%s.genotyped%s.vcf.gz' % (uuid, config.suffix)
+    genotype_gvcf.addChildJobFn(output_vcf_job,
                                 genotyped_filename,
                                 genotype_gvcf.rv(),
                                 os.path.join(config.output_dir, uuid),
                                 s3_key_path=config.ssec,
-                                disk=PromisedRequirement(lambda x: x.size, genotype_gvcf.rv()))
+                                disk=OUTPUT_DISK)
 
     if config.run_vqsr:
         if not config.joint_genotype:
@@ -334,49 +537,440 @@ def genotype_and_filter(job, gvcfs, config):
     return joint_genotype_vcf.rv()
 
 
+def sharded_genotype_gvcfs(job, gvcfs, config):
+    """
+    Genotypes one or more GVCF files in parallel across genomic shards. Each GVCF is split into
+    shards, then each genotyping job only localizes the slice of every GVCF that overlaps its shard.
+    The genotyped shards are concatenated in reference order.
+
+    0: Partition genome             0 --> 1 --> 2 --> 3
+    1: Split GVCFs by shard
+    2: Genotype each shard
+    3: Concatenate genotyped shards
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param dict gvcfs: Dictionary of GVCFs {Sample ID: IndexedVcf}
+    :param Namespace config: Input parameters and shared FileStoreIDs
+        Requires the following config attributes:
+        config.genome_dict          FilesStoreID for reference genome sequence dictionary file
+        config.intervals            FileStoreID for BED file containing analysis intervals or None
+        config.genotype_shards      Number of genomic shards
+        config.resource_model       ResourceModel for job requirements or None
+        Additional attributes are required by genotype_shards.
+    :return: FileStoreIDs for genotyped VCF file and its index
+    :rtype: IndexedVcf
+    """
+    work_dir = job.fileStore.getLocalTempDir()
+    with open(job.fileStore.readGlobalFile(config.genome_dict, os.path.join(work_dir, 'genome.dict'))) as f:
+        contigs = parse_sequence_dictionary(f)
+
+    if config.intervals:
+        with open(job.fileStore.readGlobalFile(config.intervals, os.path.join(work_dir, 'intervals.bed'))) as f:
+            intervals = sort_and_merge_intervals(parse_bed(f), contigs)
+    else:
+        intervals = genome_intervals(contigs)
+
+    shards = partition_intervals(intervals, config.genotype_shards)
+    job.fileStore.logToMaster('Genotyping {} samples across {} shards'.format(len(gvcfs), len(shards)))
+
+    # The split disk requirement depends on the input GVCF and the shard GVCFs. The shard GVCFs are
+    # slightly larger than the input GVCF because reference blocks that span a boundary are duplicated.
+    split_gvcfs = {}
+    for uuid, gvcf_id in gvcfs.iteritems():
+        split_disk = gvcf_id.size + len(shards) * vcf_output_disk(1.1 * gvcf_id.size / len(shards))
+        split_gvcfs[uuid] = job.addChild(profiled_job(config.resource_model, split_vcf_job, gvcf_id, shards,
+                                                      disk=split_disk)).rv()
+
+    return job.addFollowOnJobFn(genotype_gvcf_shards, split_gvcfs, shards, config).rv()
+
+
+def split_vcf_job(job, vcf_id, shards):
+    """
+    Splits a VCF file into genomic shards
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param IndexedVcf vcf_id: FileStoreIDs for compressed VCF file and its index
+    :param list[list[tuple]] shards: List of shards, where each shard is a list of
+                                     (contig, start, end) tuples
+    :return: FileStoreIDs for the compressed shard VCF files and their indexes in shard order
+    :rtype: list[IndexedVcf]
+    """
+    work_dir = job.fileStore.getLocalTempDir()
+    vcf_path = job.fileStore.readGlobalFile(vcf_id.vcf, os.path.join(work_dir, 'input.vcf.gz'))
+    shard_size = 1.1 * vcf_id.vcf.size / len(shards)
+    outputs = [IndexedVcfOutput(job, os.path.join(work_dir, 'shard.%d.vcf.gz' % i), shard_size)
+               for i in range(len(shards))]
+    with open_vcf(vcf_path) as f:
+        split_vcf(f, outputs, shards)
+    for output in outputs:
+        output.close()
+    return [output.ids for output in outputs]
+
+
+def genotype_gvcf_shards(job, split_gvcfs, shards, config):
+    """
+    Runs GenotypeGVCFs for each genomic shard, then concatenates the genotyped shards.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param dict split_gvcfs: Dictionary of shard GVCFs {Sample ID: [FileStoreID, ...]}
+    :param list[list[tuple]] shards: List of shards, where each shard is a list of
+                                     (contig, start, end) tuples
+    :param Namespace config: Input parameters and shared FileStoreIDs
+        Requires the following config attributes:
+        config.genome_fasta         FilesStoreID for reference genome fasta file
+        config.genome_fai           FilesStoreID for reference genome fasta index file
+        config.genome_dict          FilesStoreID for reference genome sequence dictionary file
+        config.annotations          List of GATK variant annotations
+        config.cores                Number of cores for each job
+        config.xmx                  Java heap size in bytes
+        config.unsafe_mode          If True, then run GATK tools in UNSAFE mode
+        config.reference_cache      ReferenceCache namedtuple for the node-local reference cache or None
+        config.resource_model       ResourceModel for job requirements or None
+        config.resource_limits      ResourceLimits for scaled job requirements or None
+    :return: FileStoreIDs for genotyped VCF file and its index
+    :rtype: IndexedVcf
+    """
+    work_dir = job.fileStore.getLocalTempDir()
+    genome_ref_size = config.genome_fasta.size + config.genome_fai.size + config.genome_dict.size
+
+    genotyped_shards = []
+    for i, shard in enumerate(shards):
+        shard_bed = os.path.join(work_dir, 'shard.%d.bed' % i)
+        with open(shard_bed, 'w') as f:
+            write_bed(shard, f)
+
+        shard_gvcfs = {uuid: gvcf_ids[i] for uuid, gvcf_ids in split_gvcfs.iteritems()}
+
+        # The GenotypeGVCFs disk requirement depends on the compressed shard GVCFs, the genome
+        # reference files, and the compressed output VCF file, which is smaller than the input GVCFs.
+        genotype_disk = 2 * sum(gvcf.size for gvcf in shard_gvcfs.values()) + genome_ref_size
+        genotyped_shards.append(job.addChild(profiled_job(config.resource_model, gatk_genotype_gvcfs,
+                                                          shard_gvcfs,
+                                                          config.genome_fasta,
+                                                          config.genome_fai,
+                                                          config.genome_dict,
+                                                          intervals=job.fileStore.writeGlobalFile(shard_bed),
+                                                          annotations=config.annotations,
+                                                          unsafe_mode=config.unsafe_mode,
+                                                          reference_cache=config.reference_cache,
+                                                          disk=genotype_disk,
+                                                          **scaled_resources(config, 'genotype_gvcfs',
+                                                                             shard_gvcfs.values(),
+                                                                             num_samples=len(shard_gvcfs)))).rv())
+
+    concat_disk = PromisedRequirement(lambda vcfs: sum(vcf.size for vcf in vcfs) +
+                                      vcf_output_disk(sum(vcf.size for vcf in vcfs)), genotyped_shards)
+    return job.addFollowOn(profiled_job(config.resource_model, concatenate_vcfs_job, genotyped_shards,
+                                        disk=concat_disk)).rv()
+
+
+def concatenate_vcfs_job(job, vcf_ids):
+    """
+    Concatenates VCF files that cover consecutive regions of the genome
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param list[IndexedVcf] vcf_ids: FileStoreIDs for compressed VCF files in reference order
+    :return: FileStoreIDs for concatenated VCF file and its index
+    :rtype: IndexedVcf
+    """
+    work_dir = job.fileStore.getLocalTempDir()
+    paths = [job.fileStore.readGlobalFile(vcf_id.vcf, os.path.join(work_dir, 'shard.%d.vcf.gz' % i))
+             for i, vcf_id in enumerate(vcf_ids)]
+    output = IndexedVcfOutput(job, os.path.join(work_dir, 'output.vcf.gz'), sum(vcf_id.size for vcf_id in vcf_ids))
+    with output as f:
+        num_records = concatenate_vcfs(paths, f)
+    job.fileStore.logToMaster('Concatenated {} records from {} VCF files'.format(num_records, len(paths)))
+    return output.ids
+
+
 def annotate_vcfs(job, vcfs, config):
     """
-    Runs Oncotator for a group of VCF files. Each sample is annotated individually.
+    Runs Oncotator for a group of VCF files. Each sample is annotated individually. Each VCF file is
+    split into chunks with the same number of records, which are annotated in parallel. If an
+    annotation cache is configured, then only variants that are not in the cache are annotated.
 
     :param JobFunctionWrappingJob job: passed automatically by Toil
-    :param dict vcfs: Dictionary of VCF FileStoreIDs {Sample identifier: FileStoreID}
+    :param dict vcfs: Dictionary of compressed VCF FileStoreIDs {Sample identifier: IndexedVcf}
     :param Namespace config: Input parameters and shared FileStoreIDs
         Requires the following config attributes:
         config.oncotator_db         FileStoreID to Oncotator database
+        config.oncotator_chunk_size Number of VCF records per Oncotator job
+        config.annotation_cache     AnnotationCache configuration or None
         config.suffix               Suffix added to output filename
         config.output_dir           URL or local path to output directory
         config.ssec                 Path to key file for SSE-C encryption
         config.cores                Number of cores for each job
         config.xmx                  Java heap size in bytes
+        config.resource_model       ResourceModel for job requirements or None
     """
     job.fileStore.logToMaster('Running Oncotator on the following samples:\n%s' % '\n'.join(vcfs.keys()))
+    # Jobs read a node-local copy of a snapshot of the annotation cache, because SQLite locking is
+    # not reliable on shared filesystems. The snapshot is copied first, so the shared file is not
+    # hard linked into the FileStore.
+    cache_id = None
+    if config.annotation_cache and os.path.exists(config.annotation_cache.path):
+        snapshot = os.path.join(job.fileStore.getLocalTempDir(), 'annotation_cache.db')
+        shutil.copyfile(config.annotation_cache.path, snapshot)
+        cache_id = job.fileStore.writeGlobalFile(snapshot)
+    cache_size = cache_id.size if cache_id else 0
+
+    new_annotations = []
     for uuid, vcf_id in vcfs.iteritems():
+        # Oncotator does not read compressed VCF files, so the chunks are written uncompressed
+        chunk_disk = PromisedRequirement(lambda vcf: (COMPRESSION_RATIO + 1) * vcf.size + cache_size, vcf_id)
+        chunks = job.addChild(profiled_job(config.resource_model, chunk_vcf_job,
+                                           vcf_id, config.oncotator_chunk_size,
+                                           annotation_cache=config.annotation_cache,
+                                           cache_id=cache_id,
+                                           disk=chunk_disk))
+        annotate = chunks.addChildJobFn(annotate_vcf_chunks, uuid, vcf_id, chunks.rv(), config, cache_id=cache_id)
+        new_annotations.append(annotate.rv())
+
+    # A single job adds the new annotations of every sample to the cache
+    if config.annotation_cache:
+        update_disk = PromisedRequirement(lambda ids: 2 * (cache_size + sum(x.size for x in ids)), new_annotations)
+        job.addFollowOnJobFn(update_annotation_cache_job, config.annotation_cache, new_annotations, disk=update_disk)
+
+
+def update_annotation_cache_job(job, annotation_cache, new_annotation_ids):
+    """
+    Adds the new annotations of every sample to the annotation cache. This is the only job that
+    writes the cache. The shared cache is copied to the work directory and updated, then copied
+    back under a temporary name that atomically replaces the shared cache.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param AnnotationCache annotation_cache: Annotation cache configuration
+    :param list[str] new_annotation_ids: FileStoreIDs for the new annotations from merge_annotations_job
+    """
+    work_dir = job.fileStore.getLocalTempDir()
+    path = os.path.join(work_dir, 'annotation_cache.db')
+    if os.path.exists(annotation_cache.path):
+        shutil.copyfile(annotation_cache.path, path)
+    db = open_annotation_cache(path)
+    num_annotations = 0
+    try:
+        for new_annotation_id in new_annotation_ids:
+            with job.fileStore.readGlobalFileStream(new_annotation_id) as f:
+                num_annotations += update_annotation_cache(db, annotation_cache.version, f)
+    finally:
+        db.close()
+    tmp_path = '{}.{}.tmp'.format(annotation_cache.path, uuid4())
+    try:
+        shutil.copyfile(path, tmp_path)
+        os.rename(tmp_path, annotation_cache.path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    job.fileStore.logToMaster('Added {} annotations to the annotation cache'.format(num_annotations))
+
+
+def read_annotation_cache(job, cache_id, work_dir):
+    """
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param str cache_id: FileStoreID for the annotation cache snapshot, or None if there is no cache yet
+    :param str work_dir: Job work directory
+    :return: Path to a node-local copy of the annotation cache, or ':memory:' for an empty cache
+    :rtype: str
+    """
+    if cache_id is None:
+        return ':memory:'
+    return job.fileStore.readGlobalFile(cache_id, os.path.join(work_dir, 'annotation_cache.db'), mutable=True)
+
+
+def chunk_vcf_job(job, vcf, chunk_size, annotation_cache=None, cache_id=None):
+    """
+    Splits a compressed VCF file into uncompressed chunks with the same number of records
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param IndexedVcf vcf: FileStoreIDs for the compressed VCF file and its index
+    :param int chunk_size: Maximum number of records per chunk
+    :param AnnotationCache annotation_cache: If set, then records in the annotation cache are left out of the chunks
+    :param str cache_id: FileStoreID for the annotation cache snapshot, default is None
+    :return: FileStoreIDs for the uncompressed chunk VCF files in file order
+    :rtype: list[str]
+    """
+    work_dir = job.fileStore.getLocalTempDir()
+    path = job.fileStore.readGlobalFile(vcf.vcf, os.path.join(work_dir, 'input.vcf.gz'))
+    # Count the records first, so the chunks can be balanced
+    cached = None
+    with open_vcf(path) as f:
+        if annotation_cache:
+            db = open_annotation_cache(read_annotation_cache(job, cache_id, work_dir))
+            try:
+                cached = find_cached_records(f, db, annotation_cache.version)
+            finally:
+                db.close()
+            num_records = len(cached) - sum(cached)
+            job.fileStore.logToMaster('Found {} of {} VCF records in the annotation cache ({:.1%})'.format(
+                sum(cached), len(cached), float(sum(cached)) / len(cached) if cached else 0))
+        else:
+            num_records = count_records(f)
+    num_chunks = -(-num_records // chunk_size)
+    # Without an annotation cache, the VCF is annotated even if it has no records
+    if not num_chunks and cached is None:
+        num_chunks = 1
+    chunk_paths = [os.path.join(work_dir, 'chunk.%d.vcf' % i) for i in range(num_chunks)]
+    outputs = [open(chunk_path, 'w') for chunk_path in chunk_paths]
+    try:
+        with open_vcf(path) as f:
+            counts = chunk_vcf(f if cached is None else uncached_records(f, cached), outputs, num_records)
+    finally:
+        for output in outputs:
+            output.close()
+    job.fileStore.logToMaster('Split {} VCF records into {} chunks: {}'.format(num_records, num_chunks,
+                                                                            ', '.join(map(str, counts))))
+    # Remove the compressed VCF file to free disk space
+    os.remove(path)
+    return [job.fileStore.writeGlobalFile(chunk_path) for chunk_path in chunk_paths]
+
+
+def annotate_vcf_chunks(job, uuid, vcf, chunk_ids, config, cache_id=None):
+    """
+    Runs Oncotator for each VCF chunk in parallel, then concatenates the annotated chunks in order
+    and uploads the annotated VCF file. If an annotation cache is configured, then the annotated
+    chunks are merged with the cached annotations.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param str uuid: Unique sample identifier
+    :param IndexedVcf vcf: FileStoreIDs for the compressed input VCF file and its index
+    :param list[str] chunk_ids: FileStoreIDs for uncompressed VCF chunks in file order
+    :param Namespace config: Input parameters and shared FileStoreIDs
+        Requires the following config attributes:
+        config.oncotator_db         FileStoreID to Oncotator database
+        config.annotation_cache     AnnotationCache configuration or None
+        config.suffix               Suffix added to output filename
+        config.output_dir           URL or local path to output directory
+        config.ssec                 Path to key file for SSE-C encryption
+        config.cores                Number of cores for each job
+        config.xmx                  Java heap size in bytes
+        config.resource_model       ResourceModel for job requirements or None
+        config.resource_limits      ResourceLimits for scaled job requirements or None
+    :param str cache_id: FileStoreID for the annotation cache snapshot, default is None
+    :return: FileStoreID for the new annotations if an annotation cache is configured, otherwise None
+    :rtype: str|None
+    """
+    annotated_chunks = []
+    for chunk_id in chunk_ids:
         # The Oncotator disk requirement depends on the input VCF, the Oncotator database
         # and the output VCF. The annotated VCF will be significantly larger than the input VCF.
-        onco_disk = PromisedRequirement(lambda vcf, db: 3 * vcf.size + db.size,
-                                        vcf_id,
-                                        config.oncotator_db)
-
-        annotated_vcf = job.addChildJobFn(run_oncotator,
-                                          vcf_id,
-                                          config.oncotator_db,
-                                          disk=onco_disk,
-                                          cores=config.cores,
-                                          memory=config.xmx)
-
-        output_dir = os.path.join(config.output_dir, uuid)
-        filename = '{}.oncotator{}.vcf'.format(uuid, config.suffix)
-        annotated_vcf.addChildJobFn(output_file_job,
-                                    filename,
-                                    annotated_vcf.rv(),
-                                    output_dir,
-                                    s3_key_path=config.ssec,
-                                    disk=PromisedRequirement(lambda x: x.size, annotated_vcf.rv()))
+        annotated_chunks.append(job.addChild(profiled_job(config.resource_model, run_oncotator,
+                                                          chunk_id,
+                                                          config.oncotator_db,
+                                                          disk=3 * chunk_id.size + config.oncotator_db.size,
+                                                          **scaled_resources(config, 'oncotator', chunk_id))).rv())
+
+    if config.annotation_cache:
+        # The merge disk requirement depends on the input VCF, the annotated chunks and their
+        # database, the cache snapshot, and the annotated VCF, which is about three times larger
+        # than the input VCF.
+        cache_size = cache_id.size if cache_id else 0
+        merge_disk = PromisedRequirement(lambda vcfs: vcf.size + vcf_output_disk(3 * vcf.size) + cache_size +
+                                         2 * sum(x.size for x in vcfs), annotated_chunks)
+        annotated_vcf = job.addFollowOn(profiled_job(config.resource_model, merge_annotations_job,
+                                                     vcf, annotated_chunks, config.annotation_cache, cache_id,
+                                                     disk=merge_disk))
+        annotated_vcf_id, new_annotations = annotated_vcf.rv(0), annotated_vcf.rv(1)
+    else:
+        concat_disk = PromisedRequirement(lambda vcfs: sum(x.size for x in vcfs) +
+                                          vcf_output_disk(sum(x.size for x in vcfs) / COMPRESSION_RATIO),
+                                          annotated_chunks)
+        annotated_vcf = job.addFollowOn(profiled_job(config.resource_model, concatenate_vcf_chunks_job,
+                                                     annotated_chunks, disk=concat_disk))
+        annotated_vcf_id, new_annotations = annotated_vcf.rv(), None
+
+    output_dir = os.path.join(config.output_dir, uuid)
+    filename = '{}.oncotator{}.vcf.gz'.format(uuid, config.suffix)
+    annotated_vcf.addChildJobFn(output_vcf_job,
+                                filename,
+                                annotated_vcf_id,
+                                output_dir,
+                                s3_key_path=config.ssec,
+                                disk=OUTPUT_DISK)
+    return new_annotations
+
+
+def concatenate_vcf_chunks_job(job, vcf_ids):
+    """
+    Concatenates uncompressed VCF chunks into a compressed VCF file with a single header
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param list[str] vcf_ids: FileStoreIDs for uncompressed VCF chunks in file order
+    :return: FileStoreIDs for the concatenated VCF file and its index
+    :rtype: IndexedVcf
+    """
+    work_dir = job.fileStore.getLocalTempDir()
+    paths = [job.fileStore.readGlobalFile(vcf_id, os.path.join(work_dir, 'chunk.%d.vcf' % i))
+             for i, vcf_id in enumerate(vcf_ids)]
+    # The chunks are uncompressed, so the output is about COMPRESSION_RATIO times smaller
+    output = IndexedVcfOutput(job, os.path.join(work_dir, 'output.vcf.gz'),
+                              sum(vcf_id.size for vcf_id in vcf_ids) / COMPRESSION_RATIO)
+    with output as f:
+        num_records = concatenate_vcfs(paths, f)
+    job.fileStore.logToMaster('Concatenated {} records from {} VCF chunks'.format(num_records, len(paths)))
+    return output.ids
+
+
+def merge_annotations_job(job, vcf, vcf_ids, annotation_cache, cache_id=None):
+    """
+    Annotates a VCF file with the annotated chunks and the annotation cache. The new annotations
+    are returned so that update_annotation_cache_job can add them to the cache.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param IndexedVcf vcf: FileStoreIDs for the compressed input VCF file and its index
+    :param list[str] vcf_ids: FileStoreIDs for annotated, uncompressed VCF chunks in file order
+    :param AnnotationCache annotation_cache: Annotation cache configuration
+    :param str cache_id: FileStoreID for the annotation cache snapshot, default is None
+    :return: FileStoreIDs for the annotated VCF file and its index, and FileStoreID for the new annotations
+    :rtype: tuple(IndexedVcf, str)
+    """
+    work_dir = job.fileStore.getLocalTempDir()
+    path = job.fileStore.readGlobalFile(vcf.vcf, os.path.join(work_dir, 'input.vcf.gz'))
+    paths = [job.fileStore.readGlobalFile(vcf_id, os.path.join(work_dir, 'chunk.%d.vcf' % i))
+             for i, vcf_id in enumerate(vcf_ids)]
+    # The annotated VCF file is about three times larger than the input VCF file
+    output = IndexedVcfOutput(job, os.path.join(work_dir, 'output.vcf.gz'), 3 * vcf.vcf.size)
+    new_annotations = os.path.join(work_dir, 'new_annotations.tsv')
+    # The annotated chunks are read in order, and their headers are skipped after the first chunk
+    annotated = chain.from_iterable(open_vcf(chunk_path) for chunk_path in paths)
+    db = open_annotation_cache(read_annotation_cache(job, cache_id, work_dir))
+    try:
+        with open_vcf(path) as g, output as f, open(new_annotations, 'w') as h:
+            num_cached, num_annotated = merge_annotations(g, annotated, db, annotation_cache.version, f, h,
+                                                          work_path=os.path.join(work_dir, 'annotated.db'))
+    finally:
+        db.close()
+    job.fileStore.logToMaster('Annotated {} records from the annotation cache and {} records with '
+                              'Oncotator'.format(num_cached, num_annotated))
+    return output.ids, job.fileStore.writeGlobalFile(new_annotations)
 
 
 # Pipeline convenience functions
 
 
+def sample_input(sample):
+    """
+    :param GermlineSample sample: Sample from the manifest
+    :return: Input files and read group of the sample
+    :rtype: tuple(str, str|None, str|None)
+    """
+    return sample.url, sample.paired_url, sample.rg_line
+
+
+def group_samples_by_input(samples):
+    """
+    Groups samples that have the same input files and read group, such as samples that are listed
+    under several identifiers in a re-analysis manifest
+
+    :param list[GermlineSample] samples: List of GermlineSample namedtuples
+    :return: Samples for each distinct input in manifest order {sample_input: [GermlineSample]}
+    :rtype: OrderedDict
+    """
+    groups = OrderedDict()
+    for sample in samples:
+        groups.setdefault(sample_input(sample), []).append(sample)
+    return groups
+
+
 def parse_manifest(path_to_manifest):
     """
     Parses manifest file for Toil Germline Pipeline
@@ -423,10 +1017,13 @@ def download_shared_files(job, config):
 
     :param JobFunctionWrappingJob job: passed automatically by Toil
     :param Namespace config: Pipeline configuration options
+        Requires the following config attributes:
+        config.bundle_cache_dir     Path to directory for caching reference files across runs or None
     :return: Updated config with shared fileStoreIDS
     :rtype: Namespace
     """
     job.fileStore.logToMaster('Downloading shared reference files')
+    genome_fasta_url = config.genome_fasta
     shared_files = {'genome_fasta', 'genome_fai', 'genome_dict'}
     nonessential_files = {'genome_fai', 'genome_dict'}
 
@@ -447,41 +1044,140 @@ def download_shared_files(job, config):
             url = getattr(config, name, None)
             if url is None:
                 continue
-            setattr(config, name, job.addChildJobFn(download_url_job,
-                                                    url,
-                                                    name=name,
-                                                    s3_key_path=config.ssec).rv())
+            # Reuse reference files downloaded by previous runs
+            if config.bundle_cache_dir:
+                setattr(config, name, job.addChildJobFn(cached_download_url_job,
+                                                        url,
+                                                        config.bundle_cache_dir,
+                                                        name=name,
+                                                        s3_key_path=config.ssec).rv())
+            else:
+                setattr(config, name, job.addChildJobFn(download_url_job,
+                                                        url,
+                                                        name=name,
+                                                        s3_key_path=config.ssec).rv())
         finally:
             if getattr(config, name, None) is None and name not in nonessential_files:
                 raise ValueError("Necessary configuration parameter is missing:\n{}".format(name))
-    return job.addFollowOnJobFn(reference_preprocessing, config).rv()
+    return job.addFollowOnJobFn(reference_preprocessing, config, genome_fasta_url=genome_fasta_url).rv()
 
 
-def reference_preprocessing(job, config):
+def reference_preprocessing(job, config, genome_fasta_url=None):
     """
     Creates a genome fasta index and sequence dictionary file if not already present in the pipeline config.
 
     :param JobFunctionWrappingJob job: passed automatically by Toil
     :param Namespace config: Pipeline configuration options and shared files.
                              Requires FileStoreID for genome fasta file as config.genome_fasta
+                             the bundle cache directory or None as config.bundle_cache_dir,
+                             the ResourceModel or None as config.resource_model,
+                             and the number of HaplotypeCaller shards as config.hc_shards
+    :param str genome_fasta_url: URL for the genome fasta file. Used to cache the index files
+                                 across runs if config.bundle_cache_dir is set.
     :return: Updated config with reference index files
     :rtype: Namespace
     """
     job.fileStore.logToMaster('Preparing Reference Files')
     genome_id = config.genome_fasta
-    if getattr(config, 'genome_fai', None) is None:
-        config.genome_fai = job.addChildJobFn(run_samtools_faidx,
+    if getattr(config, 'genome_fai', None) is None or getattr(config, 'genome_dict', None) is None:
+        # Both files are created in a single pass over the genome fasta file
+        if config.bundle_cache_dir and genome_fasta_url:
+            index = job.addChildJobFn(cached_derived_files_job,
+                                      config.bundle_cache_dir,
+                                      genome_fasta_url,
+                                      ['.fai', '.dict'],
+                                      genome_id,
+                                      index_reference_job,
+                                      uri=genome_fasta_url,
+                                      disk=genome_id.size)
+        else:
+            index = job.addChild(profiled_job(config.resource_model, index_reference_job,
                                               genome_id,
-                                              cores=config.cores).rv()
-    if getattr(config, 'genome_dict', None) is None:
-        config.genome_dict = job.addChildJobFn(run_picard_create_sequence_dictionary,
-                                               genome_id,
-                                               cores=config.cores,
-                                               memory=config.xmx).rv()
+                                              uri=genome_fasta_url,
+                                              disk=genome_id.size))
+        if getattr(config, 'genome_fai', None) is None:
+            config.genome_fai = index.rv(0)
+        if getattr(config, 'genome_dict', None) is None:
+            config.genome_dict = index.rv(1)
+    else:
+        index = None
+
+    # The shards are the same for every sample, so the genome is only scanned for assembly gaps once
+    if config.hc_shards > 1 and not config.hc_output:
+        shard_job = profiled_job(config.resource_model, shard_intervals_job, config, disk=2 * genome_id.size)
+        if index is None:
+            job.addChild(shard_job)
+        else:
+            index.addFollowOn(shard_job)
+        config.hc_shard_intervals = shard_job.rv()
     return config
 
 
-def prepare_bam(job, uuid, url, config, paired_url=None, rg_line=None):
+def index_reference_job(job, genome_id, uri=None):
+    """
+    Creates the fasta index and sequence dictionary for a genome fasta file
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param str genome_id: FileStoreID for the genome fasta file
+    :param str uri: URI of the genome fasta file recorded in the sequence dictionary
+    :return: FileStoreIDs for the fasta index and sequence dictionary
+    :rtype: tuple(str, str)
+    """
+    work_dir = job.fileStore.getLocalTempDir()
+    path = job.fileStore.readGlobalFile(genome_id, os.path.join(work_dir, 'ref.fasta'))
+    fai = os.path.join(work_dir, 'ref.fasta.fai')
+    seq_dict = os.path.join(work_dir, 'ref.dict')
+    with open_fasta(path) as f, open(fai, 'w') as g, open(seq_dict, 'w') as h:
+        num_sequences = index_fasta(f, g, h, uri=uri or 'file:' + path)
+    job.fileStore.logToMaster('Created reference index and dictionary for {} sequences'.format(num_sequences))
+    return job.fileStore.writeGlobalFile(fai), job.fileStore.writeGlobalFile(seq_dict)
+
+
+def shard_intervals_job(job, config):
+    """
+    Splits the genome into shards that span approximately the same number of bases. Shards are only
+    split at contig and interval boundaries and inside assembly gaps, because HaplotypeCaller clips
+    active regions at the edges of its intervals.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param Namespace config: Pipeline configuration options and shared files
+        Requires the following config attributes:
+        config.genome_fasta         FilesStoreID for reference genome fasta file
+        config.genome_dict          FilesStoreID for reference genome sequence dictionary file
+        config.intervals            FileStoreID for BED file containing analysis intervals or None
+        config.hc_shards            Number of genomic shards
+    :return: Shard BED files
+    :rtype: list[Shard]
+    """
+    work_dir = job.fileStore.getLocalTempDir()
+    with open(job.fileStore.readGlobalFile(config.genome_dict, os.path.join(work_dir, 'genome.dict'))) as f:
+        contigs = parse_sequence_dictionary(f)
+
+    if config.intervals:
+        with open(job.fileStore.readGlobalFile(config.intervals, os.path.join(work_dir, 'intervals.bed'))) as f:
+            intervals = sort_and_merge_intervals(parse_bed(f), contigs)
+    else:
+        intervals = genome_intervals(contigs)
+
+    # open_fasta decompresses BGZF fasta files and rejects plain gzip files
+    with open_fasta(job.fileStore.readGlobalFile(config.genome_fasta, os.path.join(work_dir, 'genome.fa'))) as f:
+        gaps = find_gaps(f, SHARD_GAP_LENGTH)
+    shards = partition_intervals(intervals, config.hc_shards, gaps=gaps)
+    if len(shards) < config.hc_shards:
+        job.fileStore.logToMaster('Split the genome into {} shards instead of {}, because shards are only split at '
+                                  'contig or interval boundaries and {} assembly gaps'.format(len(shards),
+                                                                                              config.hc_shards,
+                                                                                              len(gaps)))
+    results = []
+    for i, shard in enumerate(shards):
+        shard_bed = os.path.join(work_dir, 'shard.%d.bed' % i)
+        with open(shard_bed, 'w') as f:
+            write_bed(shard, f)
+        results.append(Shard(job.fileStore.writeGlobalFile(shard_bed), interval_size(shard), len(shard)))
+    return results
+
+
+def prepare_bam(job, uuid, url, config, paired_url=None, rg_line=None, aliases=None):
     """
     Prepares BAM file for Toil germline pipeline.
 
@@ -489,6 +1185,7 @@ def prepare_bam(job, uuid, url, config, paired_url=None, rg_line=None):
     0: Download and align BAM or FASTQ sample
     1: Sort BAM
     2: Index BAM
+        - If fused alignment is enabled, bwakit sorts and indexes the BAM in the alignment job
     3: Run GATK preprocessing pipeline (Optional)
         - Uploads preprocessed BAM to output directory
 
@@ -508,8 +1205,13 @@ def prepare_bam(job, uuid, url, config, paired_url=None, rg_line=None):
         config.ssec                 Path to key file for SSE-C encryption
         config.cores                Number of cores for each job
         config.xmx                  Java heap size in bytes
+        config.fused_alignment      If True, align, sort, and index the BAM in a single job
+        config.resource_model       ResourceModel for job requirements or None
+        config.resource_limits      ResourceLimits for scaled job requirements or None
     :param str|None paired_url: URL or local path to paired FASTQ file, default is None
     :param str|None rg_line: RG line for BWA alignment (i.e. @RG\tID:foo\tSM:bar), default is None
+    :param list[GermlineSample]|None aliases: Other samples with the same input files and read group, which
+                                              also get the preprocessed BAM in their output directories
     :return: BAM and BAI FileStoreIDs
     :rtype: tuple
     """
@@ -535,32 +1237,47 @@ def prepare_bam(job, uuid, url, config, paired_url=None, rg_line=None):
                          'Provide a FASTQ URL and set run-bwa or '
                          'provide a BAM URL that includes .bam extension.' % uuid)
 
+    job.addChild(get_bam)
+    index_bam = None
+
+    # 1, 2: Fused alignment sorts and indexes the BAM file in the alignment job
+    if config.run_bwa and config.fused_alignment:
+        sorted_bam = index_bam = get_bam
+        bam_promise = get_bam.rv(0)
+        bai_promise = get_bam.rv(1)
+
     # 1: Sort BAM file if necessary
     # Realigning BAM file shuffles read order
-    if config.sorted and not config.run_bwa:
+    elif config.sorted and not config.run_bwa:
         sorted_bam = get_bam
 
-    else:
+    elif config.run_bwa:
         # The samtools sort disk requirement depends on the input bam, the tmp files, and the
         # sorted output bam.
         sorted_bam_disk = PromisedRequirement(lambda bam: 3 * bam.size, get_bam.rv())
-        sorted_bam = get_bam.addChildJobFn(run_samtools_sort,
-                                           get_bam.rv(),
-                                           cores=config.cores,
-                                           disk=sorted_bam_disk)
+        sorted_bam = get_bam.addChild(profiled_job(config.resource_model, run_samtools_sort,
+                                                   get_bam.rv(),
+                                                   disk=sorted_bam_disk,
+                                                   **scaled_resources(config, 'samtools_sort', get_bam.rv())))
+
+    else:
+        # Check the BAM header before sorting, because BAM files are often already sorted
+        sorted_bam = job.wrapJobFn(sort_bam_if_unsorted, uuid, get_bam.rv(), config).encapsulate()
+        get_bam.addChild(sorted_bam)
 
     # 2: Index BAM
     # The samtools index disk requirement depends on the input bam and the output bam index
-    index_bam_disk = PromisedRequirement(lambda bam: bam.size, sorted_bam.rv())
-    index_bam = job.wrapJobFn(run_samtools_index, sorted_bam.rv(), disk=index_bam_disk)
-
-    job.addChild(get_bam)
-    sorted_bam.addChild(index_bam)
+    if index_bam is None:
+        index_bam_disk = PromisedRequirement(lambda bam: bam.size, sorted_bam.rv())
+        index_bam = profiled_job(config.resource_model, run_samtools_index, sorted_bam.rv(), disk=index_bam_disk)
+        sorted_bam.addChild(index_bam)
+        bam_promise = sorted_bam.rv()
+        bai_promise = index_bam.rv()
 
     if config.preprocess:
         preprocess = job.wrapJobFn(run_gatk_preprocessing,
-                                   sorted_bam.rv(),
-                                   index_bam.rv(),
+                                   bam_promise,
+                                   bai_promise,
                                    config.genome_fasta,
                                    config.genome_dict,
                                    config.genome_fai,
@@ -569,32 +1286,66 @@ def prepare_bam(job, uuid, url, config, paired_url=None, rg_line=None):
                                    config.dbsnp,
                                    intervals=config.intervals,
                                    realign=False,    # Do not realign INDELs
-                                   memory=config.xmx,
-                                   cores=config.cores).encapsulate()
+                                   **scaled_resources(config, 'gatk_preprocessing', bam_promise)).encapsulate()
         sorted_bam.addChild(preprocess)
-        index_bam.addChild(preprocess)
+        if index_bam is not sorted_bam:
+            index_bam.addChild(preprocess)
 
         # Update output BAM promises
         output_bam_promise = preprocess.rv(0)
         output_bai_promise = preprocess.rv(1)
 
-        # Save processed BAM
-        output_dir = os.path.join(config.output_dir, uuid)
-        filename = '{}.preprocessed{}.bam'.format(uuid, config.suffix)
-        output_bam = job.wrapJobFn(output_file_job,
-                                   filename,
-                                   preprocess.rv(0),
-                                   output_dir,
-                                   s3_key_path=config.ssec)
-        preprocess.addChild(output_bam)
+        # Save processed BAM for the sample and every sample with the same input
+        for output_uuid in [uuid] + [alias.uuid for alias in aliases or []]:
+            output_dir = os.path.join(config.output_dir, output_uuid)
+            filename = '{}.preprocessed{}.bam'.format(output_uuid, config.suffix)
+            output_bam = job.wrapJobFn(output_file_job,
+                                       filename,
+                                       preprocess.rv(0),
+                                       output_dir,
+                                       s3_key_path=config.ssec,
+                                       disk=OUTPUT_DISK)
+            preprocess.addChild(output_bam)
 
     else:
-        output_bam_promise = sorted_bam.rv()
-        output_bai_promise = index_bam.rv()
+        output_bam_promise = bam_promise
+        output_bai_promise = bai_promise
 
     return output_bam_promise, output_bai_promise
 
 
+def sort_bam_if_unsorted(job, uuid, bam_id, config):
+    """
+    Reads the BAM header and sorts the BAM file unless the header reports coordinate sort order
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param str uuid: Unique identifier for the sample
+    :param str bam_id: BAM FileStoreID
+    :param Namespace config: Configuration options for pipeline
+        Requires the following config attributes:
+        config.cores                Number of cores for each job
+        config.resource_model       ResourceModel for job requirements or None
+        config.resource_limits      ResourceLimits for scaled job requirements or None
+    :return: Coordinate sorted BAM FileStoreID
+    :rtype: str
+    """
+    with job.fileStore.readGlobalFileStream(bam_id) as f:
+        header = read_bam_header(f)
+
+    job.fileStore.logToMaster('BAM header for {}: sort order {}, {} contigs, read groups: {}'.format(
+        uuid, header.sort_order, len(header.contigs),
+        ', '.join(rg.get('ID', '?') for rg in header.read_groups) or 'none'))
+
+    if header.sort_order == 'coordinate':
+        job.fileStore.logToMaster('Skipping sort for {}, BAM is already coordinate sorted'.format(uuid))
+        return bam_id
+
+    # The samtools sort disk requirement depends on the input bam, the tmp files, and the
+    # sorted output bam.
+    return job.addChild(profiled_job(config.resource_model, run_samtools_sort, bam_id, disk=3 * bam_id.size,
+                                     **scaled_resources(config, 'samtools_sort', bam_id))).rv()
+
+
 def setup_and_run_bwakit(job, uuid, url, rg_line, config, paired_url=None):
     """
     Downloads and runs bwakit for BAM or FASTQ files
@@ -614,10 +1365,13 @@ def setup_and_run_bwakit(job, uuid, url, rg_line, config, paired_url=None):
         config.pac                  FileStoreID for BWA index file prefix.pac
         config.sa                   FileStoreID for BWA index file prefix.sa
         config.alt                  FileStoreID for alternate contigs file or None
+        config.fused_alignment      If True, sort and index the BAM in the alignment job
+        config.resource_model       ResourceModel for job requirements or None
+        config.resource_limits      ResourceLimits for scaled job requirements or None
     :param str|None paired_url: URL to paired FASTQ
     :param str|None rg_line: Read group line (i.e. @RG\tID:foo\tSM:bar)
-    :return: BAM FileStoreID
-    :rtype: str
+    :return: BAM FileStoreID, or sorted BAM and BAI FileStoreIDs if config.fused_alignment is True
+    :rtype: str|tuple(str, str)
     """
     bwa_config = deepcopy(config)
     bwa_config.uuid = uuid
@@ -675,13 +1429,155 @@ def setup_and_run_bwakit(job, uuid, url, rg_line, config, paired_url=None):
                                       samples,
                                       bwa_index_size)
 
-    return job.addFollowOnJobFn(run_bwakit,
-                                bwa_config,
-                                sort=False,             # BAM files are sorted later in the pipeline
-                                trim=config.trim,
-                                mark_secondary=True,    # Mark split alignments as secondary
-                                cores=config.cores,
-                                disk=bwakit_disk).rv()
+    if config.fused_alignment:
+        # The fused job also holds the sorted BAM, the samtools sort tmp files, and the BAM index
+        fused_disk = PromisedRequirement(lambda lst, index_size:
+                                         int(5 * sum(x.size for x in lst) + index_size),
+                                         samples,
+                                         bwa_index_size)
+        # bwa mem holds the index in memory and bwakit -s sorts in memory with every thread
+        fused_memory = PromisedRequirement(fused_alignment_memory,
+                                           samples,
+                                           bwa_index_size,
+                                           config.cores,
+                                           config.resource_limits)
+        requirements = scaled_resources(config, 'bwakit', samples)
+        requirements['memory'] = fused_memory
+        return job.addFollowOn(profiled_job(config.resource_model, run_bwakit_sort_and_index,
+                                            bwa_config,
+                                            trim=config.trim,
+                                            mark_secondary=True,
+                                            disk=fused_disk,
+                                            **requirements)).rv()
+
+    return job.addFollowOn(profiled_job(config.resource_model, run_bwakit,
+                                        bwa_config,
+                                        sort=False,             # BAM files are sorted later in the pipeline
+                                        trim=config.trim,
+                                        mark_secondary=True,    # Mark split alignments as secondary
+                                        disk=bwakit_disk,
+                                        **scaled_resources(config, 'bwakit', samples))).rv()
+
+
+def fused_alignment_memory(samples, index_size, cores, limits=None):
+    """
+    Returns the memory requirement of run_bwakit_sort_and_index. bwa mem loads the BWA index into
+    memory, and bwakit -s runs samtools sort with BWAKIT_SORT_MEMORY per thread.
+
+    :param list samples: Input FileStoreIDs
+    :param int index_size: Total size of the BWA index files in bytes
+    :param int cores: Number of cores for the job if limits is None
+    :param ResourceLimits limits: Floors and ceilings for scaled job requirements or None
+    :return: Memory requirement in bytes
+    :rtype: int
+    """
+    if limits is not None:
+        cores = scaled_requirement(limits, 'bwakit', 'cores', input_size(samples))
+    return int(index_size + cores * BWAKIT_SORT_MEMORY)
+
+
+def run_bwakit_sort_and_index(job, config, trim=False, mark_secondary=False):
+    """
+    Aligns FASTQ files or realigns a BAM file with bwakit, which pipes the alignments into
+    samtools sort, then indexes the sorted BAM in the same work directory. Compared to running
+    bwakit, samtools sort, and samtools index as separate jobs, the BAM file is written to the
+    FileStore once and never read back.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param Namespace config: Input parameters and shared FileStoreIDs
+        Requires the following config attributes:
+        config.uuid                 Unique sample identifier
+        config.rg_line              Read group line (i.e. @RG\tID:foo\tSM:bar) or None
+        config.r1                   FileStoreID for FASTQ file, or None if realigning BAM
+        config.r2                   FileStoreID for paired FASTQ file or None
+        config.bam                  FileStoreID for BAM file to be realigned, or None if aligning FASTQ
+        config.ref                  FileStoreID for reference genome fasta file
+        config.fai                  FileStoreID for reference genome fasta index file
+        config.amb                  FileStoreID for BWA index file prefix.amb
+        config.ann                  FileStoreID for BWA index file prefix.ann
+        config.bwt                  FileStoreID for BWA index file prefix.bwt
+        config.pac                  FileStoreID for BWA index file prefix.pac
+        config.sa                   FileStoreID for BWA index file prefix.sa
+        config.alt                  FileStoreID for alternate contigs file or None
+        config.reference_cache      ReferenceCache namedtuple for the node-local reference cache or None
+    :param bool trim: If True, trim adapters using bwakit
+    :param bool mark_secondary: If True, mark shorter split reads as secondary
+    :return: Sorted BAM and BAI FileStoreIDs
+    :rtype: tuple(str, str)
+    """
+    start = time.time()
+    work_dir = job.fileStore.getLocalTempDir()
+    references = {'ref.fa': config.ref,
+                  'ref.fa.fai': config.fai,
+                  'ref.fa.amb': config.amb,
+                  'ref.fa.ann': config.ann,
+                  'ref.fa.bwt': config.bwt,
+                  'ref.fa.pac': config.pac,
+                  'ref.fa.sa': config.sa}
+    if getattr(config, 'alt', None):
+        references['ref.fa.alt'] = config.alt
+    read_reference_files(job, references, work_dir, cache=config.reference_cache)
+
+    samples = {}
+    for name, attr in [('input.1.fq.gz', 'r1'), ('input.2.fq.gz', 'r2'), ('input.bam', 'bam')]:
+        if getattr(config, attr, None):
+            samples[name] = getattr(config, attr)
+    for name, file_id in samples.iteritems():
+        job.fileStore.readGlobalFile(file_id, os.path.join(work_dir, name))
+    input_bytes = sum(x.size for x in references.values() + samples.values())
+
+    parameters = ['-t', str(job.cores), '-s']
+    if trim:
+        parameters.append('-a')
+    if mark_secondary:
+        parameters.append('-M')
+    parameters += ['-o', '/data/aligned', '/data/ref.fa']
+    # If realigning, then bwakit can use pre-existing read group data
+    if getattr(config, 'rg_line', None):
+        parameters = ['-R', config.rg_line] + parameters
+    parameters += ['/data/{}'.format(name) for name in sorted(samples)]
+
+    # The samtools sort temporary files only exist while bwakit runs, so the disk usage is
+    # sampled during the docker calls
+    profiler = Profiler(job)
+    profiler.start()
+    try:
+        docker_call(job=job,
+                    tool='quay.io/ucsc_cgl/bwakit:0.7.12--c85ccff267d5021b75bb1c9ccf5f4b79f91835cc',
+                    parameters=parameters,
+                    inputs=references.keys() + samples.keys(),
+                    outputs={'aligned.aln.bam': None},
+                    work_dir=work_dir)
+
+        docker_call(job=job,
+                    tool='quay.io/ucsc_cgl/samtools:0.1.19--dd5ac549b95eb3e5d166a5e310417ef13651994e',
+                    parameters=['index', '/data/aligned.aln.bam'],
+                    inputs=['aligned.aln.bam'],
+                    outputs={'aligned.aln.bam.bai': None},
+                    work_dir=work_dir)
+    finally:
+        peak_disk = profiler.stop()['disk']
+
+    bam_path = os.path.join(work_dir, 'aligned.aln.bam')
+    bam_size = os.path.getsize(bam_path)
+    bai_size = os.path.getsize(bam_path + '.bai')
+
+    # The separate jobs are not run, so their numbers are estimates: they write the unsorted BAM,
+    # then the sort job reads it and writes the sorted BAM, then the index job reads the sorted BAM
+    # again. The sort job requests 3x the BAM size. The unsorted BAM is assumed to be the same size
+    # as the sorted BAM.
+    moved = input_bytes + bam_size + bai_size
+    estimated_chain_moved = moved + 3 * bam_size
+    estimated_chain_peak_disk = max(input_bytes + bam_size, 3 * bam_size)
+    job.fileStore.logToMaster('Fused alignment for {} took {:.0f} seconds. Moved {} bytes through the '
+                              'FileStore, compared to an estimated {} bytes for separate jobs. Sampled '
+                              'peak disk was {} bytes, compared to an estimated {} bytes for separate '
+                              'jobs.'.format(config.uuid, time.time() - start, moved, estimated_chain_moved,
+                                             peak_disk, estimated_chain_peak_disk))
+
+    bam_id = job.fileStore.writeGlobalFile(bam_path)
+    bai_id = job.fileStore.writeGlobalFile(bam_path + '.bai')
+    return bam_id, bai_id
 
 
 def gatk_haplotype_caller(job,
@@ -691,7 +1587,8 @@ def gatk_haplotype_caller(job,
                           annotations=None,
                           emit_threshold=10.0, call_threshold=30.0,
                           unsafe_mode=False,
-                          hc_output=None):
+                          hc_output=None,
+                          reference_cache=None):
     """
     Uses GATK HaplotypeCaller to identify SNPs and INDELs. Outputs variants in a Genomic VCF file.
 
@@ -707,20 +1604,27 @@ def gatk_haplotype_caller(job,
     :param float call_threshold: Minimum phred-scale confidence threshold for a variant to be called, default is 30.0
     :param bool unsafe_mode: If True, runs gatk UNSAFE mode: "-U ALLOW_SEQ_DICT_INCOMPATIBILITY"
     :param str hc_output: URL or local path to pre-cooked VCF file, default is None
-    :return: FileStoreID for GVCF file
-    :rtype: str
+    :param ReferenceCache reference_cache: Node-local reference cache configuration, default is None
+    :return: FileStoreIDs for compressed GVCF file and its index
+    :rtype: IndexedVcf
     """
     job.fileStore.logToMaster('Running GATK HaplotypeCaller')
 
-    inputs = {'genome.fa': ref,
-              'genome.fa.fai': fai,
-              'genome.dict': ref_dict,
-              'input.bam': bam,
+    references = {'genome.fa': ref,
+                  'genome.fa.fai': fai,
+                  'genome.dict': ref_dict}
+    inputs = {'input.bam': bam,
               'input.bam.bai': bai}
 
     work_dir = job.fileStore.getLocalTempDir()
+    read_reference_files(job, references, work_dir, cache=reference_cache)
     for name, file_store_id in inputs.iteritems():
         job.fileStore.readGlobalFile(file_store_id, os.path.join(work_dir, name))
+    inputs.update(references)
+
+    # GATK writes a compressed GVCF file and its tabix index. A pre-cooked hc_output file replaces
+    # the uncompressed GVCF file using docker_call mock mode, and is then compressed and indexed.
+    output = 'output.g.vcf' if hc_output else 'output.g.vcf.gz'
 
     # Call GATK -- HaplotypeCaller with parameters to produce a genomic VCF file:
     # https://software.broadinstitute.org/gatk/documentation/article?id=2803
@@ -728,7 +1632,7 @@ def gatk_haplotype_caller(job,
                '-nct', str(job.cores),
                '-R', 'genome.fa',
                '-I', 'input.bam',
-               '-o', 'output.g.vcf',
+               '-o', output,
                '-stand_call_conf', str(call_threshold),
                '-stand_emit_conf', str(emit_threshold),
                '-variant_index_type', 'LINEAR',
@@ -747,17 +1651,268 @@ def gatk_haplotype_caller(job,
         for annotation in annotations:
             command.extend(['-A', annotation])
 
-    # Uses docker_call mock mode to replace output with hc_output file
-    outputs = {'output.g.vcf': hc_output}
     docker_call(job=job,
                 work_dir=work_dir,
                 env={'JAVA_OPTS': '-Djava.io.tmpdir=/data/ -Xmx{}'.format(job.memory)},
                 parameters=command,
                 tool='quay.io/ucsc_cgl/gatk:3.5--dba6dae49156168a909c43330350c6161dc7ecc2',
                 inputs=inputs.keys(),
-                outputs=outputs,
-                mock=True if outputs['output.g.vcf'] else False)
-    return job.fileStore.writeGlobalFile(os.path.join(work_dir, 'output.g.vcf'))
+                outputs={output: hc_output},
+                mock=True if hc_output else False)
+    if hc_output:
+        return write_indexed_vcf(job, os.path.join(work_dir, output))
+    return IndexedVcf(job.fileStore.writeGlobalFile(os.path.join(work_dir, output)),
+                      job.fileStore.writeGlobalFile(os.path.join(work_dir, output + '.tbi')))
+
+
+def sharded_haplotype_caller(job, bam, bai, config):
+    """
+    Calls variants in each genomic shard from shard_intervals_job in parallel using GATK
+    HaplotypeCaller. The shard GVCFs are gathered into a single GVCF in reference order.
+
+    0: Call variants per shard  0 --> 1
+    1: Gather shard GVCFs
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param str bam: FileStoreID for BAM file
+    :param str bai: FileStoreID for BAM index file
+    :param Namespace config: Input parameters and reference FileStoreIDs
+        Requires the following config attributes:
+        config.genome_fasta         FilesStoreID for reference genome fasta file
+        config.genome_fai           FilesStoreID for reference genome fasta index file
+        config.genome_dict          FilesStoreID for reference genome sequence dictionary file
+        config.hc_shard_intervals   Shard BED files from shard_intervals_job
+        config.annotations          List of GATK variant annotations
+        config.cores                Number of cores for each job
+        config.xmx                  Java heap size in bytes
+        config.resource_model       ResourceModel for job requirements or None
+        config.resource_limits      ResourceLimits for scaled job requirements or None
+    :return: FileStoreIDs for GVCF file and its index
+    :rtype: IndexedVcf
+    """
+    shards = config.hc_shard_intervals
+    total_bases = sum(shard.bases for shard in shards)
+
+    # Get total size of genome reference files. This is used for configuring disk size.
+    genome_ref_size = config.genome_fasta.size + config.genome_fai.size + config.genome_dict.size
+
+    shard_gvcfs = []
+    shard_report = []
+    for i, shard in enumerate(shards):
+        # Every shard reads the entire BAM file, but only writes the fraction of the GVCF file that
+        # overlaps the shard. The output GVCF is smaller than the input BAM file.
+        fraction = float(shard.bases) / total_bases
+        shard_disk = int(bam.size + bai.size + genome_ref_size + fraction * bam.size)
+        shard_report.append('Shard %d: %d bp, %d intervals, %d bytes disk' % (i, shard.bases, shard.intervals,
+                                                                              shard_disk))
+
+        shard_gvcfs.append(job.addChild(profiled_job(config.resource_model, haplotype_caller_shard,
+                                                     bam, bai,
+                                                     config.genome_fasta, config.genome_fai, config.genome_dict,
+                                                     shard.bed,
+                                                     annotations=config.annotations,
+                                                     reference_cache=config.reference_cache,
+                                                     disk=shard_disk,
+                                                     **scaled_resources(config, 'haplotype_caller', bam,
+                                                                        fraction=fraction))).rv())
+
+    job.fileStore.logToMaster('Running GATK HaplotypeCaller across {} shards:\n{}'.format(len(shards),
+                                                                                           '\n'.join(shard_report)))
+
+    # The gather disk requirement depends on the shard GVCFs and the gathered GVCF, which is the
+    # same size as the shard GVCFs.
+    gather_disk = PromisedRequirement(lambda results: sum(gvcf.size for gvcf, _ in results) +
+                                      vcf_output_disk(sum(gvcf.size for gvcf, _ in results)), shard_gvcfs)
+    return job.addFollowOn(profiled_job(config.resource_model, gather_gvcfs, shard_gvcfs, disk=gather_disk)).rv()
+
+
+def haplotype_caller_shard(job, bam, bai, ref, fai, ref_dict, intervals, annotations=None, reference_cache=None):
+    """
+    Runs GATK HaplotypeCaller over a single genomic shard and records the runtime.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param str bam: FileStoreID for BAM file
+    :param str bai: FileStoreID for BAM index file
+    :param str ref: FileStoreID for reference genome fasta file
+    :param str fai: FileStoreID for reference fasta index file
+    :param str ref_dict: FileStoreID for reference sequence dictionary file
+    :param str intervals: FileStoreID for BED file containing the shard intervals
+    :param list[str] annotations: List of GATK variant annotations, default is None
+    :param ReferenceCache reference_cache: Node-local reference cache configuration, default is None
+    :return: FileStoreIDs for shard GVCF file and its index and runtime in seconds
+    :rtype: tuple(IndexedVcf, float)
+    """
+    start = time.time()
+    gvcf = gatk_haplotype_caller(job, bam, bai, ref, fai, ref_dict,
+                                 intervals=intervals,
+                                 annotations=annotations,
+                                 reference_cache=reference_cache)
+    return gvcf, time.time() - start
+
+
+def gather_gvcfs(job, shard_gvcfs):
+    """
+    Concatenates shard GVCFs into a single GVCF and reports the speedup from sharding.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param list[tuple] shard_gvcfs: List of (IndexedVcf, runtime) tuples in reference order
+    :return: FileStoreIDs for gathered GVCF file and its index
+    :rtype: IndexedVcf
+    """
+    work_dir = job.fileStore.getLocalTempDir()
+    paths = []
+    for i, (gvcf, _) in enumerate(shard_gvcfs):
+        paths.append(job.fileStore.readGlobalFile(gvcf.vcf, os.path.join(work_dir, 'shard.%d.g.vcf.gz' % i)))
+
+    output = IndexedVcfOutput(job, os.path.join(work_dir, 'output.g.vcf.gz'), sum(gvcf.size for gvcf, _ in shard_gvcfs))
+    with output as f:
+        num_records = concatenate_vcfs(paths, f)
+
+    # Summed runtime approximates the runtime of a single HaplotypeCaller job over the whole genome,
+    # while the longest shard bounds the wall-clock time of the sharded run.
+    runtimes = [runtime for _, runtime in shard_gvcfs]
+    speedup = sum(runtimes) / max(max(runtimes), 1.0)
+    job.fileStore.logToMaster('Gathered {} GVCF records from {} shards\n'
+                              'Summed shard runtime: {:.0f}s\n'
+                              'Longest shard runtime: {:.0f}s\n'
+                              'Estimated wall-clock speedup: {:.1f}x'.format(num_records, len(runtimes),
+                                                                             sum(runtimes), max(runtimes),
+                                                                             speedup))
+    return output.ids
+
+
+def gatk_combine_gvcfs(job,
+                       gvcfs,
+                       ref, fai, ref_dict,
+                       annotations=None,
+                       unsafe_mode=False,
+                       reference_cache=None):
+    """
+    Combines one or more GVCF files into a single multi-sample GVCF file using GATK CombineGVCFs
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param list[IndexedVcf] gvcfs: FileStoreIDs for compressed GVCF files and their indexes
+    :param str ref: FileStoreID for the reference genome fasta file
+    :param str fai: FileStoreID for the reference genome index file
+    :param str ref_dict: FileStoreID for the reference genome sequence dictionary
+    :param list[str] annotations: List of GATK variant annotations, default is None
+    :param bool unsafe_mode: If True, runs gatk UNSAFE mode: "-U ALLOW_SEQ_DICT_INCOMPATIBILITY"
+    :param ReferenceCache reference_cache: Node-local reference cache configuration, default is None
+    :return: FileStoreIDs for the combined GVCF file and its index
+    :rtype: IndexedVcf
+    """
+    references = {'genome.fa': ref,
+                  'genome.fa.fai': fai,
+                  'genome.dict': ref_dict}
+    inputs = {}
+    for i, gvcf_id in enumerate(gvcfs):
+        inputs['input.%d.g.vcf.gz' % i] = gvcf_id.vcf
+        inputs['input.%d.g.vcf.gz.tbi' % i] = gvcf_id.tbi
+
+    work_dir = job.fileStore.getLocalTempDir()
+    read_reference_files(job, references, work_dir, cache=reference_cache)
+    for name, file_store_id in inputs.iteritems():
+        job.fileStore.readGlobalFile(file_store_id, os.path.join(work_dir, name))
+    inputs.update(references)
+
+    command = ['-T', 'CombineGVCFs',
+               '-R', '/data/genome.fa',
+               '-o', '/data/combined.g.vcf.gz']
+
+    if annotations:
+        for annotation in annotations:
+            command.extend(['-A', annotation])
+
+    for i in range(len(gvcfs)):
+        command.extend(['--variant', '/data/input.%d.g.vcf.gz' % i])
+
+    if unsafe_mode:
+        command.extend(['-U', 'ALLOW_SEQ_DICT_INCOMPATIBILITY'])
+
+    docker_call(job=job, work_dir=work_dir,
+                env={'JAVA_OPTS': '-Djava.io.tmpdir=/data/ -Xmx{}'.format(job.memory)},
+                parameters=command,
+                tool='quay.io/ucsc_cgl/gatk:3.5--dba6dae49156168a909c43330350c6161dc7ecc2',
+                inputs=inputs.keys(),
+                outputs={'combined.g.vcf.gz': None, 'combined.g.vcf.gz.tbi': None})
+
+    # GATK writes the tabix index of a compressed output file
+    return IndexedVcf(job.fileStore.writeGlobalFile(os.path.join(work_dir, 'combined.g.vcf.gz')),
+                      job.fileStore.writeGlobalFile(os.path.join(work_dir, 'combined.g.vcf.gz.tbi')))
+
+
+def gatk_genotype_gvcfs(job,
+                        gvcfs,
+                        ref, fai, ref_dict,
+                        intervals=None,
+                        annotations=None,
+                        emit_threshold=10.0, call_threshold=30.0,
+                        unsafe_mode=False,
+                        reference_cache=None):
+    """
+    Runs GenotypeGVCFs on one or more GVCFs. Genotypes the whole genome, or a single shard if
+    intervals are given. Variants are only emitted if they start within the intervals, so genotyped
+    shards do not overlap.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param dict gvcfs: Dictionary of compressed GVCF FileStoreIDs {sample identifier: IndexedVcf}
+    :param str ref: FileStoreID for the reference genome fasta file
+    :param str fai: FileStoreID for the reference genome index file
+    :param str ref_dict: FileStoreID for the reference genome sequence dictionary
+    :param str intervals: FileStoreID for BED file containing the shard intervals, default is None
+    :param list[str] annotations: List of GATK variant annotations, default is None
+    :param float emit_threshold: Minimum phred-scale confidence threshold for a variant to be emitted, default is 10.0
+    :param float call_threshold: Minimum phred-scale confidence threshold for a variant to be called, default is 30.0
+    :param bool unsafe_mode: If True, runs gatk UNSAFE mode: "-U ALLOW_SEQ_DICT_INCOMPATIBILITY"
+    :param ReferenceCache reference_cache: Node-local reference cache configuration, default is None
+    :return: FileStoreIDs for compressed VCF file and its index
+    :rtype: IndexedVcf
+    """
+    references = {'genome.fa': ref,
+                  'genome.fa.fai': fai,
+                  'genome.dict': ref_dict}
+    inputs = {}
+    if intervals:
+        inputs['intervals.bed'] = intervals
+    for uuid, gvcf_id in gvcfs.iteritems():
+        inputs['%s.g.vcf.gz' % uuid] = gvcf_id.vcf
+        inputs['%s.g.vcf.gz.tbi' % uuid] = gvcf_id.tbi
+
+    work_dir = job.fileStore.getLocalTempDir()
+    read_reference_files(job, references, work_dir, cache=reference_cache)
+    for name, file_store_id in inputs.iteritems():
+        job.fileStore.readGlobalFile(file_store_id, os.path.join(work_dir, name))
+    inputs.update(references)
+
+    command = ['-T', 'GenotypeGVCFs',
+               '-R', '/data/genome.fa',
+               '--out', 'genotyped.vcf.gz',
+               '-stand_emit_conf', str(emit_threshold),
+               '-stand_call_conf', str(call_threshold)]
+
+    if intervals:
+        command.extend(['-L', '/data/intervals.bed'])
+
+    if annotations:
+        for annotation in annotations:
+            command.extend(['-A', annotation])
+
+    for uuid in gvcfs.keys():
+        command.extend(['--variant', '/data/%s.g.vcf.gz' % uuid])
+
+    if unsafe_mode:
+        command.extend(['-U', 'ALLOW_SEQ_DICT_INCOMPATIBILITY'])
+
+    docker_call(job=job, work_dir=work_dir,
+                env={'JAVA_OPTS': '-Djava.io.tmpdir=/data/ -Xmx{}'.format(job.memory)},
+                parameters=command,
+                tool='quay.io/ucsc_cgl/gatk:3.5--dba6dae49156168a909c43330350c6161dc7ecc2',
+                inputs=inputs.keys(),
+                outputs={'genotyped.vcf.gz': None, 'genotyped.vcf.gz.tbi': None})
+
+    # GATK writes the tabix index of a compressed output file
+    return IndexedVcf(job.fileStore.writeGlobalFile(os.path.join(work_dir, 'genotyped.vcf.gz')),
+                      job.fileStore.writeGlobalFile(os.path.join(work_dir, 'genotyped.vcf.gz.tbi')))
 
 
 def main():
@@ -776,6 +1931,17 @@ def main():
     subparsers.add_parser('generate',
                           help='Generates a config and manifest in the current working directory.')
 
+    # Filter stats subparser
+    parser_stats = subparsers.add_parser('filter-stats',
+                                         help='Counts the variants removed by hard filter expressions '
+                                              'without running the pipeline.')
+    parser_stats.add_argument('--vcf', required=True,
+                              help='Path to genotyped VCF file, which may be bgzip compressed')
+    parser_stats.add_argument('--snp-filter-expression', default=[], action='append',
+                              help='SNP JEXL filter expression. Can be given more than once.')
+    parser_stats.add_argument('--indel-filter-expression', default=[], action='append',
+                              help='INDEL JEXL filter expression. Can be given more than once.')
+
     # Run subparser
     parser_run = subparsers.add_parser('run', help='Runs the GATK germline pipeline')
     parser_run.add_argument('--config',
@@ -810,6 +1976,15 @@ def main():
         generate_file(os.path.join(cwd, 'config-toil-germline.yaml'), generate_config)
     if options.command == 'generate-manifest' or options.command == 'generate':
         generate_file(os.path.join(cwd, 'manifest-toil-germline.tsv'), generate_manifest)
+    elif options.command == 'filter-stats':
+        expressions = [('SNP', x) for x in options.snp_filter_expression] + \
+                      [('INDEL', x) for x in options.indel_filter_expression]
+        require(expressions, 'No filter expressions were provided')
+        with open_vcf(options.vcf) as f:
+            stats = filter_stats(f, expressions)
+        for (variant_type, expression), (num_records, num_filtered) in zip(expressions, stats):
+            print('{}\t{}\t{}/{} filtered ({:.2%})'.format(variant_type, expression, num_filtered, num_records,
+                                                          float(num_filtered) / num_records if num_records else 0))
     elif options.command == 'run':
         # Program checks
         for program in ['curl', 'docker']:
@@ -893,10 +2068,102 @@ def main():
         inputs['file_size'] = human2bytes(inputs['file_size'])
         inputs['cores'] = int(inputs['cores'])
 
+        # Number of genomic shards for HaplotypeCaller
+        inputs['hc_shards'] = int(inputs.get('hc_shards') or 1)
+        require(inputs['hc_shards'] > 0, 'hc-shards must be a positive integer')
+
+        # Number of genomic shards for GenotypeGVCFs
+        inputs['genotype_shards'] = int(inputs.get('genotype_shards') or 1)
+        require(inputs['genotype_shards'] > 0, 'genotype-shards must be a positive integer')
+
+        # Batch size and fan-out for hierarchically combining GVCFs before joint genotyping
+        inputs['combine_batch_size'] = int(inputs.get('combine_batch_size') or 0)
+        require(inputs['combine_batch_size'] == 0 or inputs['combine_batch_size'] > 1,
+                'combine-batch-size must be greater than 1')
+        inputs['combine_fan_out'] = int(inputs.get('combine_fan_out') or inputs['combine_batch_size'])
+        require(not inputs['combine_batch_size'] or inputs['combine_fan_out'] > 1,
+                'combine-fan-out must be greater than 1')
+
+        # Number of VCF records annotated per Oncotator job
+        inputs['oncotator_chunk_size'] = int(inputs.get('oncotator_chunk_size') or 50000)
+        require(inputs['oncotator_chunk_size'] > 0, 'oncotator-chunk-size must be a positive integer')
+
+        # Cache of Oncotator annotations shared across samples and runs. The cached annotations are
+        # versioned by the Oncotator database URL and fingerprint.
+        if inputs.get('annotation_cache') and inputs.get('run_oncotator'):
+            require(inputs.get('oncotator_db'), 'Missing oncotator-db for annotation-cache')
+            require(urlparse(inputs['annotation_cache']).scheme in ('', 'file'),
+                    'annotation-cache must be a local or shared filesystem path')
+            inputs['annotation_cache'] = AnnotationCache(os.path.abspath(urlparse(inputs['annotation_cache']).path),
+                                                         database_version(inputs['oncotator_db'],
+                                                                          s3_key_path=inputs.get('ssec')))
+        else:
+            inputs['annotation_cache'] = None
+
+        # History of profiled job resource usage used to predict job requirements
+        if inputs.get('resource_history'):
+            require(urlparse(inputs['resource_history']).scheme in ('', 'file'),
+                    'resource-history must be a local or shared filesystem path')
+            inputs['resource_margin'] = float(inputs.get('resource_margin') or 1.25)
+            require(inputs['resource_margin'] >= 1, 'resource-margin must be at least 1')
+            inputs['resource_model'] = load_resource_model(os.path.abspath(urlparse(inputs['resource_history']).path),
+                                                           inputs['resource_margin'])
+        else:
+            inputs['resource_model'] = None
+
+        # Scale the cores and memory of each job with its input size and number of samples
+        if inputs.get('scale_resources'):
+            inputs['resource_limits'] = ResourceLimits(
+                min_cores=int(inputs.get('min_cores') or 1),
+                max_cores=int(inputs.get('max_cores') or inputs['cores']),
+                min_memory=human2bytes(str(inputs.get('min_xmx') or '2G')),
+                max_memory=human2bytes(str(inputs['max_xmx'])) if inputs.get('max_xmx') else inputs['xmx'])
+            require(0 < inputs['resource_limits'].min_cores <= inputs['resource_limits'].max_cores,
+                    'min-cores must be a positive integer less than or equal to max-cores')
+            require(0 < inputs['resource_limits'].min_memory <= inputs['resource_limits'].max_memory,
+                    'min-xmx must be less than or equal to max-xmx')
+        else:
+            inputs['resource_limits'] = None
+
+        # Directory for caching reference files across runs
+        inputs['bundle_cache_dir'] = inputs.get('bundle_cache_dir') or None
+        if inputs['bundle_cache_dir'] and urlparse(inputs['bundle_cache_dir']).scheme in ('', 'file'):
+            inputs['bundle_cache_dir'] = os.path.abspath(urlparse(inputs['bundle_cache_dir']).path)
+        require(inputs['bundle_cache_dir'] is None or urlparse(inputs['bundle_cache_dir']).scheme == '',
+                'bundle-cache-dir must be a local or shared filesystem path')
+
+        # Node-local reference cache shared by jobs on the same worker
+        if inputs.get('reference_cache_dir'):
+            inputs['reference_cache'] = ReferenceCache(os.path.abspath(inputs['reference_cache_dir']),
+                                                       human2bytes(str(inputs.get('reference_cache_size') or '50G')))
+        else:
+            inputs['reference_cache'] = None
+
+        # Align, sort, and index FASTQ samples in a single job
+        inputs['fused_alignment'] = bool(inputs.get('fused_alignment'))
+
+        # Apply SNP and INDEL recalibration concurrently
+        inputs['concurrent_apply_recal'] = bool(inputs.get('concurrent_apply_recal'))
+
+        # Skip samples whose outputs were written by a previous run
+        inputs['resume'] = bool(inputs.get('resume'))
+
+        # Hard filter in a single pass instead of with the GATK hard filtering jobs
+        inputs['streaming_hard_filter'] = bool(inputs.get('streaming_hard_filter'))
+
         inputs['annotations'] = set(inputs['snp_filter_annotations'] + inputs['indel_filter_annotations'])
 
+        # Persistent store of per-sample GVCFs. The GVCF options must be fingerprinted before the
+        # reference URLs are replaced with FileStoreIDs.
+        inputs['gvcf_store'] = inputs.get('gvcf_store') or None
+        if inputs['gvcf_store'] and urlparse(inputs['gvcf_store']).scheme in ('', 'file'):
+            inputs['gvcf_store'] = os.path.abspath(urlparse(inputs['gvcf_store']).path)
+        require(inputs['gvcf_store'] is None or urlparse(inputs['gvcf_store']).scheme in ('', 's3'),
+                'gvcf-store must be a local or shared filesystem path or an S3 URL')
+
         # HaplotypeCaller test data for testing
         inputs['hc_output'] = inputs.get('hc_output', None)
+        inputs['gvcf_options'] = gvcf_options(inputs)
 
         # It is a toil-scripts convention to store input parameters in a Namespace object
         config = argparse.Namespace(**inputs)
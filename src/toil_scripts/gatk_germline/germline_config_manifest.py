@@ -28,7 +28,28 @@ def generate_config():
         # Genomic intervals to restrict analysis
         intervals:
 
-        # Required: Input BAM file is sorted (Default: False)
+        # Optional: Number of genomic shards used to parallelize HaplotypeCaller per sample (Default: 1)
+        hc-shards:
+
+        # Optional: Number of genomic shards used to parallelize GenotypeGVCFs (Default: 1)
+        genotype-shards:
+
+        # Optional: Node-local directory used to cache reference files shared by jobs on the same worker (Default: None)
+        reference-cache-dir:
+
+        # Optional: Size limit for the reference cache (human readable bytes format) (Default: 50G)
+        reference-cache-size:
+
+        # Optional: Directory used to cache downloaded reference files across runs (Default: None)
+        bundle-cache-dir:
+
+        # Optional: Local path or S3 URL of a persistent store for per-sample GVCFs, which are reused by later runs (Default: None)
+        gvcf-store:
+
+        # Optional: Skip samples whose outputs exist in the output directory and reuse their GVCFs (Default: False)
+        resume:
+
+        # Required: Input BAM file is sorted. If False, the BAM header is checked for coordinate sort order (Default: False)
         sorted:
 
         # Required: URL or local path to reference genome FASTA file
@@ -64,6 +85,9 @@ def generate_config():
         # Optional. Trim adapters (Default: False)
         trim:
 
+        # Optional: Align, sort, and index the BAM file in a single job (Default: False)
+        fused-alignment:
+
         # Required for BWA alignment: URL or local path to BWA index file prefix.amb (Default: None)
         amb:
 
@@ -106,18 +130,57 @@ def generate_config():
         # Required for hard filtering: INDEL JEXL filter expression
         indel_filter_expression:
 
+        # Optional: Hard filter in a single pass instead of with GATK (Default: False)
+        streaming-hard-filter:
+
         # Optional: Run GATK VQSR (Default: False)
         run-vqsr:
 
+        # Optional: Apply SNP and INDEL recalibration concurrently (Default: False)
+        concurrent-apply-recal:
+
         # Optional: Merges all samples into a single GVCF for genotyping and filtering (Default: False)
         joint-genotype:
 
+        # Optional: Maximum number of GVCFs combined per job before joint genotyping (Default: None)
+        combine-batch-size:
+
+        # Optional: Maximum number of intermediate GVCFs combined per job (Default: combine-batch-size)
+        combine-fan-out:
+
         # Optional: Run Oncotator (Default: False)
         run-oncotator:
 
         # Required for Oncotator: URL or local path to Oncotator database (Default: None)
         oncotator-db:
 
+        # Optional: Number of VCF records annotated per Oncotator job (Default: 50000)
+        oncotator-chunk-size:
+
+        # Optional: Local or shared filesystem path to an SQLite cache of Oncotator annotations (Default: None)
+        annotation-cache:
+
+        # Optional: Local or shared filesystem path to a history of job resource usage used to predict job requirements (Default: None)
+        resource-history:
+
+        # Optional: Multiplier applied to predicted job requirements (Default: 1.25)
+        resource-margin:
+
+        # Optional: Scale the cores and Java heap size of each job with its input size and number of samples (Default: False)
+        scale-resources:
+
+        # Optional: Minimum number of cores for scaled jobs (Default: 1)
+        min-cores:
+
+        # Optional: Maximum number of cores for scaled jobs (Default: cores)
+        max-cores:
+
+        # Optional: Minimum Java heap size for scaled jobs (human readable bytes format) (Default: 2G)
+        min-xmx:
+
+        # Optional: Maximum Java heap size for scaled jobs (human readable bytes format) (Default: xmx)
+        max-xmx:
+
         # Optional: Suffix added to output filename (i.e. .toil)
         suffix:
 
@@ -0,0 +1,116 @@
+#!/usr/bin/env python2.7
+"""
+Persistent store of per-sample GVCF files, so that adding samples to a cohort only calls variants
+for the new samples before the cohort is genotyped again.
+
+GVCFs are stored under <store>/<uuid>/<fingerprint>/, where the fingerprint is computed from the
+sample inputs and the pipeline options that change the GVCF, such as the reference genome,
+intervals, and annotations. The store can be a local or shared filesystem directory or an S3
+prefix. A GVCF is only reused once its tabix index is stored, because the index is written after
+the GVCF.
+"""
+from collections import namedtuple
+import hashlib
+import json
+import os
+from urlparse import urlparse
+
+from toil_lib.urls import download_url
+
+from toil_scripts.gatk_germline.bundle_cache import url_fingerprint
+from toil_scripts.gatk_germline.common import list_files
+from toil_scripts.gatk_germline.vcf import IndexedVcf
+
+# Pipeline options that change the GVCF produced for a sample
+GVCF_OPTIONS = ['genome_fasta', 'genome_fai', 'genome_dict', 'intervals', 'run_bwa', 'trim', 'amb', 'ann',
+                'bwt', 'pac', 'sa', 'alt', 'preprocess', 'g1k_indel', 'mills', 'dbsnp', 'annotations',
+                'unsafe_mode', 'hc_output', 'hc_shards']
+
+StoredGvcf = namedtuple('StoredGvcf', 'vcf_url tbi_url size')
+
+
+def gvcf_options(inputs):
+    """
+    Returns the pipeline options that change the GVCF. Must be called before reference URLs are
+    replaced with FileStoreIDs.
+
+    :param dict inputs: Pipeline configuration options
+    :return: JSON encoded options
+    :rtype: str
+    """
+    options = {}
+    for name in GVCF_OPTIONS:
+        value = inputs.get(name)
+        if isinstance(value, (set, frozenset)):
+            value = sorted(value)
+        options[name] = value
+    return json.dumps(options, sort_keys=True)
+
+
+def sample_fingerprint(sample, options, s3_key_path=None):
+    """
+    Returns a fingerprint of the sample inputs and pipeline options. Remote inputs are also
+    fingerprinted by their ETag, size, or modification time when available.
+
+    :param GermlineSample sample: Sample to fingerprint
+    :param str options: JSON encoded options from gvcf_options
+    :param str s3_key_path: Path to SSE-C key file
+    :return: Fingerprint
+    :rtype: str
+    """
+    fields = [options, sample.url, sample.paired_url or '', sample.rg_line or '']
+    for url in filter(None, [sample.url, sample.paired_url]):
+        fields.append(url_fingerprint(url, s3_key_path=s3_key_path) or '')
+    return hashlib.sha256('\n'.join(fields)).hexdigest()[:32]
+
+
+def gvcf_store_dir(store, uuid, fingerprint):
+    """
+    :param str store: Local path or S3 URL of the GVCF store
+    :param str uuid: Unique sample identifier
+    :param str fingerprint: Fingerprint from sample_fingerprint
+    :return: Directory for the stored GVCF
+    :rtype: str
+    """
+    return os.path.join(store, uuid, fingerprint)
+
+
+def find_stored_gvcf(store, uuid, fingerprint):
+    """
+    Returns the location of a stored GVCF file and its index
+
+    :param str store: Local path or S3 URL of the GVCF store
+    :param str uuid: Unique sample identifier
+    :param str fingerprint: Fingerprint from sample_fingerprint
+    :return: Stored GVCF or None if the sample is not in the store
+    :rtype: StoredGvcf|None
+    """
+    name = '%s.g.vcf.gz' % uuid
+    store_dir = gvcf_store_dir(store, uuid, fingerprint)
+    sizes = list_files(store_dir)
+    if name in sizes and name + '.tbi' in sizes:
+        return StoredGvcf(os.path.join(store_dir, name), os.path.join(store_dir, name + '.tbi'),
+                          sizes[name] + sizes[name + '.tbi'])
+    return None
+
+
+def import_stored_gvcf_job(job, stored_gvcf, s3_key_path=None):
+    """
+    Imports a stored GVCF file and its index into the FileStore
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param StoredGvcf stored_gvcf: Location of the stored GVCF
+    :param str s3_key_path: Path to SSE-C key file
+    :return: FileStoreIDs for the GVCF file and its index
+    :rtype: IndexedVcf
+    """
+    job.fileStore.logToMaster('Reusing stored GVCF {}'.format(stored_gvcf.vcf_url))
+    work_dir = job.fileStore.getLocalTempDir()
+    file_ids = []
+    for url in (stored_gvcf.vcf_url, stored_gvcf.tbi_url):
+        if urlparse(url).scheme == 's3':
+            path = download_url(job=job, url=url, work_dir=work_dir, s3_key_path=s3_key_path)
+        else:
+            path = urlparse(url).path
+        file_ids.append(job.fileStore.writeGlobalFile(path))
+    return IndexedVcf(*file_ids)
@@ -1,28 +1,129 @@
 #!/usr/bin/env python2.7
+from collections import OrderedDict
 import os
+import re
+import time
 
 from toil.job import PromisedRequirement
-from toil_lib.tools.variant_manipulation import gatk_select_variants, \
-    gatk_variant_filtration, gatk_combine_variants
 
-from toil_scripts.gatk_germline.common import output_file_job
+from toil_scripts.gatk_germline.common import compress_vcf_job, decompress_vcf_job, gatk_call, IndexedVcfOutput, \
+    OUTPUT_DISK, output_vcf_job, vcf_output_disk
+from toil_scripts.gatk_germline.resources import profiled_job, scaled_resources
+from toil_scripts.gatk_germline.vcf import COMPRESSION_RATIO, hard_filter_vcf, open_vcf
+
+# Names that GATK CombineVariants gives the SNP and INDEL VCFs in gatk_hard_filter_pipeline.
+# gatk_combine_variants passes the VCFs as unnamed --variant arguments in order, which GATK names
+# variant, variant2, and so on, so the SNP VCF is passed first.
+COMBINE_SOURCES = OrderedDict([('SNP', 'variant'), ('INDEL', 'variant2')])
 
 
 def hard_filter_pipeline(job, uuid, vcf_id, config):
+    """
+    Runs Hard Filtering on a VCF file and uploads the results. By default, this runs the GATK
+    SelectVariants, VariantFiltration, and CombineVariants jobs. If config.streaming_hard_filter is
+    set, then SNPs and INDELs are selected and filtered in a single pass over the VCF file.
+
+    0: Start                0 --> 1 --> 2
+    1: Select and filter SNPs and INDELs
+    2: Write filtered VCF to output directory
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param str uuid: Unique sample identifier
+    :param IndexedVcf vcf_id: Compressed VCF FileStoreIDs
+    :param Namespace config: Pipeline configuration options and shared files
+        Requires the following config attributes:
+        config.snp_filter_name          Name of SNP filter for VCF header
+        config.snp_filter_expression    SNP JEXL filter expression
+        config.indel_filter_name        Name of INDEL filter for VCF header
+        config.indel_filter_expression  INDEL JEXL filter expression
+        config.suffix                   Suffix added to output filename
+        config.output_dir               URL or local path to output directory
+        config.ssec                     Path to key file for SSE-C encryption
+        config.streaming_hard_filter    If True, then filter in a single pass instead of with GATK
+        config.resource_model           ResourceModel for job requirements or None
+        Additional attributes are required by gatk_hard_filter_pipeline.
+    :return: Filtered VCF FileStoreIDs
+    :rtype: IndexedVcf
+    """
+    if not config.streaming_hard_filter:
+        return gatk_hard_filter_pipeline(job, uuid, vcf_id, config)
+
+    job.fileStore.logToMaster('Running Hard Filter on {}'.format(uuid))
+
+    # The hard filter disk requirement depends on the compressed input VCF and the filtered VCF,
+    # which is approximately the same size as the input VCF once it is compressed.
+    filter_vcf = profiled_job(config.resource_model, hard_filter_job,
+                              vcf_id,
+                              config,
+                              disk=PromisedRequirement(lambda vcf: vcf.size + vcf_output_disk(vcf.size), vcf_id))
+    job.addChild(filter_vcf)
+
+    # Output the hard filtered VCF
+    output_dir = os.path.join(config.output_dir, uuid)
+    output_filename = '%s.hard_filter%s.vcf.gz' % (uuid, config.suffix)
+    output_vcf = job.wrapJobFn(output_vcf_job,
+                               output_filename,
+                               filter_vcf.rv(),
+                               output_dir,
+                               s3_key_path=config.ssec,
+                               disk=OUTPUT_DISK)
+    filter_vcf.addChild(output_vcf)
+    return filter_vcf.rv()
+
+
+def hard_filter_job(job, vcf_id, config):
+    """
+    Selects SNPs and INDELs and applies the SNP and INDEL filter expressions in a single pass over
+    a VCF file. Records of other variant types are dropped. Records are annotated with the
+    CombineVariants set field of gatk_hard_filter_pipeline, but GATK header lines are not written.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param IndexedVcf vcf_id: Compressed VCF FileStoreIDs
+    :param Namespace config: Pipeline configuration options and shared files
+        Requires the following config attributes:
+        config.snp_filter_name          Name of SNP filter for VCF header
+        config.snp_filter_expression    SNP JEXL filter expression
+        config.indel_filter_name        Name of INDEL filter for VCF header
+        config.indel_filter_expression  INDEL JEXL filter expression
+    :return: Filtered VCF FileStoreIDs
+    :rtype: IndexedVcf
+    """
+    start = time.time()
+    work_dir = job.fileStore.getLocalTempDir()
+    input_path = job.fileStore.readGlobalFile(vcf_id.vcf, os.path.join(work_dir, 'input.vcf.gz'))
+
+    filters = {'SNP': (config.snp_filter_name, config.snp_filter_expression),
+               'INDEL': (config.indel_filter_name, config.indel_filter_expression)}
+    output = IndexedVcfOutput(job, os.path.join(work_dir, 'filtered_variants.vcf.gz'), vcf_id.vcf.size)
+    with open_vcf(input_path) as f, output as g:
+        counts = hard_filter_vcf(f, g, filters, sources=COMBINE_SOURCES)
+
+    job.fileStore.logToMaster('Hard filtered {SNP} SNPs ({SNP_filtered} failed {snp}) and {INDEL} INDELs '
+                              '({INDEL_filtered} failed {indel}). Dropped {dropped} records of other '
+                              'variant types.'.format(snp=config.snp_filter_name,
+                                                      indel=config.indel_filter_name,
+                                                      **counts))
+    job.fileStore.logToMaster('Hard filter read {} bytes and wrote {} bytes in {:.1f} seconds'.format(
+        os.path.getsize(input_path), output.ids.vcf.size, time.time() - start))
+    return output.ids
+
+
+def gatk_hard_filter_pipeline(job, uuid, vcf_id, config):
     """
     Runs GATK Hard Filtering on a Genomic VCF file and uploads the results.
 
-    0: Start                0 --> 1 --> 3 --> 5 --> 6
+    0: Decompress VCF       0 --> 1 --> 3 --> 5 --> 6 --> 7
     1: Select SNPs                |           |
     2: Select INDELs              +-> 2 --> 4 +
     3: Apply SNP Filter
     4: Apply INDEL Filter
     5: Merge SNP and INDEL VCFs
-    6: Write filtered VCF to output directory
+    6: Compress and index VCF
+    7: Write filtered VCF to output directory
 
     :param JobFunctionWrappingJob job: passed automatically by Toil
     :param str uuid: Unique sample identifier
-    :param str vcf_id: VCF FileStoreID
+    :param IndexedVcf vcf_id: Compressed VCF FileStoreIDs
     :param Namespace config: Pipeline configuration options and shared files
         Requires the following config attributes:
         config.genome_fasta             FilesStoreID for reference genome fasta file
@@ -36,28 +137,39 @@ def hard_filter_pipeline(job, uuid, vcf_id, config):
         config.suffix                   Suffix added to output filename
         config.output_dir               URL or local path to output directory
         config.ssec                     Path to key file for SSE-C encryption
-    :return: SNP and INDEL FileStoreIDs
-    :rtype: tuple
+        config.resource_model           ResourceModel for job requirements or None
+        config.resource_limits          ResourceLimits for scaled job requirements or None
+        config.reference_cache          ReferenceCache for the node-local reference cache or None
+    :return: Filtered VCF FileStoreIDs
+    :rtype: IndexedVcf
     """
     job.fileStore.logToMaster('Running Hard Filter on {}'.format(uuid))
 
     # Get the total size of the genome reference
     genome_ref_size = config.genome_fasta.size + config.genome_fai.size + config.genome_dict.size
 
+    # GATK SelectVariants reads uncompressed VCF files
+    decompress = profiled_job(config.resource_model, decompress_vcf_job,
+                              vcf_id,
+                              disk=PromisedRequirement(lambda vcf: (COMPRESSION_RATIO + 1) * vcf.size, vcf_id))
+    job.addChild(decompress)
+    vcf_id = decompress.rv()
+
     # The SelectVariants disk requirement depends on the input VCF, the genome reference files,
     # and the output VCF. The output VCF is smaller than the input VCF. The disk requirement
     # is identical for SNPs and INDELs.
     select_variants_disk = PromisedRequirement(lambda vcf, ref_size: 2 * vcf.size + ref_size,
                                                vcf_id,
                                                genome_ref_size)
-    select_snps = job.wrapJobFn(gatk_select_variants,
-                                'SNP',
-                                vcf_id,
-                                config.genome_fasta,
-                                config.genome_fai,
-                                config.genome_dict,
-                                memory=config.xmx,
-                                disk=select_variants_disk)
+    select_snps = profiled_job(config.resource_model, gatk_select_variants,
+                               'SNP',
+                               vcf_id,
+                               config.genome_fasta,
+                               config.genome_fai,
+                               config.genome_dict,
+                               reference_cache=config.reference_cache,
+                               disk=select_variants_disk,
+                               **scaled_resources(config, 'hard_filter', vcf_id))
 
     # The VariantFiltration disk requirement depends on the input VCF, the genome reference files,
     # and the output VCF. The filtered VCF is smaller than the input VCF.
@@ -65,38 +177,41 @@ def hard_filter_pipeline(job, uuid, vcf_id, config):
                                           select_snps.rv(),
                                           genome_ref_size)
 
-    snp_filter = job.wrapJobFn(gatk_variant_filtration,
-                               select_snps.rv(),
-                               config.snp_filter_name,
-                               config.snp_filter_expression,
-                               config.genome_fasta,
-                               config.genome_fai,
-                               config.genome_dict,
-                               memory=config.xmx,
-                               disk=snp_filter_disk)
-
-    select_indels = job.wrapJobFn(gatk_select_variants,
-                                  'INDEL',
-                                  vcf_id,
-                                  config.genome_fasta,
-                                  config.genome_fai,
-                                  config.genome_dict,
-                                  memory=config.xmx,
-                                  disk=select_variants_disk)
+    snp_filter = profiled_job(config.resource_model, gatk_variant_filtration,
+                              select_snps.rv(),
+                              config.snp_filter_name,
+                              config.snp_filter_expression,
+                              config.genome_fasta,
+                              config.genome_fai,
+                              config.genome_dict,
+                              reference_cache=config.reference_cache,
+                              disk=snp_filter_disk,
+                              **scaled_resources(config, 'hard_filter', select_snps.rv()))
+
+    select_indels = profiled_job(config.resource_model, gatk_select_variants,
+                                 'INDEL',
+                                 vcf_id,
+                                 config.genome_fasta,
+                                 config.genome_fai,
+                                 config.genome_dict,
+                                 reference_cache=config.reference_cache,
+                                 disk=select_variants_disk,
+                                 **scaled_resources(config, 'hard_filter', vcf_id))
 
     indel_filter_disk = PromisedRequirement(lambda vcf, ref_size: 2 * vcf.size + ref_size,
                                             select_indels.rv(),
                                             genome_ref_size)
 
-    indel_filter = job.wrapJobFn(gatk_variant_filtration,
-                                 select_indels.rv(),
-                                 config.indel_filter_name,
-                                 config.indel_filter_expression,
-                                 config.genome_fasta,
-                                 config.genome_fai,
-                                 config.genome_dict,
-                                 memory=config.xmx,
-                                 disk=indel_filter_disk)
+    indel_filter = profiled_job(config.resource_model, gatk_variant_filtration,
+                                select_indels.rv(),
+                                config.indel_filter_name,
+                                config.indel_filter_expression,
+                                config.genome_fasta,
+                                config.genome_fai,
+                                config.genome_dict,
+                                reference_cache=config.reference_cache,
+                                disk=indel_filter_disk,
+                                **scaled_resources(config, 'hard_filter', select_indels.rv()))
 
     # The CombineVariants disk requirement depends on the SNP and INDEL input VCFs and the
     # genome reference files. The combined VCF is approximately the same size as the input files.
@@ -106,17 +221,18 @@ def hard_filter_pipeline(job, uuid, vcf_id, config):
                                             snp_filter.rv(),
                                             genome_ref_size)
 
-    combine_vcfs = job.wrapJobFn(gatk_combine_variants,
-                                 {'SNPs': snp_filter.rv(), 'INDELs': indel_filter.rv()},
-                                 config.genome_fasta,
-                                 config.genome_fai,
-                                 config.genome_dict,
-                                 merge_option='UNSORTED',  # Merges variants from a single sample
-                                 memory=config.xmx,
-                                 disk=combine_vcfs_disk)
+    combine_vcfs = profiled_job(config.resource_model, gatk_combine_variants,
+                                OrderedDict([('SNPs', snp_filter.rv()), ('INDELs', indel_filter.rv())]),
+                                config.genome_fasta,
+                                config.genome_fai,
+                                config.genome_dict,
+                                merge_option='UNSORTED',  # Merges variants from a single sample
+                                reference_cache=config.reference_cache,
+                                disk=combine_vcfs_disk,
+                                **scaled_resources(config, 'hard_filter', [snp_filter.rv(), indel_filter.rv()]))
 
-    job.addChild(select_snps)
-    job.addChild(select_indels)
+    decompress.addChild(select_snps)
+    decompress.addChild(select_indels)
 
     select_snps.addChild(snp_filter)
     snp_filter.addChild(combine_vcfs)
@@ -124,14 +240,129 @@ def hard_filter_pipeline(job, uuid, vcf_id, config):
     select_indels.addChild(indel_filter)
     indel_filter.addChild(combine_vcfs)
 
+    compress = profiled_job(config.resource_model, compress_vcf_job,
+                            combine_vcfs.rv(),
+                            disk=PromisedRequirement(lambda x: 2 * x.size, combine_vcfs.rv()))
+    combine_vcfs.addChild(compress)
+
     # Output the hard filtered VCF
     output_dir = os.path.join(config.output_dir, uuid)
-    output_filename = '%s.hard_filter%s.vcf' % (uuid, config.suffix)
-    output_vcf = job.wrapJobFn(output_file_job,
+    output_filename = '%s.hard_filter%s.vcf.gz' % (uuid, config.suffix)
+    output_vcf = job.wrapJobFn(output_vcf_job,
                                output_filename,
-                               combine_vcfs.rv(),
+                               compress.rv(),
                                output_dir,
                                s3_key_path=config.ssec,
-                               disk=PromisedRequirement(lambda x: x.size, combine_vcfs.rv()))
-    combine_vcfs.addChild(output_vcf)
-    return combine_vcfs.rv()
+                               disk=OUTPUT_DISK)
+    compress.addChild(output_vcf)
+    return compress.rv()
+
+
+def gatk_select_variants(job, mode, vcf_id, ref_fasta, ref_fai, ref_dict, reference_cache=None):
+    """
+    Isolates a particular variant type from a VCF file using GATK SelectVariants
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param str mode: variant type (i.e. SNP or INDEL)
+    :param str vcf_id: FileStoreID for input VCF file
+    :param str ref_fasta: FileStoreID for reference genome fasta
+    :param str ref_fai: FileStoreID for reference genome index file
+    :param str ref_dict: FileStoreID for reference genome sequence dictionary file
+    :param ReferenceCache reference_cache: Node-local reference cache configuration, default is None
+    :return: FileStoreID for filtered VCF
+    :rtype: str
+    """
+    job.fileStore.logToMaster('Running GATK SelectVariants to select %ss' % mode)
+
+    command = ['-T', 'SelectVariants',
+               '-R', 'genome.fa',
+               '-V', 'input.vcf',
+               '-o', 'output.vcf',
+               '-selectType', mode]
+
+    work_dir = gatk_call(job, command, ref_fasta, ref_fai, ref_dict,
+                         inputs={'input.vcf': vcf_id},
+                         outputs=['output.vcf'],
+                         reference_cache=reference_cache)
+
+    return job.fileStore.writeGlobalFile(os.path.join(work_dir, 'output.vcf'))
+
+
+def gatk_variant_filtration(job, vcf_id, filter_name, filter_expression, ref_fasta, ref_fai, ref_dict,
+                            reference_cache=None):
+    """
+    Filters VCF file using GATK VariantFiltration. Fixes extra pair of quotation marks in VCF header that
+    may interfere with other VCF tools.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param str vcf_id: FileStoreID for input VCF file
+    :param str filter_name: Name of filter for VCF header
+    :param str filter_expression: JEXL filter expression
+    :param str ref_fasta: FileStoreID for reference genome fasta
+    :param str ref_fai: FileStoreID for reference genome index file
+    :param str ref_dict: FileStoreID for reference genome sequence dictionary file
+    :param ReferenceCache reference_cache: Node-local reference cache configuration, default is None
+    :return: FileStoreID for filtered VCF file
+    :rtype: str
+    """
+    command = ['-T', 'VariantFiltration',
+               '-R', 'genome.fa',
+               '-V', 'input.vcf',
+               '--filterName', filter_name,   # Documents filter name in header
+               '--filterExpression', filter_expression,
+               '-o', 'filtered_variants.vcf']
+
+    job.fileStore.logToMaster('Running GATK VariantFiltration using {name}: '
+                              '{expression}'.format(name=filter_name, expression=filter_expression))
+
+    work_dir = gatk_call(job, command, ref_fasta, ref_fai, ref_dict,
+                         inputs={'input.vcf': vcf_id},
+                         outputs=['filtered_variants.vcf'],
+                         reference_cache=reference_cache)
+
+    # Remove extra quotation marks around filter expression.
+    malformed_header = os.path.join(work_dir, 'filtered_variants.vcf')
+    fixed_header = os.path.join(work_dir, 'fixed_header.vcf')
+    filter_regex = re.escape('"%s"' % filter_expression)
+    with open(malformed_header, 'r') as f, open(fixed_header, 'w') as g:
+        for line in f:
+            g.write(re.sub(filter_regex, filter_expression, line))
+
+    return job.fileStore.writeGlobalFile(fixed_header)
+
+
+def gatk_combine_variants(job, vcfs, ref_fasta, ref_fai, ref_dict, merge_option='UNIQUIFY', reference_cache=None):
+    """
+    Merges VCF files using GATK CombineVariants
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param dict vcfs: Dictionary of VCF FileStoreIDs {sample identifier: FileStoreID}. The VCFs are
+                      passed to GATK in iteration order, which sets their names and priority, so pass
+                      an OrderedDict if the order matters.
+    :param str ref_fasta: FileStoreID for reference genome fasta
+    :param str ref_fai: FileStoreID for reference genome index file
+    :param str ref_dict: FileStoreID for reference genome sequence dictionary file
+    :param str merge_option: Value for --genotypemergeoption flag (Default: 'UNIQUIFY')
+                            'UNIQUIFY': Multiple variants at a single site are merged into a
+                                        single variant record.
+                            'UNSORTED': Used to merge VCFs from the same sample
+    :param ReferenceCache reference_cache: Node-local reference cache configuration, default is None
+    :return: FileStoreID for merged VCF file
+    :rtype: str
+    """
+    job.fileStore.logToMaster('Running GATK CombineVariants')
+
+    command = ['-T', 'CombineVariants',
+               '-R', '/data/genome.fa',
+               '-o', '/data/merged.vcf',
+               '--genotypemergeoption', merge_option]
+
+    for name in vcfs:
+        command.extend(['--variant', os.path.join('/data', name)])
+
+    work_dir = gatk_call(job, command, ref_fasta, ref_fai, ref_dict,
+                         inputs=vcfs,
+                         outputs=['merged.vcf'],
+                         reference_cache=reference_cache)
+
+    return job.fileStore.writeGlobalFile(os.path.join(work_dir, 'merged.vcf'))
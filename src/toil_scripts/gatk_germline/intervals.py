@@ -0,0 +1,177 @@
+#!/usr/bin/env python2.7
+"""
+Genomic interval utilities for splitting GATK jobs into reference ordered shards.
+
+Intervals are represented as (contig, start, end) tuples using 0-based, half-open
+BED coordinates.
+"""
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+# Minimum length of an assembly gap that HaplotypeCaller shards are split at
+SHARD_GAP_LENGTH = 1000
+
+
+def parse_sequence_dictionary(handle):
+    """
+    Parses contig names and lengths from a Picard sequence dictionary
+
+    :param file handle: Open file handle for a sequence dictionary (.dict) file
+    :return: Ordered dictionary of contig lengths {contig: length}
+    :rtype: OrderedDict
+    """
+    contigs = OrderedDict()
+    for line in handle:
+        if not line.startswith('@SQ'):
+            continue
+        fields = dict(field.split(':', 1) for field in line.rstrip('\n').split('\t')[1:] if ':' in field)
+        contigs[fields['SN']] = int(fields['LN'])
+    return contigs
+
+
+def parse_bed(handle):
+    """
+    Parses intervals from a BED file. Header, track, and comment lines are skipped.
+
+    :param file handle: Open file handle for a BED file
+    :return: List of (contig, start, end) tuples
+    :rtype: list[tuple]
+    """
+    intervals = []
+    for line in handle:
+        if not line.strip() or line.startswith(('#', 'track', 'browser')):
+            continue
+        fields = line.rstrip('\n').split('\t')
+        intervals.append((fields[0], int(fields[1]), int(fields[2])))
+    return intervals
+
+
+def genome_intervals(contigs):
+    """
+    Converts contig lengths into intervals that span each contig
+
+    :param OrderedDict contigs: Ordered dictionary of contig lengths {contig: length}
+    :return: List of (contig, start, end) tuples
+    :rtype: list[tuple]
+    """
+    return [(contig, 0, length) for contig, length in contigs.iteritems()]
+
+
+def sort_and_merge_intervals(intervals, contigs):
+    """
+    Sorts intervals by reference order and merges overlapping intervals. Intervals on contigs
+    that are not in the sequence dictionary are dropped.
+
+    :param list[tuple] intervals: List of (contig, start, end) tuples
+    :param OrderedDict contigs: Ordered dictionary of contig lengths {contig: length}
+    :return: Sorted, non-overlapping list of (contig, start, end) tuples
+    :rtype: list[tuple]
+    """
+    order = {contig: i for i, contig in enumerate(contigs)}
+    merged = []
+    for contig, start, end in sorted((x for x in intervals if x[0] in order),
+                                     key=lambda x: (order[x[0]], x[1], x[2])):
+        if merged and merged[-1][0] == contig and start <= merged[-1][2]:
+            merged[-1] = (contig, merged[-1][1], max(end, merged[-1][2]))
+        else:
+            merged.append((contig, start, end))
+    return merged
+
+
+def partition_intervals(intervals, num_shards, gaps=None):
+    """
+    Splits reference ordered intervals into contiguous shards that span approximately the same
+    number of bases. Concatenating the output of each shard in order reproduces reference order.
+
+    Without gaps, intervals are split at any base. With gaps, intervals are only split at contig
+    and interval boundaries and at the midpoint of each gap, so no read or HaplotypeCaller active
+    region spans a shard boundary. Shards are then less even and there may be fewer shards than
+    requested.
+
+    :param list[tuple] intervals: Sorted, non-overlapping list of (contig, start, end) tuples
+    :param int num_shards: Number of shards
+    :param list[tuple] gaps: List of (contig, start, end) assembly gaps, default is None
+    :return: List of shards, where each shard is a list of (contig, start, end) tuples
+    :rtype: list[list[tuple]]
+    """
+    if num_shards < 1:
+        raise ValueError('Number of shards must be a positive integer, got %s' % num_shards)
+    total = sum(end - start for _, start, end in intervals)
+    num_shards = min(num_shards, total) if total else 1
+    if gaps is not None:
+        return _partition_at_gaps(intervals, num_shards, total, gaps)
+
+    shards = [[]]
+    # Number of bases assigned to all shards so far
+    assigned = 0
+    for contig, start, end in intervals:
+        while start < end:
+            # The cumulative number of bases that should be assigned once the current shard is full
+            remaining = total * len(shards) // num_shards - assigned
+            if remaining <= 0:
+                shards.append([])
+                continue
+            stop = min(end, start + remaining)
+            shards[-1].append((contig, start, stop))
+            assigned += stop - start
+            start = stop
+    return [shard for shard in shards if shard]
+
+
+def _partition_at_gaps(intervals, num_shards, total, gaps):
+    """
+    Groups intervals into shards that are only split at interval boundaries and gap midpoints
+
+    :param list[tuple] intervals: Sorted, non-overlapping list of (contig, start, end) tuples
+    :param int num_shards: Number of shards
+    :param int total: Total number of bases spanned by the intervals
+    :param list[tuple] gaps: List of (contig, start, end) assembly gaps
+    :return: List of shards, where each shard is a list of (contig, start, end) tuples
+    :rtype: list[list[tuple]]
+    """
+    cut_points = {}
+    for contig, start, end in gaps:
+        cut_points.setdefault(contig, []).append((start + end) // 2)
+    for points in cut_points.itervalues():
+        points.sort()
+
+    # Pieces of the intervals between cut points, which are never split further
+    pieces = []
+    for contig, start, end in intervals:
+        points = cut_points.get(contig, [])
+        bounds = [start] + points[bisect_right(points, start):bisect_left(points, end)] + [end]
+        pieces.extend((contig, a, b) for a, b in zip(bounds, bounds[1:]))
+
+    shards = [[]]
+    assigned = 0
+    for contig, start, end in pieces:
+        # Start a new shard if the current shard is closer to full without this piece than with it
+        target = total * len(shards) // num_shards
+        if shards[-1] and len(shards) < num_shards and assigned + (end - start) / 2.0 > target:
+            shards.append([])
+        if shards[-1] and shards[-1][-1][0] == contig and shards[-1][-1][2] == start:
+            shards[-1][-1] = (contig, shards[-1][-1][1], end)
+        else:
+            shards[-1].append((contig, start, end))
+        assigned += end - start
+    return shards
+
+
+def interval_size(intervals):
+    """
+    :param list[tuple] intervals: List of (contig, start, end) tuples
+    :return: Total number of bases spanned by the intervals
+    :rtype: int
+    """
+    return sum(end - start for _, start, end in intervals)
+
+
+def write_bed(intervals, handle):
+    """
+    Writes intervals in BED format
+
+    :param list[tuple] intervals: List of (contig, start, end) tuples
+    :param file handle: Open file handle for output BED file
+    """
+    for contig, start, end in intervals:
+        handle.write('%s\t%d\t%d\n' % (contig, start, end))
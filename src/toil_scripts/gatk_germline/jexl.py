@@ -0,0 +1,393 @@
+#!/usr/bin/env python2.7
+"""
+Evaluates the subset of JEXL used by GATK VariantFiltration hard filter expressions.
+
+Supported syntax:
+    - Numbers, quoted strings, true, false, and variable names
+    - Comparisons: <, <=, >, >=, ==, != and lt, le, gt, ge, eq, ne
+    - Logical operators: ||, &&, ! and or, and, not
+    - Unary minus and parentheses
+
+Variables are looked up in a dictionary of record values. GATK evaluates expressions in strict
+mode, so if evaluation reaches a variable that is not defined for a record, then the entire
+expression evaluates to False. Logical operators short-circuit, so a missing variable in the
+right hand side of "QD < 2.0 || FS > 60.0" does not matter when QD < 2.0.
+
+Expressions can be evaluated one record at a time with compile_expression, or over blocks of
+records at once with compile_vectorized, which evaluates the expression using NumPy operations
+over columnar arrays of record values. A column is a pair of arrays (values, present), where
+present is False for records that do not define the value. Values are stored the same way as in
+record dictionaries: an array of strings is compared as strings with other strings and
+converted to numbers when compared with numbers, a float array holds numbers, and a boolean
+array holds flags.
+"""
+import operator
+import re
+
+import numpy as np
+
+
+class MissingVariable(KeyError):
+    """
+    Raised when an expression references a variable that is not defined for a record
+    """
+
+
+_TOKEN_REGEX = re.compile(r"""
+    \s*(?:
+        (?P<number>(?:\d+\.\d*|\.\d+|\d+)(?:[eE][-+]?\d+)?)|
+        (?P<string>"[^"]*"|'[^']*')|
+        (?P<operator>\|\||&&|==|!=|<=|>=|<|>|!|\(|\)|-)|
+        (?P<name>[A-Za-z_$][A-Za-z0-9_$.]*)
+    )""", re.VERBOSE)
+
+_WORD_OPERATORS = {'or': '||', 'and': '&&', 'not': '!',
+                   'lt': '<', 'le': '<=', 'gt': '>', 'ge': '>=', 'eq': '==', 'ne': '!='}
+
+_CONSTANTS = {'true': True, 'false': False}
+
+COMPARISONS = {'<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge,
+               '==': operator.eq, '!=': operator.ne}
+
+
+def tokenize(expression):
+    """
+    Splits a JEXL expression into tokens
+
+    :param str expression: JEXL expression
+    :return: List of (kind, value) tuples
+    :rtype: list[tuple]
+    """
+    tokens = []
+    position = 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = _TOKEN_REGEX.match(expression, position)
+        if not match:
+            raise ValueError('Unable to parse JEXL expression at position %d: %s' % (position, expression))
+        position = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'number':
+            value = float(value) if re.search(r'[.eE]', value) else int(value)
+        elif kind == 'string':
+            value = value[1:-1]
+        elif kind == 'name' and value in _WORD_OPERATORS:
+            kind, value = 'operator', _WORD_OPERATORS[value]
+        elif kind == 'name' and value in _CONSTANTS:
+            kind, value = 'const', _CONSTANTS[value]
+        tokens.append((kind, value))
+    return tokens
+
+
+def parse_expression(expression):
+    """
+    Parses a JEXL expression into a syntax tree. The tree is made of tuples:
+
+        ('or', left, right)
+        ('and', left, right)
+        ('not', operand)
+        ('cmp', operator, left, right)
+        ('neg', operand)
+        ('var', name)
+        ('const', value)
+
+    :param str expression: JEXL expression. Surrounding quotation marks are removed.
+    :return: Syntax tree
+    :rtype: tuple
+    """
+    expression = expression.strip()
+    if len(expression) > 1 and expression[0] == expression[-1] and expression[0] in '"\'':
+        expression = expression[1:-1]
+    tokens = tokenize(expression)
+    if not tokens:
+        raise ValueError('Empty JEXL expression')
+
+    # Recursive descent parser. The position is stored in a list so nested functions can update it.
+    position = [0]
+
+    def peek():
+        return tokens[position[0]] if position[0] < len(tokens) else (None, None)
+
+    def advance():
+        token = peek()
+        position[0] += 1
+        return token
+
+    def expect(value):
+        kind, token = advance()
+        if kind != 'operator' or token != value:
+            raise ValueError('Expected "%s" in JEXL expression: %s' % (value, expression))
+
+    def parse_or():
+        tree = parse_and()
+        while peek() == ('operator', '||'):
+            advance()
+            tree = ('or', tree, parse_and())
+        return tree
+
+    def parse_and():
+        tree = parse_not()
+        while peek() == ('operator', '&&'):
+            advance()
+            tree = ('and', tree, parse_not())
+        return tree
+
+    def parse_not():
+        if peek() == ('operator', '!'):
+            advance()
+            return 'not', parse_not()
+        return parse_comparison()
+
+    def parse_comparison():
+        tree = parse_unary()
+        kind, value = peek()
+        if kind == 'operator' and value in COMPARISONS:
+            advance()
+            tree = ('cmp', value, tree, parse_unary())
+        return tree
+
+    def parse_unary():
+        if peek() == ('operator', '-'):
+            advance()
+            return 'neg', parse_unary()
+        return parse_primary()
+
+    def parse_primary():
+        kind, value = advance()
+        if kind in ('number', 'string', 'const'):
+            return 'const', value
+        if kind == 'name':
+            return 'var', value
+        if (kind, value) == ('operator', '('):
+            tree = parse_or()
+            expect(')')
+            return tree
+        raise ValueError('Unexpected token "%s" in JEXL expression: %s' % (value, expression))
+
+    tree = parse_or()
+    if position[0] != len(tokens):
+        raise ValueError('Unexpected token "%s" in JEXL expression: %s' % (peek()[1], expression))
+    return tree
+
+
+def variables(tree):
+    """
+    :param tuple tree: Syntax tree from parse_expression
+    :return: Names of the variables referenced by the expression
+    :rtype: set[str]
+    """
+    if tree[0] == 'var':
+        return {tree[1]}
+    if tree[0] == 'const':
+        return set()
+    return set.union(*[variables(node) for node in tree[1:] if isinstance(node, tuple)])
+
+
+def to_number(value):
+    """
+    Coerces a value to a number following JEXL arithmetic
+
+    :param value: Number, boolean, or string
+    :return: Numeric value
+    :rtype: int|float
+    """
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, long, float)):
+        return value
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError('Unable to compare non-numeric value "%s" to a number' % value)
+
+
+def to_boolean(value):
+    """
+    Coerces a value to a boolean following JEXL arithmetic
+
+    :param value: Number, boolean, or string
+    :rtype: bool
+    """
+    if isinstance(value, basestring):
+        return value not in ('', 'false')
+    return bool(value)
+
+
+def compare(op, left, right):
+    """
+    Compares two values. If either value is numeric, then both values are compared as numbers,
+    otherwise they are compared as strings.
+
+    :param str op: Comparison operator
+    :param left: Left operand
+    :param right: Right operand
+    :rtype: bool
+    """
+    if isinstance(left, basestring) and isinstance(right, basestring):
+        return COMPARISONS[op](left, right)
+    return COMPARISONS[op](to_number(left), to_number(right))
+
+
+def _compile(tree):
+    """
+    Converts a syntax tree into nested closures, so the tree is only walked once per expression
+    """
+    node = tree[0]
+    if node == 'const':
+        value = tree[1]
+        return lambda record: value
+    if node == 'var':
+        name = tree[1]
+
+        def lookup(record):
+            try:
+                return record[name]
+            except KeyError:
+                raise MissingVariable(name)
+        return lookup
+    if node == 'neg':
+        operand = _compile(tree[1])
+        return lambda record: -to_number(operand(record))
+    if node == 'not':
+        operand = _compile(tree[1])
+        return lambda record: not to_boolean(operand(record))
+    if node == 'cmp':
+        op, left, right = tree[1], _compile(tree[2]), _compile(tree[3])
+        return lambda record: compare(op, left(record), right(record))
+    left, right = _compile(tree[1]), _compile(tree[2])
+    if node == 'and':
+        return lambda record: to_boolean(left(record)) and to_boolean(right(record))
+    return lambda record: to_boolean(left(record)) or to_boolean(right(record))
+
+
+def compile_expression(expression):
+    """
+    Compiles a JEXL expression into a function that evaluates the expression for a record.
+
+    :param str expression: JEXL expression
+    :return: Function that takes a dictionary of record values and returns True if the
+             record matches the expression
+    :rtype: function
+    """
+    evaluate = _compile(parse_expression(expression))
+
+    def match(record):
+        try:
+            return to_boolean(evaluate(record))
+        except MissingVariable:
+            return False
+    return match
+
+
+def _to_number_array(values):
+    if isinstance(values, np.ndarray):
+        if _is_string(values):
+            try:
+                return values.astype(float)
+            except ValueError:
+                raise ValueError('Unable to compare non-numeric values to a number')
+        return values
+    return to_number(values)
+
+
+def _to_boolean_array(values):
+    if isinstance(values, np.ndarray):
+        if values.dtype == bool:
+            return values
+        if _is_string(values):
+            return (values != '') & (values != 'false')
+        return values != 0
+    return to_boolean(values)
+
+
+def _is_string(values):
+    if isinstance(values, np.ndarray):
+        return values.dtype.kind in 'SO'
+    return isinstance(values, basestring)
+
+
+def _compile_vectorized(tree):
+    """
+    Converts a syntax tree into nested closures that evaluate a block of records. Each closure
+    returns the values for the block and a mask of records where evaluation reached a missing
+    variable. Short-circuiting is reproduced by only propagating the right hand side mask to
+    records that would have evaluated the right hand side.
+    """
+    node = tree[0]
+    if node == 'const':
+        value = tree[1]
+        return lambda columns: (value, False)
+    if node == 'var':
+        name = tree[1]
+
+        def lookup(columns):
+            values, present = columns[name]
+            return values, ~present
+        return lookup
+    if node == 'neg':
+        operand = _compile_vectorized(tree[1])
+
+        def negate(columns):
+            values, missing = operand(columns)
+            return -_to_number_array(values), missing
+        return negate
+    if node == 'not':
+        operand = _compile_vectorized(tree[1])
+
+        def invert(columns):
+            values, missing = operand(columns)
+            return ~_to_boolean_array(values) if isinstance(values, np.ndarray) else not to_boolean(values), missing
+        return invert
+    if node == 'cmp':
+        op, left, right = COMPARISONS[tree[1]], _compile_vectorized(tree[2]), _compile_vectorized(tree[3])
+
+        def comparison(columns):
+            left_values, left_missing = left(columns)
+            right_values, right_missing = right(columns)
+            if not (_is_string(left_values) and _is_string(right_values)):
+                left_values, right_values = _to_number_array(left_values), _to_number_array(right_values)
+            with np.errstate(invalid='ignore'):
+                return op(left_values, right_values), left_missing | right_missing
+        return comparison
+    left, right = _compile_vectorized(tree[1]), _compile_vectorized(tree[2])
+    if node == 'and':
+        def conjunction(columns):
+            left_values, left_missing = left(columns)
+            right_values, right_missing = right(columns)
+            left_values, right_values = _to_boolean_array(left_values), _to_boolean_array(right_values)
+            return left_values & right_values, left_missing | (left_values & right_missing)
+        return conjunction
+
+    def disjunction(columns):
+        left_values, left_missing = left(columns)
+        right_values, right_missing = right(columns)
+        left_values, right_values = _to_boolean_array(left_values), _to_boolean_array(right_values)
+        return left_values | right_values, left_missing | (~left_values & right_missing)
+    return disjunction
+
+
+def compile_vectorized(expression):
+    """
+    Compiles a JEXL expression into a function that evaluates the expression for a block of
+    records. The results are identical to evaluating each record with compile_expression.
+
+    :param str expression: JEXL expression
+    :return: Function that takes a dictionary of columns {name: (values, present)} and the
+             number of records, and returns a boolean array that is True for records that match
+             the expression. The names of the columns it reads are stored in its variables
+             attribute.
+    :rtype: function
+    """
+    tree = parse_expression(expression)
+    evaluate = _compile_vectorized(tree)
+
+    def match(columns, size):
+        if not size:
+            return np.zeros(0, dtype=bool)
+        values, missing = evaluate(columns)
+        matched = np.logical_and(_to_boolean_array(values), np.logical_not(missing))
+        # Expressions without variables evaluate to a scalar
+        return np.broadcast_to(matched, (size,)).copy()
+    match.variables = variables(tree)
+    return match
@@ -0,0 +1,167 @@
+#!/usr/bin/env python2.7
+"""
+Node-local, read-only cache for shared reference files.
+
+Jobs that need the genome reference copy each file from the FileStore into their own work
+directory. When many jobs run on the same worker, the same files are copied again for every job.
+The reference cache localizes each file once per node, keyed by FileStoreID, then hard links it
+into each job's work directory. If the work directory is on a different device, the cached file
+is copied instead, which still avoids downloading it from the FileStore. Cached files are
+read-only and are evicted in least recently used order when the cache grows past its size limit.
+Files that are still linked into a job's work directory are never evicted.
+"""
+from collections import namedtuple
+from contextlib import contextmanager
+import errno
+import fcntl
+import hashlib
+import os
+import shutil
+import stat
+import uuid
+
+# Configuration for the node-local reference cache. Path is a local directory that must be
+# available on every worker and max_size is the size limit of the cache in bytes.
+ReferenceCache = namedtuple('ReferenceCache', 'path max_size')
+
+
+@contextmanager
+def _lock(path):
+    """
+    Holds an exclusive lock on a lock file, so jobs on the same node do not race each other
+    """
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _link(source, destination):
+    """
+    Hard links a file, falling back to a copy across devices. Symbolic links are not used,
+    because they cannot be followed inside the Docker containers that the work directory is
+    mounted into.
+    """
+    try:
+        os.link(source, destination)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.copyfile(source, destination)
+
+
+def cache_path(cache, file_id):
+    """
+    :param ReferenceCache cache: Reference cache configuration
+    :param str file_id: FileStoreID
+    :return: Path to the cached copy of the file
+    :rtype: str
+    """
+    return os.path.join(cache.path, hashlib.sha1(str(file_id)).hexdigest())
+
+
+def _entry_lock(path):
+    return os.path.join(os.path.dirname(path), '.%s.lock' % os.path.basename(path))
+
+
+def evict(cache, keep=()):
+    """
+    Removes the least recently used files until the cache is smaller than its size limit. Files
+    that are linked into a work directory and files in keep are not removed.
+
+    :param ReferenceCache cache: Reference cache configuration
+    :param iterable[str] keep: Paths to cached files that must not be removed
+    :return: Number of bytes removed
+    :rtype: int
+    """
+    entries = []
+    for name in os.listdir(cache.path):
+        path = os.path.join(cache.path, name)
+        if name.startswith('.'):
+            continue
+        st = os.stat(path)
+        entries.append((st.st_mtime, st.st_size, st.st_nlink, path))
+
+    total = sum(size for _, size, _, _ in entries)
+    removed = 0
+    for _, size, nlink, path in sorted(entries):
+        if total <= cache.max_size:
+            break
+        if nlink > 1 or path in keep:
+            continue
+        # Skip files that another job is downloading or linking
+        with open(_entry_lock(path), 'a') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                continue
+            try:
+                if os.stat(path).st_nlink == 1:
+                    os.remove(path)
+                    total -= size
+                    removed += size
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+    return removed
+
+
+def read_reference_files(job, files, work_dir, cache=None):
+    """
+    Localizes reference files into a work directory. If a reference cache is configured, each
+    file is downloaded once per node and linked into the work directory, otherwise each file is
+    copied from the FileStore.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param dict files: Dictionary of reference files {filename: FileStoreID}
+    :param str work_dir: Job work directory
+    :param ReferenceCache cache: Reference cache configuration, default is None
+    :return: Number of bytes copied from the FileStore and number of bytes linked from the cache
+    :rtype: tuple(int, int)
+    """
+    copied = linked = 0
+    if cache is None:
+        for name, file_id in files.iteritems():
+            job.fileStore.readGlobalFile(file_id, os.path.join(work_dir, name))
+            copied += file_id.size
+        job.fileStore.logToMaster('Copied {} bytes of reference files'.format(copied))
+        return copied, linked
+
+    if not os.path.isdir(cache.path):
+        try:
+            os.makedirs(cache.path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    cached = set()
+    for name, file_id in files.iteritems():
+        path = cache_path(cache, file_id)
+        cached.add(path)
+        # Lock each cache entry while it is downloaded, so concurrent jobs only download it once
+        with _lock(_entry_lock(path)):
+            if os.path.exists(path):
+                linked += os.path.getsize(path)
+            else:
+                tmp_path = os.path.join(cache.path, '.%s.tmp' % uuid.uuid4())
+                try:
+                    with job.fileStore.readGlobalFileStream(file_id) as src, open(tmp_path, 'wb') as dst:
+                        shutil.copyfileobj(src, dst, 16 * 1024 * 1024)
+                    os.chmod(tmp_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+                    os.rename(tmp_path, path)
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                copied += os.path.getsize(path)
+            # Mark the file as recently used
+            os.utime(path, None)
+            _link(path, os.path.join(work_dir, name))
+
+    with _lock(os.path.join(cache.path, '.lock')):
+        evicted = evict(cache, keep=cached)
+
+    job.fileStore.logToMaster('Reference cache {}: copied {} bytes and linked {} bytes. Without the cache '
+                              '{} bytes would be copied. Evicted {} bytes.'.format(cache.path, copied, linked,
+                                                                                   copied + linked, evicted))
+    return copied, linked
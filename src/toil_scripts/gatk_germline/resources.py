@@ -0,0 +1,515 @@
+#!/usr/bin/env python2.7
+"""
+Learned resource requirements for pipeline jobs.
+
+Job resource requirements are estimated with fixed multiples of the input file sizes, which
+over-provision small samples and under-provision large ones. Profiled jobs record their peak disk
+usage, peak memory, average number of cores used, and runtime with the total size of their input
+files in a history file. The history is fit per job function when the pipeline starts, and jobs
+with enough history request the predicted resources plus a safety margin. Jobs without history use
+their fixed estimates.
+
+Disk usage is sampled from the job's temporary directory every second and whenever a container
+exits. Memory and CPU usage include the job process, its child processes, and the Docker containers
+the job starts. Profiled jobs start their containers with docker_call, which places them in a cgroup
+for the job, and the peak memory and CPU time of the cgroup are read once when the job finishes, so
+short-lived containers that Docker has already removed are counted. The containers of toil_lib's
+tool functions are started outside of the cgroup, so only the disk usage of those jobs is recorded.
+
+The memory requirement of a job is also the Java heap size of the tools it runs, and a JVM grows
+its heap towards that size whether or not it needs it. The heap size is recorded separately from
+the observed memory, runs with a Java heap are not used to fit memory, and predicted memory is never
+less than the fixed estimate, so predictions do not feed back into the usage they are fit to.
+
+The history file is a JSON record per line, so it can be shared by runs on a local path or a
+shared filesystem that is mounted on every worker.
+
+Without history, the cores and memory of each job type can be scaled with the size of its input
+files and the number of samples by fixed rules, which are bounded by configured floors and
+ceilings. The memory requirement is also the Java heap size of the tools the job runs.
+"""
+from argparse import Namespace
+from collections import namedtuple
+import fcntl
+import json
+import hashlib
+import math
+import os
+import re
+import resource
+import threading
+import time
+
+import numpy as np
+from toil.job import Job, Promise, PromisedRequirement
+from toil_lib import programs
+
+
+# Configuration for learned resource requirements. History is the path to the history file, margin
+# is the multiplier applied to predictions, and fits holds the fitted model of each job function
+# {name: {resource: (slope, intercept, residual)}}.
+ResourceModel = namedtuple('ResourceModel', 'history margin fits')
+
+# A job function needs this many profiled runs before its history is used
+MIN_RECORDS = 3
+
+# Only the most recent runs of each job function are fit
+MAX_RECORDS = 200
+
+# Seconds between disk samples
+SAMPLE_INTERVAL = 1
+
+RESOURCES = ('disk', 'memory', 'cores')
+
+# Floors and ceilings for scaled job requirements. Memory is in bytes.
+ResourceLimits = namedtuple('ResourceLimits', 'min_cores max_cores min_memory max_memory')
+
+# Rule for scaling the requirements of a job type. Memory is a base amount plus an amount per input
+# byte and per sample, or None if the job does not request memory. The job requests a core for
+# every bytes_per_core bytes of input, or None if the tool is single threaded.
+ScalingRule = namedtuple('ScalingRule', 'memory memory_per_byte memory_per_sample bytes_per_core')
+
+MB = 1024 ** 2
+GB = 1024 ** 3
+
+SCALING_RULES = {
+    'bwakit': ScalingRule(None, 0, 0, GB),
+    'samtools_sort': ScalingRule(None, 0, 0, 2 * GB),
+    'gatk_preprocessing': ScalingRule(4 * GB, 0.1, 0, 4 * GB),
+    'haplotype_caller': ScalingRule(4 * GB, 0.05, 0, 4 * GB),
+    # CombineGVCFs is single threaded and holds a record from every sample
+    'combine_gvcfs': ScalingRule(2 * GB, 0.5, 64 * MB, None),
+    'genotype_gvcfs': ScalingRule(4 * GB, 0.5, 64 * MB, 2 * GB),
+    # SelectVariants, VariantFiltration, and CombineVariants
+    'hard_filter': ScalingRule(2 * GB, 0.25, 0, None),
+    'variant_recalibrator': ScalingRule(4 * GB, 1.0, 0, GB),
+    'apply_recalibration': ScalingRule(2 * GB, 0.25, 0, 2 * GB),
+    'oncotator': ScalingRule(4 * GB, 2.0, 0, 512 * MB),
+}
+
+
+def fit(records, resource_name):
+    """
+    Fits a linear model of a resource to the input size
+
+    :param list[dict] records: History records of a job function
+    :param str resource_name: disk, memory, or cores
+    :return: Slope, intercept, and largest residual, or None if there is not enough history
+    :rtype: tuple(float, float, float)|None
+    """
+    # The memory used by a JVM follows its heap size, which is set from the memory requirement
+    points = [(record['input_size'], record[resource_name]) for record in records
+              if record.get(resource_name) is not None and not (resource_name == 'memory' and record.get('xmx'))]
+    if len(points) < MIN_RECORDS:
+        return None
+    x, y = np.array(points, dtype=float).T
+    if len(set(x)) > 1:
+        slope, intercept = np.polyfit(x, y, 1)
+    else:
+        slope, intercept = 0.0, y.mean()
+    # A resource does not shrink as the input grows
+    if slope < 0:
+        slope, intercept = 0.0, y.mean()
+    residual = max(0.0, float((y - (slope * x + intercept)).max()))
+    return float(slope), float(intercept), residual
+
+
+def load_resource_model(history, margin):
+    """
+    Reads the resource history and fits a model for each job function
+
+    :param str history: Path to the history file
+    :param float margin: Multiplier applied to predicted requirements
+    :return: Resource model
+    :rtype: ResourceModel
+    """
+    records = {}
+    if os.path.exists(history):
+        with open(history, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Skip records that were not completely written
+                    continue
+                records.setdefault(record['name'], []).append(record)
+    fits = {}
+    for name, job_records in records.iteritems():
+        job_fits = {resource_name: fit(job_records[-MAX_RECORDS:], resource_name) for resource_name in RESOURCES}
+        fits[name] = {resource_name: value for resource_name, value in job_fits.iteritems() if value}
+    return ResourceModel(history, margin, fits)
+
+
+def input_size(value, seen=None):
+    """
+    Returns the total size of the FileStoreIDs in a job's arguments
+
+    :param value: Job argument, or list, tuple, dict, or Namespace of arguments
+    :param set seen: FileStoreIDs that were already counted
+    :return: Size in bytes
+    :rtype: int
+    """
+    seen = set() if seen is None else seen
+    if isinstance(value, str):
+        # FileStoreIDs are strings with a size
+        size = getattr(value, 'size', None)
+        if size is None or value in seen:
+            return 0
+        seen.add(value)
+        return size
+    if isinstance(value, Namespace):
+        value = vars(value)
+    if isinstance(value, dict):
+        value = value.values()
+    if isinstance(value, (list, tuple)):
+        return sum(input_size(item, seen) for item in value)
+    return 0
+
+
+def predict(model, name, resource_name, size, default):
+    """
+    Predicts a resource requirement from the history of a job function
+
+    :param ResourceModel model: Resource model
+    :param str name: Job function name
+    :param str resource_name: disk, memory, or cores
+    :param int size: Total size of the job's input files in bytes
+    :param int|float default: Fixed estimate used without history and as the floor for memory, or None
+    :return: Resource requirement
+    :rtype: int|float
+    """
+    model_fit = model.fits.get(name, {}).get(resource_name)
+    if model_fit is None:
+        return default
+    slope, intercept, residual = model_fit
+    value = model.margin * (slope * size + intercept + residual)
+    if resource_name == 'cores':
+        # The number of cores is only lowered, because tools are configured to use every core
+        value = max(1, int(math.ceil(value)))
+        return min(default, value) if default else default
+    if resource_name == 'memory' and default:
+        return max(int(value), default)
+    return max(int(value), 1024 * 1024)
+
+
+def scaled_requirement(limits, job_type, resource_name, size, num_samples=1):
+    """
+    Scales the cores or memory of a job type with its input
+
+    :param ResourceLimits limits: Floors and ceilings for scaled requirements
+    :param str job_type: Job type in SCALING_RULES
+    :param str resource_name: memory or cores
+    :param int size: Total size of the job's input files in bytes
+    :param int num_samples: Number of samples in the job's input files
+    :return: Resource requirement
+    :rtype: int
+    """
+    rule = SCALING_RULES[job_type]
+    if resource_name == 'cores':
+        value = int(math.ceil(float(size) / rule.bytes_per_core))
+        return min(max(value, limits.min_cores), limits.max_cores)
+    value = int(rule.memory + rule.memory_per_byte * size + rule.memory_per_sample * num_samples)
+    return min(max(value, limits.min_memory), limits.max_memory)
+
+
+def scaled_resources(config, job_type, inputs, num_samples=1, fraction=1.0):
+    """
+    Returns the cores and memory requirements of a job type, which are scaled with its input if
+    config.resource_limits is set and are config.cores and config.xmx otherwise. Requirements that
+    depend on promised inputs are returned as PromisedRequirements.
+
+    :param Namespace config: Pipeline configuration options and shared files
+        Requires the following config attributes:
+        config.cores                Number of cores for each job
+        config.xmx                  Java heap size in bytes
+        config.resource_limits      ResourceLimits for scaled job requirements or None
+    :param str job_type: Job type in SCALING_RULES
+    :param inputs: Input FileStoreIDs or promises for FileStoreIDs
+    :param int num_samples: Number of samples in the input files
+    :param float fraction: Fraction of the input processed by the job
+    :return: Keyword arguments for the job requirements
+    :rtype: dict
+    """
+    rule = SCALING_RULES[job_type]
+    requirements = {}
+    for resource_name, default in [('cores', config.cores), ('memory', config.xmx)]:
+        if getattr(rule, 'bytes_per_core' if resource_name == 'cores' else 'memory') is None:
+            continue
+        if config.resource_limits is None:
+            requirements[resource_name] = default
+        elif _contains_promise(inputs):
+            requirements[resource_name] = PromisedRequirement(_scaled_requirement, config.resource_limits,
+                                                              job_type, resource_name, inputs, num_samples, fraction)
+        else:
+            requirements[resource_name] = _scaled_requirement(config.resource_limits, job_type, resource_name,
+                                                              inputs, num_samples, fraction)
+    return requirements
+
+
+def _scaled_requirement(limits, job_type, resource_name, inputs, num_samples, fraction):
+    return scaled_requirement(limits, job_type, resource_name, int(fraction * input_size(inputs)), num_samples)
+
+
+def _contains_promise(value):
+    if isinstance(value, (Promise, PromisedRequirement)):
+        return True
+    if isinstance(value, dict):
+        value = value.values()
+    if isinstance(value, (list, tuple)):
+        return any(_contains_promise(item) for item in value)
+    return False
+
+
+def _requirement(model, name, resource_name, default, inputs):
+    if isinstance(default, PromisedRequirement):
+        default = default.getValue()
+    return predict(model, name, resource_name, input_size(inputs), default)
+
+
+def profiled_job(model, func, *args, **kwargs):
+    """
+    Wraps a job function so that its resource usage is recorded in the resource history and its
+    requirements are predicted from the history. The disk, memory, and cores keyword arguments
+    are the fixed estimates used without history.
+
+    :param ResourceModel model: Resource model, or None to run the job function unchanged
+    :param function func: Job function
+    :param args: Arguments for the job function
+    :param kwargs: Keyword arguments and requirements for the job function
+    :return: Job that runs the job function
+    :rtype: Job
+    """
+    if model is None:
+        return Job.wrapJobFn(func, *args, **kwargs)
+    name = func.__name__
+    inputs = [args, {key: value for key, value in kwargs.iteritems() if key not in RESOURCES}]
+    for resource_name in RESOURCES:
+        if resource_name not in model.fits.get(name, {}):
+            continue
+        default = kwargs.get(resource_name)
+        if _contains_promise([inputs, default]):
+            kwargs[resource_name] = PromisedRequirement(_requirement, model, name, resource_name, default, inputs)
+        else:
+            kwargs[resource_name] = predict(model, name, resource_name, input_size(inputs), default)
+    return Job.wrapJobFn(profile_job, model, func, *args, **kwargs)
+
+
+def profile_job(job, model, func, *args, **kwargs):
+    """
+    Runs a job function and appends its resource usage to the resource history
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param ResourceModel model: Resource model
+    :param function func: Job function
+    :param args: Arguments for the job function
+    :param kwargs: Keyword arguments for the job function
+    :return: Return value of the job function
+    """
+    profiler = Profiler(job)
+    profiler.start()
+    try:
+        rv = func(job, *args, **kwargs)
+    finally:
+        usage = profiler.stop()
+    if func.__module__.startswith('toil_lib.'):
+        usage.update(memory=None, cores=None)
+    record = dict(usage, name=func.__name__, input_size=input_size([args, kwargs]),
+                  requested={'disk': job.disk, 'memory': job.memory, 'cores': job.cores})
+    job.fileStore.logToMaster('Resource usage of {}: {} bytes input, {} bytes disk, {} bytes memory, {} bytes Java '
+                              'heap, {} cores, {:.0f} seconds'.format(record['name'], record['input_size'],
+                                                                      record['disk'], record['memory'], record['xmx'],
+                                                                      record['cores'], record['runtime']))
+    append_record(model.history, record)
+    return rv
+
+
+def append_record(history, record):
+    """
+    Appends a record to the resource history. The file is locked, so concurrent jobs do not
+    interleave their records.
+
+    :param str history: Path to the history file
+    :param dict record: Resource usage record
+    """
+    with open(history, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def directory_size(path):
+    """
+    :param str path: Path to a directory
+    :return: Total size of the files in the directory
+    :rtype: int
+    """
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                # The file was removed while the directory was walked
+                pass
+    return size
+
+
+def _read_int(path, key=None):
+    try:
+        with open(path, 'r') as f:
+            if key is None:
+                return int(f.read().strip())
+            for line in f:
+                fields = line.split()
+                if fields[0] == key:
+                    return int(fields[1])
+    except (IOError, ValueError, IndexError):
+        pass
+    return None
+
+
+def cgroup_parent(job):
+    """
+    :param JobFunctionWrappingJob job: Job that starts Docker containers
+    :return: Name of the parent cgroup of the job's containers. The name is a systemd slice
+             without a hierarchy, so it is a top level cgroup with either cgroup driver.
+    :rtype: str
+    """
+    job_id = '{}--{}'.format(job.fileStore.jobStore.config.workflowID, job.fileStore.jobID)
+    return 'toil_{}.slice'.format(hashlib.md5(job_id).hexdigest())
+
+
+def _cgroup_paths(name):
+    # cgroup v2, then cgroup v1
+    if os.path.exists('/sys/fs/cgroup/cgroup.controllers'):
+        return [os.path.join('/sys/fs/cgroup', name)]
+    return [os.path.join('/sys/fs/cgroup', controller, name) for controller in ('memory', 'cpuacct')]
+
+
+def cgroup_usage(name):
+    """
+    Reads the peak memory and CPU time of the containers in a parent cgroup. The parent cgroup
+    outlives its containers, so the usage of containers that were removed is included.
+
+    :param str name: Name of the parent cgroup
+    :return: Peak memory in bytes and CPU time in seconds, or None if they cannot be read
+    :rtype: tuple(int|None, float|None)
+    """
+    paths = _cgroup_paths(name)
+    if len(paths) == 1:
+        cpu = _read_int(os.path.join(paths[0], 'cpu.stat'), 'usage_usec')
+        return _read_int(os.path.join(paths[0], 'memory.peak')), cpu / 1e6 if cpu is not None else None
+    memory = _read_int(os.path.join(paths[0], 'memory.max_usage_in_bytes'))
+    cpu = _read_int(os.path.join(paths[1], 'cpuacct.usage'))
+    return memory, cpu / 1e9 if cpu is not None else None
+
+
+def java_heap_size(env):
+    """
+    :param dict[str,str] env: Environment variables of a container
+    :return: Java heap size in bytes from the -Xmx option of JAVA_OPTS, or None
+    :rtype: int|None
+    """
+    match = re.search(r'-Xmx(\d+)([kKmMgG]?)\b', (env or {}).get('JAVA_OPTS', ''))
+    if match is None:
+        return None
+    return int(match.group(1)) * 1024 ** ' kmg'.index(match.group(2).lower() or ' ')
+
+
+def docker_call(job, **kwargs):
+    """
+    Calls toil_lib's docker_call. If the job is profiled, the container is started in the job's
+    cgroup, and its Java heap size and the disk usage after it exits are recorded.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param kwargs: Keyword arguments for toil_lib's docker_call
+    :return: Return value of toil_lib's docker_call
+    """
+    profiler = _profilers.get(job.fileStore.jobID)
+    if profiler is None:
+        return programs.docker_call(job=job, **kwargs)
+    profiler.xmx = max(profiler.xmx, java_heap_size(kwargs.get('env')))
+    kwargs['docker_parameters'] = list(kwargs.get('docker_parameters') or []) + ['--cgroup-parent', profiler.cgroup]
+    try:
+        return programs.docker_call(job=job, **kwargs)
+    finally:
+        profiler.sample()
+
+
+# Running profilers by job ID
+_profilers = {}
+
+
+class Profiler(object):
+    """
+    Samples the disk usage of a job's temporary directory in a background thread, and reads the
+    memory and CPU usage of the Docker containers it starts from their cgroup when it stops
+    """
+
+    def __init__(self, job, interval=SAMPLE_INTERVAL):
+        """
+        :param JobFunctionWrappingJob job: Job to profile
+        :param int interval: Seconds between disk samples
+        """
+        self.path = job.fileStore.localTempDir
+        self.job_id = job.fileStore.jobID
+        self.cgroup = cgroup_parent(job)
+        self.interval = interval
+        self.peak_disk = 0
+        # Largest Java heap size of the job's containers
+        self.xmx = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        self._start_time = time.time()
+        self._start_usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+        # A job function may profile part of itself while the whole job is profiled
+        self._outer = _profilers.get(self.job_id)
+        _profilers[self.job_id] = self
+        self._thread.start()
+
+    def sample(self):
+        size = directory_size(self.path)
+        with self._lock:
+            self.peak_disk = max(self.peak_disk, size)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        """
+        :return: Peak disk and memory in bytes, Java heap size in bytes, average number of cores
+                 used, and runtime in seconds
+        :rtype: dict
+        """
+        if self._outer is None:
+            _profilers.pop(self.job_id, None)
+        else:
+            _profilers[self.job_id] = self._outer
+            self._outer.xmx = max(self._outer.xmx, self.xmx)
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+        runtime = time.time() - self._start_time
+        usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+        cpu = sum(end.ru_utime + end.ru_stime - start.ru_utime - start.ru_stime
+                  for start, end in zip(self._start_usage, usage))
+        # ru_maxrss is in kilobytes and covers the lifetime of the worker process
+        memory = 1024 * max(u.ru_maxrss for u in usage)
+        container_memory, container_cpu = cgroup_usage(self.cgroup)
+        memory = max(memory, container_memory or 0)
+        cpu += container_cpu or 0
+        for path in _cgroup_paths(self.cgroup) if self._outer is None else []:
+            try:
+                os.rmdir(path)
+            except OSError:
+                # The cgroup was not created, or is removed by systemd
+                pass
+        return {'disk': self.peak_disk, 'memory': memory, 'xmx': self.xmx,
+                'cores': cpu / runtime if runtime else 0.0, 'runtime': runtime}
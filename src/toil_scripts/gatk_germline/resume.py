@@ -0,0 +1,67 @@
+#!/usr/bin/env python2.7
+"""
+Sample-granular resume of a pipeline run from the files in its output directory.
+
+Restarting a run with a new job store processes every sample again. If resume is set, the output
+directory of each sample is checked before the pipeline starts. Samples whose outputs are all
+present are skipped, and the GVCFs of the remaining samples are imported for genotyping instead of
+calling variants again. A VCF file is only reused once its tabix index exists, because the index is
+written after the VCF file.
+"""
+import os
+
+from toil_scripts.gatk_germline.common import list_files
+from toil_scripts.gatk_germline.gvcf_store import StoredGvcf
+
+
+def expected_outputs(uuid, config):
+    """
+    Returns the names of the files written to the output directory of a sample. Samples that are
+    joint genotyped also need the outputs of the rest of the cohort, so they are never skipped.
+
+    :param str uuid: Unique sample identifier
+    :param Namespace config: Pipeline configuration options
+        Requires the following config attributes:
+        config.suffix               Suffix added to output filename
+        config.preprocess_only      If True, then stops pipeline after preprocessing steps
+        config.preprocess           If True, then preprocesses the BAM file
+        config.joint_genotype       If True, then joint genotypes cohort
+        config.run_vqsr             If True, then filters variants with VQSR
+        config.run_oncotator        If True, then annotates variants with Oncotator
+    :return: Output filenames, or None if the sample is never skipped
+    :rtype: list[str]|None
+    """
+    if config.preprocess_only:
+        return ['{}.preprocessed{}.bam'.format(uuid, config.suffix)] if config.preprocess else None
+    if config.joint_genotype:
+        return None
+    vcfs = ['{}{}.g.vcf.gz'.format(uuid, config.suffix),
+            '{}.genotyped{}.vcf.gz'.format(uuid, config.suffix),
+            '{}.{}{}.vcf.gz'.format(uuid, 'vqsr' if config.run_vqsr else 'hard_filter', config.suffix)]
+    if config.run_oncotator:
+        vcfs.append('{}.oncotator{}.vcf.gz'.format(uuid, config.suffix))
+    return vcfs + [vcf + '.tbi' for vcf in vcfs]
+
+
+def find_sample_outputs(uuid, config):
+    """
+    Checks the output directory of a sample for the outputs of a previous run
+
+    :param str uuid: Unique sample identifier
+    :param Namespace config: Pipeline configuration options
+        Requires the following config attributes:
+        config.output_dir           URL or local path to output directory
+        Additional attributes are required by expected_outputs.
+    :return: True if every output of the sample exists, and the GVCF of an incomplete sample or None
+    :rtype: tuple(bool, StoredGvcf|None)
+    """
+    output_dir = os.path.join(config.output_dir, uuid)
+    sizes = list_files(output_dir)
+    expected = expected_outputs(uuid, config)
+    if expected and all(name in sizes for name in expected):
+        return True, None
+    name = '{}{}.g.vcf.gz'.format(uuid, config.suffix)
+    if config.preprocess_only or name not in sizes or name + '.tbi' not in sizes:
+        return False, None
+    return False, StoredGvcf(os.path.join(output_dir, name), os.path.join(output_dir, name + '.tbi'),
+                             sizes[name] + sizes[name + '.tbi'])
@@ -0,0 +1,103 @@
+#!/usr/bin/env python2.7
+"""
+Builds tabix (.tbi) indexes for BGZF compressed VCF files.
+
+The index is built from the virtual offsets of each record as the VCF file is written, so the
+file does not have to be read again. Records are assigned to the smallest bin of the UCSC binning
+scheme that contains them, and a linear index stores the first record that overlaps each 16 KB
+window of the genome.
+"""
+import struct
+
+from toil_scripts.lib.bgzf import BgzfWriter
+
+# Tabix preset for VCF files: sequence name, start, and end columns, and the header prefix
+TBX_VCF = 2
+LINEAR_SHIFT = 14
+
+
+def reg2bin(beg, end):
+    """
+    Returns the smallest bin that contains a zero-based, half-open region
+
+    :param int beg: Start position
+    :param int end: End position
+    :return: Bin number
+    :rtype: int
+    """
+    end -= 1
+    for shift, offset in ((14, 4681), (17, 585), (20, 73), (23, 9), (26, 1)):
+        if beg >> shift == end >> shift:
+            return offset + (beg >> shift)
+    return 0
+
+
+class TabixIndex(object):
+    """
+    Collects the bins, chunks, and linear index of a coordinate sorted file
+    """
+
+    def __init__(self):
+        self.names = []
+        self._refs = {}
+        self._last_beg = None
+
+    def add(self, contig, beg, end, start, stop):
+        """
+        Adds a record to the index. Records must be added in file order, and the file must be
+        sorted by start position within each contig, with the records of each contig together.
+
+        :param str contig: Sequence name
+        :param int beg: Zero-based start position
+        :param int end: Zero-based, exclusive end position
+        :param int start: Virtual offset of the start of the record
+        :param int stop: Virtual offset of the end of the record
+        :raises ValueError: If the record is before the previous record
+        """
+        ref = self._refs.get(contig)
+        if ref is None:
+            ref = self._refs[contig] = ({}, {})
+            self.names.append(contig)
+        elif contig != self.names[-1]:
+            raise ValueError('Records of {} are not together: the file is not sorted'.format(contig))
+        elif beg < self._last_beg:
+            raise ValueError('Record at {}:{} is before the previous record at {}:{}: the file is not '
+                             'sorted'.format(contig, beg + 1, contig, self._last_beg + 1))
+        self._last_beg = beg
+        bins, linear = ref
+
+        chunks = bins.setdefault(reg2bin(beg, max(end, beg + 1)), [])
+        # Merge chunks that are adjacent in the file or start in the same compressed block
+        if chunks and (chunks[-1][1] == start or chunks[-1][1] >> 16 == start >> 16):
+            chunks[-1][1] = stop
+        else:
+            chunks.append([start, stop])
+
+        for window in xrange(beg >> LINEAR_SHIFT, (max(end, beg + 1) - 1 >> LINEAR_SHIFT) + 1):
+            if window not in linear:
+                linear[window] = start
+
+    def write(self, path):
+        """
+        Writes the index as a BGZF compressed .tbi file
+
+        :param str path: Path to the index file
+        """
+        names = ''.join(name + '\x00' for name in self.names)
+        with BgzfWriter(path) as f:
+            f.write('TBI\x01' + struct.pack('<8i', len(self.names), TBX_VCF, 1, 2, 0, ord('#'), 0, len(names)))
+            f.write(names)
+            for name in self.names:
+                bins, linear = self._refs[name]
+                f.write(struct.pack('<i', len(bins)))
+                for bin_, chunks in sorted(bins.iteritems()):
+                    f.write(struct.pack('<Ii', bin_, len(chunks)))
+                    for start, stop in chunks:
+                        f.write(struct.pack('<QQ', start, stop))
+                # Windows without records point to the previous record
+                n_intv = max(linear) + 1 if linear else 0
+                offsets = []
+                for window in xrange(n_intv):
+                    offsets.append(linear.get(window, offsets[-1] if offsets else 0))
+                f.write(struct.pack('<i', n_intv))
+                f.write(struct.pack('<%dQ' % n_intv, *offsets))
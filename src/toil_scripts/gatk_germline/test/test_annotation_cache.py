@@ -0,0 +1,99 @@
+from StringIO import StringIO
+from unittest import TestCase
+
+from toil_scripts.gatk_germline import annotation_cache
+from toil_scripts.gatk_germline.annotation_cache import find_cached_records, merge_annotations, \
+    open_annotation_cache, record_key, uncached_records, update_annotation_cache
+
+
+class AnnotationCacheTest(TestCase):
+
+    header = '##fileformat=VCFv4.1\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
+    onco_header = '##INFO=<ID=gene,Number=1,Type=String,Description="Gene">\n'
+
+    def test_record_key(self):
+        self.assertEqual(record_key(['1', '10', '.', 'a', 'g']), ('1', 10, 'A', 'G'))
+        # Shared trailing and then leading bases are trimmed
+        self.assertEqual(record_key(['1', '10', '.', 'CAT', 'CGT']), ('1', 11, 'A', 'G'))
+        self.assertEqual(record_key(['1', '10', '.', 'CTT', 'CT,CTTT']), ('1', 10, 'CT', 'C,CTT'))
+        self.assertEqual(record_key(['1', '10', '.', 'AT', 'A']), ('1', 10, 'AT', 'A'))
+        self.assertEqual(record_key(['1', '10', '.', 'AT', '<DEL>']), ('1', 10, 'AT', '<DEL>'))
+
+    def test_merge_annotations(self):
+        db = open_annotation_cache(':memory:')
+        records = ['1\t10\t.\tA\tG\t50\t.\tDP=5\n', '1\t20\t.\tA\tT\t50\t.\tDP=7\n']
+        vcf = self.header + ''.join(records)
+
+        # Nothing is cached, so every record is annotated by Oncotator
+        cached = find_cached_records(StringIO(vcf), db, 'v1')
+        self.assertEqual(list(cached), [0, 0])
+        self.assertEqual(''.join(uncached_records(StringIO(vcf), cached)), vcf)
+        # Oncotator may reorder the records
+        annotated = (self.onco_header + self.header + '1\t20\t.\tA\tT\t50\t.\tDP=7;gene=XYZ\n' +
+                     self.header + '1\t10\t.\tA\tG\t50\t.\tDP=5;gene=ABC\n')
+        output, new_annotations = StringIO(), StringIO()
+        self.assertEqual(merge_annotations(StringIO(vcf), StringIO(annotated), db, 'v1', output, new_annotations),
+                         (0, 2))
+        expected = (self.header.replace('#CHROM', self.onco_header + '#CHROM') +
+                    '1\t10\t.\tA\tG\t50\t.\tDP=5;gene=ABC\n1\t20\t.\tA\tT\t50\t.\tDP=7;gene=XYZ\n')
+        self.assertEqual(output.getvalue(), expected)
+        self.assertEqual(new_annotations.getvalue(), self.onco_header + '1\t10\tA\tG\tgene=ABC\n'
+                                                                        '1\t20\tA\tT\tgene=XYZ\n')
+
+        # The new annotations are only in the cache once they are added
+        self.assertEqual(list(find_cached_records(StringIO(vcf), db, 'v1')), [0, 0])
+        self.assertEqual(update_annotation_cache(db, 'v1', StringIO(new_annotations.getvalue())), 2)
+
+        # Another sample reuses the cached annotations and only the new variant is annotated. A
+        # variant written with a padding base is the same variant.
+        records = ['1\t10\t.\tAC\tGC\t50\t.\tDP=9\n', '1\t15\t.\tC\tG\t50\t.\t.\n', '1\t20\t.\tA\tT\t50\t.\tDP=3\n']
+        vcf = self.header + ''.join(records)
+        cached = find_cached_records(StringIO(vcf), db, 'v1')
+        self.assertEqual(list(cached), [1, 0, 1])
+        self.assertEqual(''.join(uncached_records(StringIO(vcf), cached)), self.header + records[1])
+        output, new_annotations = StringIO(), StringIO()
+        annotated = self.onco_header + self.header + '1\t15\t.\tC\tG\t50\t.\tgene=DEF\n'
+        self.assertEqual(merge_annotations(StringIO(vcf), StringIO(annotated), db, 'v1', output, new_annotations),
+                         (2, 1))
+        self.assertEqual(output.getvalue().splitlines()[3:],
+                         ['1\t10\t.\tAC\tGC\t50\t.\tDP=9;gene=ABC', '1\t15\t.\tC\tG\t50\t.\tgene=DEF',
+                          '1\t20\t.\tA\tT\t50\t.\tDP=3;gene=XYZ'])
+        update_annotation_cache(db, 'v1', StringIO(new_annotations.getvalue()))
+
+        # Header lines are restored from the cache when every record is cached
+        output = StringIO()
+        self.assertEqual(merge_annotations(StringIO(vcf), StringIO(''), db, 'v1', output, StringIO()), (3, 0))
+        self.assertTrue(output.getvalue().startswith(self.header.replace('#CHROM', self.onco_header + '#CHROM')))
+
+        # Annotations from another database version are not reused
+        self.assertEqual(list(find_cached_records(StringIO(vcf), db, 'v2')), [0, 0, 0])
+
+        # Every record must be annotated, and every annotated record must be in the input
+        with self.assertRaises(ValueError):
+            merge_annotations(StringIO(vcf), StringIO(''), db, 'v2', StringIO(), StringIO())
+        annotated = self.header + '1\t15\t.\tC\tG\t50\t.\tgene=DEF\n1\t30\t.\tC\tG\t50\t.\tgene=GHI\n'
+        with self.assertRaises(ValueError):
+            merge_annotations(StringIO(self.header + records[1]), StringIO(annotated), db, 'v1', StringIO(),
+                              StringIO())
+        db.close()
+
+    def test_batches(self):
+        batch_size = annotation_cache.BATCH_SIZE
+        annotation_cache.BATCH_SIZE = 2
+        try:
+            db = open_annotation_cache(':memory:')
+            records = ['1\t%d\t.\tA\tG\t50\t.\tDP=%d\n' % (pos, pos) for pos in range(1, 8)]
+            vcf = self.header + ''.join(records)
+            annotated = self.header + ''.join(record.replace('\n', ';gene=G%d\n' % i)
+                                              for i, record in enumerate(records) if i % 2)
+            update_annotation_cache(db, 'v1', StringIO(''.join('1\t%d\tA\tG\tgene=G%d\n' % (i + 1, i)
+                                                               for i in range(0, 7, 2))))
+            self.assertEqual(list(find_cached_records(StringIO(vcf), db, 'v1')), [1, 0, 1, 0, 1, 0, 1])
+            output = StringIO()
+            self.assertEqual(merge_annotations(StringIO(vcf), StringIO(annotated), db, 'v1', output, StringIO()),
+                             (4, 3))
+            self.assertEqual([line.split('\t')[7] for line in output.getvalue().splitlines()[2:]],
+                             ['DP=%d;gene=G%d' % (i + 1, i) for i in range(7)])
+            db.close()
+        finally:
+            annotation_cache.BATCH_SIZE = batch_size
@@ -0,0 +1,67 @@
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from toil_scripts.gatk_germline.bundle_cache import cache_key, lookup, store, url_fingerprint
+
+
+class BundleCacheTest(TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.work_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.work_dir, 'genome.fa')
+        with open(self.path, 'w') as f:
+            f.write('>1\nACGT\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        shutil.rmtree(self.work_dir)
+
+    def test_fingerprint_changes_with_file(self):
+        url = 'file://' + self.path
+        fingerprint = url_fingerprint(url)
+        self.assertTrue(fingerprint.startswith('size=8;'))
+        with open(self.path, 'a') as f:
+            f.write('ACGT\n')
+        self.assertNotEqual(url_fingerprint(url), fingerprint)
+        self.assertIsNone(url_fingerprint('file:///does/not/exist'))
+
+    def test_store_and_lookup(self):
+        url = 'file://' + self.path
+        key = cache_key(url, url_fingerprint(url))
+        self.assertNotEqual(key, cache_key(url, url_fingerprint(url), '.fai'))
+        self.assertIsNone(lookup(self.cache_dir, key))
+
+        path = store(self.cache_dir, key, self.path, url=url)
+        self.assertEqual(lookup(self.cache_dir, key), path)
+        with open(os.path.join(self.cache_dir, key, 'manifest.json')) as f:
+            manifest = json.load(f)
+        self.assertEqual(manifest['size'], 8)
+        self.assertEqual(manifest['url'], url)
+        self.assertEqual(manifest['md5'], '95ce833e24dfeef500ee2ab3b9a7d890')
+
+        # Storing an existing entry keeps the original
+        self.assertEqual(store(self.cache_dir, key, self.path, url=url), path)
+        self.assertEqual(os.listdir(self.cache_dir), [key])
+
+        # Truncated entries are evicted
+        with open(path, 'w') as f:
+            f.write('>1\n')
+        self.assertIsNone(lookup(self.cache_dir, key))
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_lookup_verifies_md5(self):
+        url = 'file://' + self.path
+        key = cache_key(url, url_fingerprint(url))
+        path = store(self.cache_dir, key, self.path, url=url)
+
+        # Corrupted entries of the same size are evicted and can be stored again
+        with open(path, 'w') as f:
+            f.write('>1\nACGA\n')
+        self.assertIsNone(lookup(self.cache_dir, key))
+        self.assertEqual(os.listdir(self.cache_dir), [])
+        self.assertEqual(store(self.cache_dir, key, self.path, url=url), path)
+        self.assertEqual(lookup(self.cache_dir, key), path)
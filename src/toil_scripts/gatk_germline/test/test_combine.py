@@ -0,0 +1,23 @@
+from unittest import TestCase
+
+from toil_scripts.gatk_germline.combine import batch_gvcfs, combine_tree
+
+
+class CombineTest(TestCase):
+
+    def test_batch_gvcfs(self):
+        self.assertEqual(batch_gvcfs(range(5), 2), [[0, 1], [2, 3], [4]])
+        self.assertEqual(batch_gvcfs(range(4), 4), [range(4)])
+        self.assertEqual(batch_gvcfs([], 4), [])
+        self.assertRaises(ValueError, batch_gvcfs, range(4), 1)
+
+    def test_combine_tree(self):
+        k = 4
+        # A single GVCF is not combined
+        self.assertEqual(combine_tree(1, k, k), [])
+        self.assertEqual(combine_tree(k, k, k), [[k]])
+        self.assertEqual(combine_tree(k + 1, k, k), [[k, 1], [2]])
+        self.assertEqual(combine_tree(k * k, k, k), [[k] * k, [k]])
+        self.assertEqual(combine_tree(k * k + 1, k, k), [[k] * k + [1], [k, 1], [2]])
+        # The fan-out applies above the first level
+        self.assertEqual(combine_tree(12, 2, 3), [[2] * 6, [3, 3], [2]])
@@ -0,0 +1,48 @@
+import hashlib
+import os
+import shutil
+from StringIO import StringIO
+import tempfile
+from unittest import TestCase
+
+from toil_scripts.gatk_germline import common
+from toil_scripts.gatk_germline.common import copy_stream, file_exists, sse_headers
+
+
+class CommonTest(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_copy_stream(self):
+        data = ''.join(chr(i % 256) for i in xrange(10000))
+        path = os.path.join(self.work_dir, 'output.bin')
+        buffer_size = common.COPY_BUFFER_SIZE
+        common.COPY_BUFFER_SIZE = 1000
+        try:
+            size, md5 = copy_stream(StringIO(data), path)
+        finally:
+            common.COPY_BUFFER_SIZE = buffer_size
+        self.assertEqual(size, len(data))
+        self.assertEqual(md5, hashlib.md5(data).hexdigest())
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        # The temporary file is renamed
+        self.assertEqual(os.listdir(self.work_dir), ['output.bin'])
+
+    def test_file_exists(self):
+        self.assertTrue(file_exists(self.work_dir))
+        self.assertFalse(file_exists(os.path.join(self.work_dir, 'output.bin')))
+        self.assertFalse(file_exists('file://' + os.path.join(self.work_dir, 'output.bin')))
+
+    def test_sse_headers(self):
+        key_path = os.path.join(self.work_dir, 'key')
+        with open(key_path, 'w') as f:
+            f.write('k' * 32)
+        headers = sse_headers(key_path, 's3://bucket/foo/foo.g.vcf.gz')
+        self.assertEqual(headers['x-amz-server-side-encryption-customer-algorithm'], 'AES256')
+        self.assertNotEqual(headers, sse_headers(key_path, 's3://bucket/foo/foo.g.vcf.gz.tbi'))
+        self.assertEqual(len(headers['x-amz-server-side-encryption-customer-key'].decode('base64')), 32)
@@ -0,0 +1,81 @@
+import gzip
+import os
+import shutil
+from StringIO import StringIO
+import tempfile
+from unittest import TestCase
+
+from toil_scripts.lib.bgzf import BgzfWriter
+from toil_scripts.gatk_germline.fasta import find_gaps, index_fasta, open_fasta
+
+# The fixtures in the data directory were generated with samtools 1.24: ref.fasta.fai and
+# crlf.fasta.fai with samtools faidx, ref.fasta.gz with bgzip, and ref.dict with
+# samtools dict -u file:/data/ref.fasta. Picard is not used, so the @HD line of ref.dict is not
+# compared, and the order of the M5 and UR fields is that of samtools.
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+def read_data(name):
+    with open(os.path.join(DATA_DIR, name), 'rb') as f:
+        return f.read()
+
+
+FASTA = read_data('ref.fasta')
+FAI = read_data('ref.fasta.fai')
+DICT = read_data('ref.dict')
+
+
+class FastaTest(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def index(self, path):
+        fai, seq_dict = StringIO(), StringIO()
+        with open_fasta(path) as f:
+            self.assertEqual(index_fasta(f, fai, seq_dict, uri='file:/data/ref.fasta'), 3)
+        return fai.getvalue(), seq_dict.getvalue()
+
+    def assertIndex(self, path):
+        fai, seq_dict = self.index(path)
+        self.assertEqual(fai, FAI)
+        self.assertEqual(seq_dict.splitlines()[0], '@HD\tVN:1.4\tSO:unsorted')
+        self.assertEqual(seq_dict.splitlines()[1:], DICT.splitlines()[1:])
+
+    def test_index_fasta(self):
+        self.assertIndex(os.path.join(DATA_DIR, 'ref.fasta'))
+
+        # Windows line endings are part of the line width
+        fai = StringIO()
+        index_fasta(StringIO(read_data('crlf.fasta')), fai, StringIO())
+        self.assertEqual(fai.getvalue(), read_data('crlf.fasta.fai'))
+
+        # samtools faidx also rejects lines that are longer than the first line of the sequence
+        with self.assertRaises(ValueError):
+            index_fasta(StringIO('>x\nACGT\nAC\nACGT\n'), StringIO(), StringIO())
+
+    def test_index_compressed_fasta(self):
+        # Compressed with bgzip
+        self.assertIndex(os.path.join(DATA_DIR, 'ref.fasta.gz'))
+
+        path = os.path.join(self.work_dir, 'ref.fasta.gz')
+        with BgzfWriter(path) as f:
+            f.write(FASTA)
+        self.assertIndex(path)
+
+        # samtools faidx refuses to index plain gzip files
+        f = gzip.open(path, 'wb')
+        f.write(FASTA)
+        f.close()
+        with self.assertRaises(ValueError):
+            open_fasta(path)
+
+    def test_find_gaps(self):
+        self.assertEqual(find_gaps(StringIO(FASTA), 1), [('chr1', 8, 10), ('chr2', 0, 10), ('chr2', 14, 15)])
+        self.assertEqual(find_gaps(StringIO(FASTA), 3), [('chr2', 0, 10)])
+        # Gaps that continue across lines
+        self.assertEqual(find_gaps(StringIO('>1\nACNN\nNNNA\nNNNN\n>2\nNN\n'), 2),
+                         [('1', 2, 7), ('1', 8, 12), ('2', 0, 2)])
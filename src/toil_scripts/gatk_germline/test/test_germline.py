@@ -8,11 +8,15 @@ import shutil
 import subprocess
 import tempfile
 import textwrap
+from StringIO import StringIO
 from unittest import TestCase
 from uuid import uuid4
 
 from bd2k.util.iterables import concat
 
+from toil_scripts.gatk_germline.hard_filter import COMBINE_SOURCES
+from toil_scripts.gatk_germline.vcf import hard_filter_vcf, open_vcf
+
 
 log = logging.getLogger(__name__)
 
@@ -53,9 +57,12 @@ class GermlineTest(TestCase):
         Skips HaplotypeCaller step by swapping in a pre-cooked GVCF file.
         """
         expected_files = {'bam_test.preprocessed.ci_test.bam',
-                          'bam_test.ci_test.g.vcf',
-                          'bam_test.genotyped.ci_test.vcf',
-                          'bam_test.vqsr.ci_test.vcf',
+                          'bam_test.ci_test.g.vcf.gz',
+                          'bam_test.ci_test.g.vcf.gz.tbi',
+                          'bam_test.genotyped.ci_test.vcf.gz',
+                          'bam_test.genotyped.ci_test.vcf.gz.tbi',
+                          'bam_test.vqsr.ci_test.vcf.gz',
+                          'bam_test.vqsr.ci_test.vcf.gz.tbi',
                           'config-toil-germline.yaml'}
 
         inputs = self._get_default_inputs()
@@ -76,14 +83,17 @@ class GermlineTest(TestCase):
         Aligns paired FASTQ files, joint genotypes, and hard filters.
         """
         num_samples = int(os.environ.get('TOIL_SCRIPTS_TEST_NUM_SAMPLES', '3'))
-        expected_files = {'joint_genotyped.genotyped.ci_test.vcf',
-                          'joint_genotyped.hard_filter.ci_test.vcf',
+        expected_files = {'joint_genotyped.genotyped.ci_test.vcf.gz',
+                          'joint_genotyped.genotyped.ci_test.vcf.gz.tbi',
+                          'joint_genotyped.hard_filter.ci_test.vcf.gz',
+                          'joint_genotyped.hard_filter.ci_test.vcf.gz.tbi',
                           'config-toil-germline.yaml',
                           'manifest-toil-germline.tsv'}
 
         for i in range(1, num_samples+1):
             expected_files |= {'fastq_test_%s.preprocessed.ci_test.bam' % i,
-                               'fastq_test_%s.ci_test.g.vcf' % i}
+                               'fastq_test_%s.ci_test.g.vcf.gz' % i,
+                               'fastq_test_%s.ci_test.g.vcf.gz.tbi' % i}
 
         inputs = self._get_default_inputs()
         inputs.run_bwa = True
@@ -98,6 +108,7 @@ class GermlineTest(TestCase):
                   '--config', self._generate_config(inputs),
                   '--manifest', self._generate_manifest(num_samples))
         self._assertOutput(expected_files)
+        self._assertStreamingHardFilter(inputs, 'joint_genotyped', '.ci_test')
 
     def test_preprocess_only(self):
         """
@@ -200,6 +211,23 @@ class GermlineTest(TestCase):
                 self.assertTrue(name in expected_files)
                 self.assertTrue(os.stat(os.path.join(root, name)).st_size > 0)
 
+    def _assertStreamingHardFilter(self, inputs, uuid, suffix):
+        """
+        Checks that single pass hard filtering of the genotyped VCF writes the same records as the
+        GATK hard filtering jobs. Header lines differ, because GATK adds command line lines.
+        """
+        output_dir = os.path.join(self.workdir, uuid)
+        filters = {'SNP': (inputs.snp_filter_name, inputs.snp_filter_expression),
+                   'INDEL': (inputs.indel_filter_name, inputs.indel_filter_expression)}
+        output = StringIO()
+        with open_vcf(os.path.join(output_dir, '%s.genotyped%s.vcf.gz' % (uuid, suffix))) as f:
+            hard_filter_vcf(f, output, filters, sources=COMBINE_SOURCES)
+        with open_vcf(os.path.join(output_dir, '%s.hard_filter%s.vcf.gz' % (uuid, suffix))) as f:
+            expected = [line for line in f if not line.startswith('#')]
+        records = [line for line in output.getvalue().splitlines(True) if not line.startswith('#')]
+        self.assertTrue(expected)
+        self.assertEqual(records, expected)
+
     def _get_default_inputs(self):
         """
         Creates a Namespace object with default parameters
@@ -0,0 +1,55 @@
+from collections import namedtuple
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+Sample = namedtuple('Sample', 'uuid url paired_url rg_line')
+
+
+class GvcfStoreTest(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_sample_fingerprint(self):
+        from toil_scripts.gatk_germline.gvcf_store import gvcf_options, sample_fingerprint
+        bam = os.path.join(self.work_dir, 'sample.bam')
+        with open(bam, 'w') as f:
+            f.write('reads')
+        inputs = {'genome_fasta': 'file:///ref.fa', 'annotations': {'QualByDepth', 'FisherStrand'}}
+        options = gvcf_options(inputs)
+        self.assertEqual(options, gvcf_options(dict(inputs, annotations={'FisherStrand', 'QualByDepth'})))
+
+        sample = Sample('foo', 'file://' + bam, None, None)
+        fingerprint = sample_fingerprint(sample, options)
+        self.assertEqual(fingerprint, sample_fingerprint(sample, options))
+        self.assertNotEqual(fingerprint, sample_fingerprint(sample, gvcf_options(dict(inputs, intervals='a.bed'))))
+        # Variants near shard boundaries can be called differently, so sharding changes the GVCF
+        self.assertNotEqual(fingerprint, sample_fingerprint(sample, gvcf_options(dict(inputs, hc_shards=4))))
+        self.assertNotEqual(fingerprint, sample_fingerprint(sample._replace(rg_line='@RG\\tID:foo'), options))
+
+        # The fingerprint changes when the sample file changes
+        with open(bam, 'a') as f:
+            f.write('more reads')
+        self.assertNotEqual(fingerprint, sample_fingerprint(sample, options))
+
+    def test_find_stored_gvcf(self):
+        from toil_scripts.gatk_germline.gvcf_store import find_stored_gvcf, gvcf_store_dir
+        store_dir = gvcf_store_dir(self.work_dir, 'foo', 'abc')
+        self.assertEqual(store_dir, os.path.join(self.work_dir, 'foo', 'abc'))
+        self.assertIsNone(find_stored_gvcf(self.work_dir, 'foo', 'abc'))
+
+        os.makedirs(store_dir)
+        with open(os.path.join(store_dir, 'foo.g.vcf.gz'), 'w') as f:
+            f.write('gvcf')
+        # GVCFs are not reused until the index is stored
+        self.assertIsNone(find_stored_gvcf(self.work_dir, 'foo', 'abc'))
+        with open(os.path.join(store_dir, 'foo.g.vcf.gz.tbi'), 'w') as f:
+            f.write('tbi')
+        stored = find_stored_gvcf(self.work_dir, 'foo', 'abc')
+        self.assertEqual(stored.vcf_url, os.path.join(store_dir, 'foo.g.vcf.gz'))
+        self.assertEqual(stored.size, 7)
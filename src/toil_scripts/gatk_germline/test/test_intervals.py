@@ -0,0 +1,60 @@
+from collections import OrderedDict
+from StringIO import StringIO
+from unittest import TestCase
+
+from toil_scripts.gatk_germline.intervals import genome_intervals, interval_size, parse_bed, \
+    parse_sequence_dictionary, partition_intervals, sort_and_merge_intervals
+
+
+class IntervalsTest(TestCase):
+
+    def setUp(self):
+        self.contigs = OrderedDict([('1', 1000), ('2', 600), ('3', 400)])
+
+    def test_parse_sequence_dictionary(self):
+        ref_dict = StringIO('@HD\tVN:1.4\tSO:unsorted\n'
+                            '@SQ\tSN:1\tLN:1000\tUR:file:/data/genome.fa\tM5:abc\n'
+                            '@SQ\tSN:2\tLN:600\n'
+                            '@SQ\tSN:3\tLN:400\n')
+        self.assertEqual(parse_sequence_dictionary(ref_dict), self.contigs)
+
+    def test_sort_and_merge_intervals(self):
+        bed = StringIO('track name=test\n'
+                       '2\t10\t20\n'
+                       '1\t50\t100\n'
+                       '1\t0\t60\n'
+                       'GL000192.1\t0\t10\n')
+        self.assertEqual(sort_and_merge_intervals(parse_bed(bed), self.contigs),
+                         [('1', 0, 100), ('2', 10, 20)])
+
+    def test_partition_genome(self):
+        intervals = genome_intervals(self.contigs)
+        shards = partition_intervals(intervals, 4)
+        self.assertEqual(len(shards), 4)
+        self.assertEqual([interval_size(shard) for shard in shards], [500, 500, 500, 500])
+        # Concatenating the shards in order reproduces the genome
+        self.assertEqual(shards[0], [('1', 0, 500)])
+        self.assertEqual(shards[2], [('2', 0, 500)])
+        self.assertEqual(shards[3], [('2', 500, 600), ('3', 0, 400)])
+
+    def test_partition_more_shards_than_bases(self):
+        shards = partition_intervals([('1', 0, 3)], 10)
+        self.assertEqual(shards, [[('1', 0, 1)], [('1', 1, 2)], [('1', 2, 3)]])
+
+    def test_partition_uneven(self):
+        intervals = [('1', 0, 7), ('2', 3, 5)]
+        shards = partition_intervals(intervals, 3)
+        self.assertEqual(sum(interval_size(shard) for shard in shards), 9)
+        self.assertEqual([interval_size(shard) for shard in shards], [3, 3, 3])
+
+    def test_partition_at_gaps(self):
+        intervals = genome_intervals(self.contigs)
+        # Shards are only split at contig boundaries and at gap midpoints
+        shards = partition_intervals(intervals, 4, gaps=[('1', 400, 600), ('2', 100, 120)])
+        self.assertEqual(shards, [[('1', 0, 500)], [('1', 500, 1000)], [('2', 0, 600)], [('3', 0, 400)]])
+        # Without gaps, there are at most as many shards as contigs
+        shards = partition_intervals(intervals, 4, gaps=[])
+        self.assertEqual(shards, [[('1', 0, 1000)], [('2', 0, 600)], [('3', 0, 400)]])
+        # Gaps outside of the intervals do not split them
+        self.assertEqual(partition_intervals([('1', 0, 300), ('1', 700, 1000)], 2, gaps=[('1', 400, 600)]),
+                         [[('1', 0, 300)], [('1', 700, 1000)]])
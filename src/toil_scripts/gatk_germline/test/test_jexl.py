@@ -0,0 +1,80 @@
+from unittest import TestCase
+
+import numpy as np
+
+from toil_scripts.gatk_germline.jexl import compile_expression, compile_vectorized, parse_expression, variables
+
+
+class JexlTest(TestCase):
+
+    def test_parse_expression(self):
+        self.assertEqual(parse_expression('"QD < 2.0 || MQRankSum < -12.5"'),
+                         ('or',
+                          ('cmp', '<', ('var', 'QD'), ('const', 2.0)),
+                          ('cmp', '<', ('var', 'MQRankSum'), ('neg', ('const', 12.5)))))
+        self.assertEqual(variables(parse_expression('!(QD lt 2) and FS > 60.0')), {'QD', 'FS'})
+        self.assertRaises(ValueError, parse_expression, 'QD < ')
+        self.assertRaises(ValueError, parse_expression, 'vc.isSNP()')
+
+    def test_precedence(self):
+        match = compile_expression('QD < 2.0 || FS > 60.0 && MQ < 40.0')
+        self.assertTrue(match({'QD': '1.0', 'FS': '0.0', 'MQ': '60.0'}))
+        self.assertFalse(match({'QD': '5.0', 'FS': '70.0', 'MQ': '60.0'}))
+        self.assertTrue(match({'QD': '5.0', 'FS': '70.0', 'MQ': '30.0'}))
+
+    def test_missing_values(self):
+        match = compile_expression('QD < 2.0 || FS > 60.0')
+        # Short-circuit before reaching the missing value
+        self.assertTrue(match({'QD': '1.0'}))
+        # A missing value makes the entire expression false
+        self.assertFalse(match({'FS': '100.0'}))
+        self.assertFalse(compile_expression('!(QD < 2.0)')({}))
+
+    def test_types(self):
+        self.assertTrue(compile_expression('DB')({'DB': True}))
+        self.assertTrue(compile_expression('CHROM == "20" && POS >= 100')({'CHROM': '20', 'POS': 100}))
+        self.assertRaises(ValueError, compile_expression('AF > 0.5'), {'AF': '0.25,0.75'})
+
+    def test_vectorized(self):
+        records = [{'QD': '1.0', 'FS': '0.0'},
+                   {'QD': '5.0', 'FS': '70.0'},
+                   {'QD': '5.0'},
+                   {'FS': '70.0'},
+                   {'QD': '5.0', 'FS': '0.0', 'DB': True},
+                   {}]
+        columns = {'QD': _column(['1.0', '5.0', '5.0', None, '5.0', None]),
+                   'FS': _column(['0.0', '70.0', None, '70.0', '0.0', None]),
+                   'DB': _column([None, None, None, None, True, None])}
+        for expression in ['QD < 2.0 || FS > 60.0',
+                           'QD < 2.0 && FS > 60.0',
+                           '!(QD >= 2.0) || DB',
+                           'FS > 60.0 || QD < 2.0 && -FS < -50',
+                           'QD == "5.0" || FS == "abc"',
+                           'QD == 5 && FS != "0"',
+                           'true']:
+            match = compile_expression(expression)
+            self.assertEqual(list(compile_vectorized(expression)(columns, len(records))), [match(x) for x in records],
+                             msg=expression)
+
+    def test_vectorized_strings(self):
+        columns = {'CHROM': _column(['20', 'X']), 'POS': (np.array([5.0, 10.0]), np.ones(2, dtype=bool))}
+        self.assertEqual(list(compile_vectorized('CHROM == "20" || POS > 8')(columns, 2)), [True, True])
+        self.assertEqual(list(compile_vectorized('CHROM == "X"')(columns, 2)), [False, True])
+        # INFO values are strings, so they are compared as strings with string constants
+        columns = {'QD': _column(['2.00', '2.0'])}
+        self.assertEqual(list(compile_vectorized('QD == "2.0"')(columns, 2)), [False, True])
+        self.assertEqual(list(compile_vectorized('QD == 2.0')(columns, 2)), [True, True])
+        self.assertRaises(ValueError, compile_vectorized('QD < 2.0'), {'QD': _column(['0.25,0.75'])}, 1)
+        self.assertEqual(compile_vectorized('QD < 2.0').variables, {'QD'})
+
+
+def _column(values):
+    """
+    :param list values: Record values, or None for missing values
+    :return: Column in the format of block_columns
+    :rtype: tuple(np.array, np.array)
+    """
+    present = np.array([value is not None for value in values], dtype=bool)
+    if all(value in (None, True) for value in values):
+        return present, present
+    return np.array(['nan' if value is None else value for value in values], dtype=object), present
@@ -0,0 +1,40 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from toil_scripts.gatk_germline.reference_cache import evict, ReferenceCache
+
+
+class ReferenceCacheTest(TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        shutil.rmtree(self.work_dir)
+
+    def _add(self, name, size, mtime):
+        path = os.path.join(self.cache_dir, name)
+        with open(path, 'w') as f:
+            f.write('A' * size)
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_evict_least_recently_used(self):
+        oldest = self._add('oldest', 10, 100)
+        linked = self._add('linked', 10, 200)
+        newest = self._add('newest', 10, 300)
+        # Files linked into a work directory are in use
+        os.link(linked, os.path.join(self.work_dir, 'genome.fa'))
+
+        self.assertEqual(evict(ReferenceCache(self.cache_dir, 20)), 10)
+        self.assertFalse(os.path.exists(oldest))
+        self.assertTrue(os.path.exists(linked))
+        self.assertTrue(os.path.exists(newest))
+
+        self.assertEqual(evict(ReferenceCache(self.cache_dir, 10), keep={newest}), 0)
+        self.assertEqual(evict(ReferenceCache(self.cache_dir, 0)), 10)
+        self.assertEqual([x for x in os.listdir(self.cache_dir) if not x.startswith('.')], ['linked'])
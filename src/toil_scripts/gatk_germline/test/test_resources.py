@@ -0,0 +1,116 @@
+from argparse import Namespace
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from toil_scripts.gatk_germline.resources import append_record, directory_size, fit, GB, input_size, \
+    java_heap_size, load_resource_model, MB, predict, ResourceLimits, ResourceModel, scaled_requirement, \
+    scaled_resources
+
+
+class FileID(str):
+    """
+    FileStoreID with a size
+    """
+
+    def __new__(cls, value, size):
+        file_id = str.__new__(cls, value)
+        file_id.size = size
+        return file_id
+
+
+class ResourcesTest(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_fit(self):
+        records = [{'input_size': size, 'disk': 2 * size + 10, 'cores': None} for size in (1, 2, 3)]
+        self.assertIsNone(fit(records[:2], 'disk'))
+        self.assertIsNone(fit(records, 'cores'))
+        slope, intercept, residual = fit(records, 'disk')
+        self.assertAlmostEqual(slope, 2)
+        self.assertAlmostEqual(intercept, 10)
+        self.assertAlmostEqual(residual, 0)
+
+        # A negative slope is replaced by the mean, and the residual covers the largest record
+        records = [{'input_size': size, 'memory': memory} for size, memory in ((1, 30), (2, 20), (3, 10))]
+        self.assertEqual(fit(records, 'memory'), (0.0, 20.0, 10.0))
+
+        # Runs with a Java heap are not used to fit memory
+        for record in records:
+            record['xmx'] = 32
+        self.assertIsNone(fit(records, 'memory'))
+
+    def test_input_size(self):
+        genome = FileID('genome', 100)
+        config = Namespace(genome_fasta=genome, cores=4, name='sample')
+        self.assertEqual(input_size([(FileID('bam', 10), genome), {'config': config}]), 110)
+
+    def test_predict(self):
+        model = ResourceModel(None, 1.5, {'job': {'disk': (2.0, 0.0, 0.0), 'cores': (0.0, 2.0, 0.0)}})
+        self.assertEqual(predict(model, 'job', 'disk', 1024 * 1024, 10), 3 * 1024 * 1024)
+        self.assertEqual(predict(model, 'job', 'disk', 1, 10), 1024 * 1024)
+        self.assertEqual(predict(model, 'job', 'memory', 1, 10), 10)
+        self.assertEqual(predict(model, 'other', 'disk', 1, 10), 10)
+        self.assertEqual(predict(model, 'job', 'cores', 1, 8), 3)
+        self.assertEqual(predict(model, 'job', 'cores', 1, 2), 2)
+
+        # Memory is never less than the fixed estimate
+        model = ResourceModel(None, 1.0, {'job': {'memory': (0.0, 4 * GB, 0.0)}})
+        self.assertEqual(predict(model, 'job', 'memory', 1, 8 * GB), 8 * GB)
+        self.assertEqual(predict(model, 'job', 'memory', 1, 2 * GB), 4 * GB)
+        self.assertEqual(predict(model, 'job', 'memory', 1, None), 4 * GB)
+
+    def test_java_heap_size(self):
+        self.assertEqual(java_heap_size({'JAVA_OPTS': '-Djava.io.tmpdir=/data/ -Xmx4294967296'}), 4 * GB)
+        self.assertEqual(java_heap_size({'JAVA_OPTS': '-Xmx512m'}), 512 * MB)
+        self.assertIsNone(java_heap_size({'OTHER': '-Xmx1G'}))
+        self.assertIsNone(java_heap_size(None))
+
+    def test_scaled_requirement(self):
+        limits = ResourceLimits(1, 8, 2 * GB, 32 * GB)
+        self.assertEqual(scaled_requirement(limits, 'hard_filter', 'memory', 0), 2 * GB)
+        self.assertEqual(scaled_requirement(limits, 'hard_filter', 'memory', 8 * GB), 4 * GB)
+        self.assertEqual(scaled_requirement(limits, 'genotype_gvcfs', 'memory', 0, num_samples=64), 8 * GB)
+        self.assertEqual(scaled_requirement(limits, 'genotype_gvcfs', 'memory', 100 * GB), 32 * GB)
+        self.assertEqual(scaled_requirement(limits, 'oncotator', 'cores', 10 * MB), 1)
+        self.assertEqual(scaled_requirement(limits, 'oncotator', 'cores', GB), 2)
+        self.assertEqual(scaled_requirement(limits, 'oncotator', 'cores', 100 * GB), 8)
+
+    def test_scaled_resources(self):
+        config = Namespace(cores=8, xmx=30 * GB, resource_limits=None)
+        vcf = FileID('vcf', 8 * GB)
+        self.assertEqual(scaled_resources(config, 'hard_filter', vcf), {'memory': 30 * GB})
+        self.assertEqual(scaled_resources(config, 'samtools_sort', vcf), {'cores': 8})
+        config.resource_limits = ResourceLimits(1, 8, 2 * GB, 32 * GB)
+        self.assertEqual(scaled_resources(config, 'hard_filter', vcf), {'memory': 4 * GB})
+        self.assertEqual(scaled_resources(config, 'haplotype_caller', vcf, fraction=0.5),
+                         {'cores': 1, 'memory': int(4.2 * GB)})
+
+    def test_load_resource_model(self):
+        history = os.path.join(self.work_dir, 'history.jsonl')
+        for size in (1, 2, 3):
+            append_record(history, {'name': 'job', 'input_size': size, 'disk': size, 'memory': 5, 'cores': 1.0})
+        append_record(history, {'name': 'new_job', 'input_size': 1, 'disk': 1, 'memory': 1, 'cores': 1.0})
+        with open(history, 'a') as f:
+            f.write(json.dumps({'name': 'job'})[:5])
+        model = load_resource_model(history, 1.25)
+        self.assertEqual(model.margin, 1.25)
+        self.assertEqual(sorted(model.fits['job']), ['cores', 'disk', 'memory'])
+        self.assertEqual(model.fits['new_job'], {})
+        self.assertEqual(load_resource_model(os.path.join(self.work_dir, 'missing'), 1.25).fits, {})
+
+    def test_directory_size(self):
+        for name, size in [('a', 10), ('b', 20)]:
+            with open(os.path.join(self.work_dir, name), 'w') as f:
+                f.write('x' * size)
+        os.mkdir(os.path.join(self.work_dir, 'c'))
+        with open(os.path.join(self.work_dir, 'c', 'd'), 'w') as f:
+            f.write('x' * 5)
+        self.assertEqual(directory_size(self.work_dir), 35)
@@ -0,0 +1,61 @@
+from argparse import Namespace
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+
+class ResumeTest(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.config = Namespace(output_dir=self.work_dir, suffix='.toil', preprocess_only=False, preprocess=False,
+                                joint_genotype=False, run_vqsr=False, run_oncotator=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def _write_outputs(self, uuid, filenames):
+        output_dir = os.path.join(self.work_dir, uuid)
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        for filename in filenames:
+            with open(os.path.join(output_dir, filename), 'w') as f:
+                f.write('data')
+
+    def test_expected_outputs(self):
+        from toil_scripts.gatk_germline.resume import expected_outputs
+        self.assertEqual(expected_outputs('foo', self.config),
+                         ['foo.toil.g.vcf.gz', 'foo.genotyped.toil.vcf.gz', 'foo.hard_filter.toil.vcf.gz',
+                          'foo.toil.g.vcf.gz.tbi', 'foo.genotyped.toil.vcf.gz.tbi', 'foo.hard_filter.toil.vcf.gz.tbi'])
+        self.config.run_vqsr = self.config.run_oncotator = True
+        self.assertEqual(expected_outputs('foo', self.config)[2:4],
+                         ['foo.vqsr.toil.vcf.gz', 'foo.oncotator.toil.vcf.gz'])
+        self.config.joint_genotype = True
+        self.assertIsNone(expected_outputs('foo', self.config))
+        self.config.preprocess_only = True
+        self.assertIsNone(expected_outputs('foo', self.config))
+        self.config.preprocess = True
+        self.assertEqual(expected_outputs('foo', self.config), ['foo.preprocessed.toil.bam'])
+
+    def test_find_sample_outputs(self):
+        from toil_scripts.gatk_germline.resume import expected_outputs, find_sample_outputs
+        self.assertEqual(find_sample_outputs('foo', self.config), (False, None))
+
+        # GVCFs are not reused until the index is written
+        self._write_outputs('foo', ['foo.toil.g.vcf.gz'])
+        self.assertEqual(find_sample_outputs('foo', self.config), (False, None))
+        self._write_outputs('foo', ['foo.toil.g.vcf.gz.tbi'])
+        complete, gvcf = find_sample_outputs('foo', self.config)
+        self.assertFalse(complete)
+        self.assertEqual(gvcf.vcf_url, os.path.join(self.work_dir, 'foo', 'foo.toil.g.vcf.gz'))
+        self.assertEqual(gvcf.size, 8)
+
+        self._write_outputs('foo', expected_outputs('foo', self.config))
+        self.assertEqual(find_sample_outputs('foo', self.config), (True, None))
+
+        # Joint genotyped samples are never complete, but their GVCFs are reused
+        self.config.joint_genotype = True
+        complete, gvcf = find_sample_outputs('foo', self.config)
+        self.assertFalse(complete)
+        self.assertIsNotNone(gvcf)
@@ -0,0 +1,67 @@
+import gzip
+import os
+import shutil
+import struct
+import tempfile
+from unittest import TestCase
+
+from toil_scripts.gatk_germline.tabix import reg2bin, TabixIndex
+
+
+class TabixTest(TestCase):
+
+    def test_reg2bin(self):
+        self.assertEqual(reg2bin(0, 1), 4681)
+        self.assertEqual(reg2bin(16384, 16385), 4682)
+        # Regions that span a 16 KB window are placed in a larger bin
+        self.assertEqual(reg2bin(16000, 17000), 585)
+        self.assertEqual(reg2bin(0, 1 << 29), 0)
+
+    def test_write(self):
+        index = TabixIndex()
+        index.add('1', 0, 1, 100, 200)
+        index.add('1', 1, 2, 200, 300)
+        index.add('1', 40000, 40001, 300, 400)
+        index.add('2', 10, 20000, 1 << 16, 2 << 16)
+        work_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(work_dir, 'test.vcf.gz.tbi')
+            index.write(path)
+            with gzip.open(path, 'rb') as f:
+                data = f.read()
+        finally:
+            shutil.rmtree(work_dir)
+
+        self.assertEqual(data[:4], 'TBI\x01')
+        n_ref, fmt, col_seq, col_beg, col_end, meta, skip, l_nm = struct.unpack('<8i', data[4:36])
+        self.assertEqual((n_ref, fmt, col_seq, col_beg, col_end, chr(meta), skip), (2, 2, 1, 2, 0, '#', 0))
+        self.assertEqual(data[36:36 + l_nm], '1\x002\x00')
+
+        offset = 36 + l_nm
+        n_bin, = struct.unpack('<i', data[offset:offset + 4])
+        offset += 4
+        bins = {}
+        for _ in range(n_bin):
+            bin_, n_chunk = struct.unpack('<Ii', data[offset:offset + 8])
+            offset += 8
+            bins[bin_] = [struct.unpack('<QQ', data[offset + 16 * i:offset + 16 * i + 16]) for i in range(n_chunk)]
+            offset += 16 * n_chunk
+        # Adjacent records in the same bin share a chunk
+        self.assertEqual(bins, {4681: [(100, 300)], 4683: [(300, 400)]})
+        n_intv, = struct.unpack('<i', data[offset:offset + 4])
+        self.assertEqual(n_intv, 3)
+        # The empty second window points to the previous record
+        self.assertEqual(struct.unpack('<3Q', data[offset + 4:offset + 28]), (100, 100, 300))
+
+    def test_unsorted(self):
+        index = TabixIndex()
+        index.add('1', 10, 11, 100, 200)
+        index.add('1', 10, 12, 200, 300)
+        with self.assertRaises(ValueError):
+            index.add('1', 9, 10, 300, 400)
+        index = TabixIndex()
+        index.add('1', 10, 11, 100, 200)
+        index.add('2', 0, 1, 200, 300)
+        # The records of contig 1 must be together
+        with self.assertRaises(ValueError):
+            index.add('1', 20, 21, 300, 400)
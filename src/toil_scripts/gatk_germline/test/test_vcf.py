@@ -0,0 +1,193 @@
+import os
+import shutil
+from StringIO import StringIO
+import tempfile
+from unittest import TestCase
+
+from toil_scripts.gatk_germline.jexl import compile_expression, compile_vectorized
+from toil_scripts.gatk_germline.vcf import block_columns, chunk_vcf, compress_vcf, concatenate_vcfs, count_records, \
+    filter_stats, hard_filter_vcf, IndexedVcfWriter, merge_sorted_vcfs, open_vcf, record_span, record_values, \
+    split_vcf, split_vcf_by_type, variant_type, variant_types
+
+
+class VCFTest(TestCase):
+
+    def test_record_span(self):
+        self.assertEqual(record_span('1\t100\t.\tACG\tA\t50\t.\tDP=10'.split('\t')), ('1', 99, 102))
+        self.assertEqual(record_span('1\t100\t.\tA\t<NON_REF>\t.\t.\tEND=200\tGT\t0/0'.split('\t')),
+                         ('1', 99, 200))
+
+    def test_split_vcf(self):
+        header = '##fileformat=VCFv4.1\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\n'
+        block = '1\t1\t.\tA\t<NON_REF>\t.\t.\tEND=60\tGT\t0/0\n'
+        snp = '1\t80\t.\tC\tT\t50\t.\tDP=10\tGT\t0/1\n'
+        other = '2\t5\t.\tG\tA\t50\t.\tDP=10\tGT\t0/1\n'
+        unknown = 'GL000192.1\t5\t.\tG\tA\t50\t.\tDP=10\tGT\t0/1\n'
+        shards = [[('1', 0, 50)], [('1', 50, 100), ('2', 0, 10)]]
+        outputs = [StringIO(), StringIO()]
+        counts = split_vcf(StringIO(header + block + snp + other + unknown), outputs, shards)
+        self.assertEqual(counts, [1, 3])
+        self.assertEqual(outputs[0].getvalue(), header + block)
+        self.assertEqual(outputs[1].getvalue(), header + block + snp + other)
+
+    def test_chunk_vcf(self):
+        header = '##fileformat=VCFv4.1\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
+        records = ['1\t%d\t.\tA\tG\t50\t.\t.\n' % pos for pos in xrange(1, 8)]
+        vcf = header + ''.join(records)
+        self.assertEqual(count_records(StringIO(vcf)), 7)
+        outputs = [StringIO(), StringIO(), StringIO()]
+        self.assertEqual(chunk_vcf(StringIO(vcf), outputs, 7), [3, 2, 2])
+        self.assertEqual([output.getvalue() for output in outputs],
+                         [header + ''.join(records[:3]), header + ''.join(records[3:5]),
+                          header + ''.join(records[5:])])
+
+    def test_variant_type(self):
+        self.assertEqual(variant_type('A', ['G']), 'SNP')
+        self.assertEqual(variant_type('A', ['G', 'T']), 'SNP')
+        self.assertEqual(variant_type('AT', ['GC']), 'MNP')
+        self.assertEqual(variant_type('AT', ['A', 'ATT']), 'INDEL')
+        self.assertEqual(variant_type('AT', ['A', 'GT']), 'MIXED')
+        self.assertEqual(variant_type('A', ['<NON_REF>']), 'SYMBOLIC')
+        self.assertEqual(variant_type('A', ['.']), 'NO_VARIATION')
+
+    def test_variant_types(self):
+        alleles = [('A', 'G'), ('A', 'G,T'), ('AT', 'GC'), ('AT', 'A,ATT'), ('AT', 'A,GT'), ('A', '<NON_REF>'),
+                   ('A', 'G[1:10['), ('A', '.'), ('A', 'AT')]
+        self.assertEqual(list(variant_types(*zip(*alleles))),
+                         [variant_type(ref, alts.split(',')) for ref, alts in alleles])
+
+    def test_block_columns(self):
+        block = [line.split('\t') for line in ['1\t10\trs1\tA\tG\t50\t.\tQD=1.5;DB;FS=0.0',
+                                               '1\t20\t.\tA\tG\t.\t.\tQDX=2;FS=',
+                                               '2\t30\t.\tAT\tA\t50\t.\t.',
+                                               '2\t40\t.\tAT\tA\t50\t.\tAQD=3;QD=1e1',
+                                               '2\t50\t.\tA\tG,T\t50\t.\tAF=0.5,0.5;QD=1.0']]
+        types = variant_types([fields[3] for fields in block], [fields[4] for fields in block])
+        records = [record_values(fields, record_type) for fields, record_type in zip(block, types)]
+        for expression in ['QD < 2.0 || DB', 'QD > 5 && CHROM == "2"', 'POS >= 20 && QUAL < 0', 'ID == "rs1"',
+                           'TYPE == "INDEL" && !DB', 'FS == ""', 'QD == "1e1"',
+                           # Multi-valued fields are missing, so the first expression is False
+                           'AF > 0.1 || QD < 2.0', 'QD < 2.0 || AF > 0.1']:
+            match = compile_vectorized(expression)
+            columns = block_columns(block, types, match.variables)
+            self.assertEqual(list(match(columns, len(block))), [compile_expression(expression)(x) for x in records],
+                             msg=expression)
+        self.assertNotIn('AF', records[4])
+        match = compile_vectorized('QD < 2.0 || AF > 0.1')
+        self.assertEqual(list(match(block_columns(block, types, match.variables), len(block))),
+                         [True, False, False, False, True])
+
+    def test_hard_filter_vcf(self):
+        header = '##fileformat=VCFv4.1\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\n'
+        vcf = StringIO(header +
+                       '1\t10\t.\tA\tG\t50\t.\tQD=1.5;FS=0.0\tGT\t0/1\n'
+                       '1\t20\t.\tA\tG\t50\t.\tQD=10.0;FS=0.0\tGT\t0/1\n'
+                       '1\t30\t.\tAT\tA\t50\tLowQual\tQD=1.0;FS=0.0\tGT\t0/1\n'
+                       '1\t40\t.\tAT\tA,GT\t50\t.\tQD=1.0\tGT\t1/2\n'
+                       '1\t50\t.\tAT\tATT\t50\t.\tFS=250.0\tGT\t0/1\n')
+        output = StringIO()
+        counts = hard_filter_vcf(vcf, output, {'SNP': ('SNP_FILTER', '"QD < 2.0 || FS > 60.0"'),
+                                               'INDEL': ('INDEL_FILTER', 'QD < 2.0 || FS > 200.0')},
+                                 block_size=2)
+        self.assertEqual(counts, {'SNP': 2, 'SNP_filtered': 1, 'INDEL': 2, 'INDEL_filtered': 1, 'dropped': 1})
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[1:3], ['##FILTER=<ID=INDEL_FILTER,Description="QD < 2.0 || FS > 200.0">',
+                                      '##FILTER=<ID=SNP_FILTER,Description="QD < 2.0 || FS > 60.0">'])
+        self.assertEqual([line.split('\t')[6] for line in lines[4:]],
+                         ['SNP_FILTER', 'PASS', 'INDEL_FILTER;LowQual', 'PASS'])
+
+        # Multi-valued INFO fields of multiallelic sites are missing values
+        output = StringIO()
+        counts = hard_filter_vcf(StringIO(header + '1\t10\t.\tA\tG,T\t50\t.\tAF=0.5,0.5;QD=1.0\tGT\t1/2\n'
+                                                   '1\t20\t.\tA\tG,T\t50\t.\tAF=0.5,0.5;QD=5.0\tGT\t1/2\n'),
+                                 output, {'SNP': ('SNP_FILTER', 'QD < 2.0 || AF > 0.1'),
+                                          'INDEL': ('INDEL_FILTER', 'QD < 2.0')})
+        self.assertEqual(counts['SNP_filtered'], 1)
+        self.assertEqual([line.split('\t')[6] for line in output.getvalue().splitlines()[-2:]],
+                         ['SNP_FILTER', 'PASS'])
+
+        # CombineVariants set annotation
+        vcf.seek(0)
+        output = StringIO()
+        hard_filter_vcf(vcf, output, {'SNP': ('SNP_FILTER', 'QD < 2.0'), 'INDEL': ('INDEL_FILTER', 'QD < 2.0')},
+                        sources={'SNP': 'variant', 'INDEL': 'variant2'})
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[3], '##INFO=<ID=set,Number=1,Type=String,'
+                                   'Description="Source VCF for the merged record in CombineVariants">')
+        self.assertEqual([line.split('\t')[7] for line in lines[5:]],
+                         ['QD=1.5;FS=0.0;set=filterInvariant', 'QD=10.0;FS=0.0;set=variant',
+                          'QD=1.0;FS=0.0;set=filterInvariant2', 'FS=250.0;set=variant2'])
+
+    def test_filter_stats(self):
+        vcf = StringIO('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
+                       '1\t10\t.\tA\tG\t50\t.\tQD=1.5\n'
+                       '1\t20\t.\tA\tG\t50\t.\tQD=10.0\n'
+                       '1\t30\t.\tAT\tA\t50\t.\tQD=1.0\n')
+        self.assertEqual(filter_stats(vcf, [('SNP', 'QD < 2.0'), ('SNP', 'QD < 20.0'), ('INDEL', 'QD < 2.0')]),
+                         [(2, 1), (2, 2), (1, 1)])
+
+    def test_split_and_merge_by_type(self):
+        header = ('##fileformat=VCFv4.1\n##contig=<ID=1,length=100>\n##contig=<ID=2,length=100>\n'
+                  '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+        records = ['1\t10\t.\tA\tG\t50\t.\t.\n',
+                   '1\t10\t.\tAT\tA\t50\t.\t.\n',
+                   '1\t20\t.\tAT\tA,GT\t50\t.\t.\n',
+                   '2\t5\t.\tA\tG\t50\t.\t.\n',
+                   '2\t7\t.\tA\t<DEL>\t50\t.\t.\n']
+        snps, indels = StringIO(), StringIO()
+        self.assertEqual(split_vcf_by_type(StringIO(header + ''.join(records)), snps, indels), (2, 3))
+
+        work_dir = tempfile.mkdtemp()
+        try:
+            paths = []
+            # Simulate the header lines added by each recalibration
+            for name, output in [('snp', snps), ('indel', indels)]:
+                path = os.path.join(work_dir, name + '.vcf')
+                with open(path, 'w') as f:
+                    f.write(output.getvalue().replace('#CHROM', '##%s=recalibrated\n#CHROM' % name))
+                paths.append(path)
+            merged = StringIO()
+            self.assertEqual(merge_sorted_vcfs(paths, merged), 5)
+            self.assertEqual(merged.getvalue(), header.replace('#CHROM', '##snp=recalibrated\n'
+                                                                         '##indel=recalibrated\n#CHROM')
+                             + ''.join(records))
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_compress_vcf(self):
+        header = '##fileformat=VCFv4.1\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
+        # Enough records to fill several BGZF blocks
+        records = ['%s\t%d\t.\tA\tG\t50\t.\tDP=%d\n' % (contig, pos, pos)
+                   for contig in ('1', '2') for pos in xrange(1, 20000, 2)]
+        work_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(work_dir, 'input.vcf')
+            with open(path, 'w') as f:
+                f.write(header + ''.join(records))
+            compressed = os.path.join(work_dir, 'input.vcf.gz')
+            compress_vcf(path, compressed)
+            self.assertTrue(os.path.getsize(compressed) < os.path.getsize(path))
+            self.assertTrue(os.path.exists(compressed + '.tbi'))
+            with open_vcf(compressed) as f:
+                self.assertEqual(''.join(f), header + ''.join(records))
+
+            # Compressed files are read transparently and writes may split lines
+            later = [record.replace('1\t', '3\t', 1) if record.startswith('1\t') else record.replace('2\t', '4\t', 1)
+                     for record in records]
+            later_path = os.path.join(work_dir, 'later.vcf')
+            with open(later_path, 'w') as f:
+                f.write(header + ''.join(later))
+            output = os.path.join(work_dir, 'output.vcf.gz')
+            with IndexedVcfWriter(output) as f:
+                self.assertEqual(concatenate_vcfs([compressed, later_path], f), 2 * len(records))
+                f.write('5\t1\t.\tA')
+                f.write('\tG\t50\t.\t.\n')
+            with open_vcf(output) as f:
+                self.assertEqual(''.join(f), header + ''.join(records) + ''.join(later) + '5\t1\t.\tA\tG\t50\t.\t.\n')
+
+            # The tabix index requires sorted records
+            with self.assertRaises(ValueError):
+                with IndexedVcfWriter(os.path.join(work_dir, 'unsorted.vcf.gz')) as f:
+                    concatenate_vcfs([compressed, path], f)
+        finally:
+            shutil.rmtree(work_dir)
@@ -0,0 +1,659 @@
+#!/usr/bin/env python2.7
+"""
+Streaming utilities for VCF and GVCF files.
+"""
+from bisect import bisect_right
+from collections import namedtuple
+import heapq
+from operator import itemgetter
+
+import numpy as np
+
+from toil_scripts.gatk_germline.jexl import compile_vectorized
+from toil_scripts.gatk_germline.tabix import TabixIndex
+from toil_scripts.lib.bgzf import BgzfWriter, GzipReader
+
+# Approximate ratio of the uncompressed to the BGZF compressed size of a VCF file. Used to estimate
+# the disk requirement of jobs that decompress a VCF file or write an uncompressed VCF file.
+COMPRESSION_RATIO = 6
+
+# Bytes of INFO and ALT columns. ALT columns with special bytes are multiallelic, symbolic, or missing.
+SEMICOLON, NEWLINE, EQUALS, COMMA = ord(';'), ord('\n'), ord('='), ord(',')
+SPECIAL_ALT_BYTES = np.frombuffer(',<[].', dtype=np.uint8)
+
+# INFO header line of the set field added by GATK CombineVariants
+SET_HEADER = '##INFO=<ID=set,Number=1,Type=String,Description="Source VCF for the merged record in CombineVariants">\n'
+
+
+class IndexedVcf(namedtuple('IndexedVcf', 'vcf tbi')):
+    """
+    FileStoreIDs for a BGZF compressed VCF file and its tabix index
+    """
+    __slots__ = ()
+
+    @property
+    def size(self):
+        return self.vcf.size + self.tbi.size
+
+
+def open_vcf(path):
+    """
+    Opens a VCF file that is either uncompressed or gzip compressed
+
+    :param str path: Path to VCF file
+    :return: Iterable file object over the lines of the VCF file
+    :rtype: file|GzipReader
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(2)
+    if magic == '\x1f\x8b':
+        return GzipReader(path)
+    return open(path, 'r')
+
+
+class IndexedVcfWriter(object):
+    """
+    Writes a BGZF compressed VCF file and builds its tabix index at the same time. The index is
+    written to the same path with a .tbi extension when the writer is closed.
+    """
+
+    def __init__(self, path):
+        """
+        :param str path: Path to the compressed VCF file
+        """
+        self.path = path
+        self._writer = BgzfWriter(path)
+        self._index = TabixIndex()
+        self._partial = ''
+
+    def write(self, data):
+        if self._partial:
+            data = self._partial + data
+            self._partial = ''
+        start = 0
+        while start < len(data):
+            end = data.find('\n', start)
+            if end == -1:
+                self._partial = data[start:]
+                break
+            self._write_line(data[start:end + 1])
+            start = end + 1
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def _write_line(self, line):
+        if line.startswith('#'):
+            self._writer.write(line)
+            return
+        start = self._writer.tell()
+        self._writer.write(line)
+        contig, beg, end = record_span(line.split('\t', 8))
+        self._index.add(contig, beg, end, start, self._writer.tell())
+
+    def close(self):
+        if self._partial:
+            self._write_line(self._partial)
+            self._partial = ''
+        self._writer.close()
+        self._index.write(self.path + '.tbi')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def compress_vcf(vcf, output):
+    """
+    Compresses a VCF file with BGZF and writes its tabix index to output + '.tbi'
+
+    :param str vcf: Path to an uncompressed or gzip compressed VCF file
+    :param str output: Path to the compressed VCF file
+    :return: Number of bytes read from the input VCF
+    :rtype: int
+    """
+    size = 0
+    with open_vcf(vcf) as f, IndexedVcfWriter(output) as g:
+        for line in f:
+            g.write(line)
+            size += len(line)
+    return size
+
+
+def concatenate_vcfs(paths, output):
+    """
+    Concatenates VCF files that cover consecutive, non-overlapping regions of the genome. The header
+    is taken from the first file and records are written in the order the files are given.
+
+    :param list[str] paths: Paths to uncompressed or gzip compressed VCF files in reference order
+    :param file output: Open file handle for the concatenated VCF
+    :return: Number of records written
+    :rtype: int
+    """
+    num_records = 0
+    for i, path in enumerate(paths):
+        with open_vcf(path) as f:
+            for line in f:
+                if line.startswith('#'):
+                    if i == 0:
+                        output.write(line)
+                    continue
+                output.write(line)
+                num_records += 1
+    return num_records
+
+
+def record_span(fields):
+    """
+    Returns the reference span of a VCF record. GVCF reference blocks use the END INFO field.
+
+    :param list[str] fields: Tab separated fields of a VCF record
+    :return: Contig, 0-based start position, and exclusive end position
+    :rtype: tuple(str, int, int)
+    """
+    start = int(fields[1]) - 1
+    end = start + len(fields[3])
+    for entry in fields[7].split(';'):
+        if entry.startswith('END='):
+            end = max(end, int(entry[4:]))
+            break
+    return fields[0], start, end
+
+
+def split_vcf(vcf, outputs, shards):
+    """
+    Splits a VCF file into genomic shards. The header is written to every shard and each record is
+    written to every shard that it overlaps, so GVCF reference blocks that span a shard boundary
+    are present in both shards. Records that do not overlap a shard are dropped.
+
+    :param file vcf: Open file handle for a VCF file
+    :param list[file] outputs: Open file handles for each shard
+    :param list[list[tuple]] shards: List of shards, where each shard is a list of
+                                     sorted, non-overlapping (contig, start, end) tuples
+    :return: Number of records written to each shard
+    :rtype: list[int]
+    """
+    # Build a lookup table of shard intervals for each contig
+    lookup = {}
+    for i, shard in enumerate(shards):
+        for contig, start, end in shard:
+            lookup.setdefault(contig, []).append((start, end, i))
+    starts = {}
+    for contig, entries in lookup.iteritems():
+        entries.sort()
+        starts[contig] = [start for start, _, _ in entries]
+
+    counts = [0] * len(outputs)
+    for line in vcf:
+        if line.startswith('#'):
+            for output in outputs:
+                output.write(line)
+            continue
+        contig, start, end = record_span(line.split('\t', 8))
+        if contig not in lookup:
+            continue
+        entries = lookup[contig]
+        j = max(bisect_right(starts[contig], start) - 1, 0)
+        written = set()
+        while j < len(entries) and entries[j][0] < end:
+            _, shard_end, shard = entries[j]
+            if shard_end > start and shard not in written:
+                outputs[shard].write(line)
+                counts[shard] += 1
+                written.add(shard)
+            j += 1
+    return counts
+
+
+def count_records(vcf):
+    """
+    :param file vcf: Open file handle for a VCF file
+    :return: Number of records in the VCF file
+    :rtype: int
+    """
+    return sum(1 for line in vcf if not line.startswith('#'))
+
+
+def chunk_vcf(vcf, outputs, num_records):
+    """
+    Splits a VCF file into consecutive chunks with the same number of records, give or take one.
+    The header is written to every chunk, so each chunk is a valid VCF file.
+
+    :param file vcf: Open file handle for a VCF file
+    :param list[file] outputs: Open file handles for each chunk
+    :param int num_records: Number of records in the VCF file
+    :return: Number of records written to each chunk
+    :rtype: list[int]
+    """
+    counts = [0] * len(outputs)
+    i = 0
+    for line in vcf:
+        if line.startswith('#'):
+            for output in outputs:
+                output.write(line)
+            continue
+        chunk = min(i * len(outputs) // max(num_records, 1), len(outputs) - 1)
+        outputs[chunk].write(line)
+        counts[chunk] += 1
+        i += 1
+    return counts
+
+
+def variant_type(ref, alts):
+    """
+    Classifies a VCF record using the same rules as htsjdk VariantContext.getType(), which
+    GATK SelectVariants uses to select SNPs and INDELs. Each alternate allele is classified
+    against the reference allele. If the alternate alleles have different types, then the
+    record is MIXED.
+
+    :param str ref: Reference allele
+    :param list[str] alts: Alternate alleles
+    :return: NO_VARIATION, SNP, MNP, INDEL, SYMBOLIC, or MIXED
+    :rtype: str
+    """
+    record_type = None
+    for alt in alts:
+        if alt == '.':
+            continue
+        if alt.startswith('<') or '[' in alt or ']' in alt:
+            allele_type = 'SYMBOLIC'
+        elif len(alt) == len(ref):
+            allele_type = 'SNP' if len(alt) == 1 else 'MNP'
+        else:
+            allele_type = 'INDEL'
+        if record_type is None:
+            record_type = allele_type
+        elif record_type != allele_type:
+            return 'MIXED'
+    return record_type or 'NO_VARIATION'
+
+
+def variant_types(refs, alts):
+    """
+    Classifies a block of VCF records with the same rules as variant_type. Records with one
+    alternate allele are classified by comparing allele lengths with NumPy. Records with several,
+    symbolic, or missing alternate alleles are classified with variant_type.
+
+    :param list[str] refs: Reference allele of each record
+    :param list[str] alts: ALT column of each record
+    :return: Variant type of each record
+    :rtype: np.array
+    """
+    ref_lengths = np.fromiter(map(len, refs), dtype=np.int64, count=len(refs))
+    alt_lengths = np.fromiter(map(len, alts), dtype=np.int64, count=len(alts))
+    types = np.where(alt_lengths == ref_lengths, np.where(alt_lengths == 1, 'SNP', 'MNP'), 'INDEL').astype('S12')
+    data, newlines = _text_bytes(alts)
+    for i in np.unique(np.searchsorted(newlines, np.flatnonzero(np.in1d(data, SPECIAL_ALT_BYTES)))):
+        types[i] = variant_type(refs[i], alts[i].split(','))
+    return types
+
+
+def record_values(fields, record_type):
+    """
+    Returns the values that a filter expression can reference for a VCF record. INFO fields are
+    stored as strings and INFO flags are stored as True. INFO fields with several values, such as
+    the AF of a multiallelic site, are left out, so they are missing values that make an expression
+    that reaches them evaluate to False instead of failing to convert to a number.
+
+    :param list[str] fields: Tab separated fields of a VCF record
+    :param str record_type: Variant type from variant_type
+    :return: Dictionary of record values {name: value}
+    :rtype: dict
+    """
+    values = {}
+    if fields[7] != '.':
+        for entry in fields[7].split(';'):
+            key, _, value = entry.partition('=')
+            if ',' not in value:
+                values[key] = value if _ else True
+    values['CHROM'] = fields[0]
+    values['POS'] = int(fields[1])
+    values['ID'] = fields[2]
+    # htsjdk reports a missing QUAL as -10.0
+    values['QUAL'] = float(fields[5]) if fields[5] != '.' else -10.0
+    values['TYPE'] = record_type
+    return values
+
+
+def block_columns(block, types, names):
+    """
+    Builds the columns of record values that filter expressions reference for a block of VCF
+    records. The values are the same as the values from record_values. Only the referenced INFO
+    fields are extracted, by searching the bytes of the INFO column of the whole block with NumPy.
+    INFO fields that are flags in every record are boolean columns, and other INFO fields are
+    string columns. A flag in a string column is stored as '1', and missing values are stored as
+    'nan', so that string columns convert to numbers. INFO fields with several values are missing.
+
+    :param list[list[str]] block: Fields of each VCF record
+    :param np.array types: Variant type of each record from variant_types
+    :param iterable[str] names: Names of the columns
+    :return: Dictionary of columns {name: (values, present)}, where present is a boolean array
+             that is False for records that do not define the value
+    :rtype: dict
+    """
+    columns = {}
+    everywhere = np.ones(len(block), dtype=bool)
+    info = None
+    for name in names:
+        if name in ('CHROM', 'ID'):
+            columns[name] = np.array(map(itemgetter(0 if name == 'CHROM' else 2), block), dtype=str), everywhere
+        elif name == 'POS':
+            columns[name] = np.array(map(itemgetter(1), block), dtype=str).astype(float), everywhere
+        elif name == 'QUAL':
+            # htsjdk reports a missing QUAL as -10.0
+            qual = np.array(map(itemgetter(5), block), dtype=str)
+            columns[name] = np.where(qual == '.', '-10.0', qual).astype(float), everywhere
+        elif name == 'TYPE':
+            columns[name] = types, everywhere
+        else:
+            if info is None:
+                # Each INFO column starts with a separator, so every field follows a separator
+                data, newlines = _text_bytes([';' + x for x in map(itemgetter(7), block)])
+                separators = np.flatnonzero((data == SEMICOLON) | (data == NEWLINE))
+                info = data, newlines, separators, separators[data[separators] == SEMICOLON] + 1
+            columns[name] = _info_column(info, name)
+    return columns
+
+
+def _text_bytes(lines):
+    """
+    :param list[str] lines: Lines of text
+    :return: Bytes of the lines, each followed by a newline, and the positions of the newlines
+    :rtype: tuple(np.array, np.array)
+    """
+    data = np.frombuffer('\n'.join(lines) + '\n', dtype=np.uint8)
+    return data, np.flatnonzero(data == NEWLINE)
+
+
+def _info_column(info, name):
+    """
+    :param tuple info: Bytes of the INFO columns of a block from _text_bytes, the positions of
+                       their newlines, the positions of their field separators and newlines, and
+                       the start of each field
+    :param str name: INFO field
+    :return: Column of the INFO field (values, present)
+    :rtype: tuple(np.array, np.array)
+    """
+    data, newlines, separators, starts = info
+    # Fields that start with the key and continue with a value, a separator, or a newline. The
+    # candidates are narrowed one byte of the key at a time. The bytes end with a newline, which
+    # never matches the key, so the positions stay within the bytes.
+    for i, byte in enumerate(bytearray(name)):
+        starts = starts[data[starts + i] == byte]
+    following = data[starts + len(name)]
+    has_value = following == EQUALS
+    is_flag = (following == SEMICOLON) | (following == NEWLINE)
+    records = np.searchsorted(newlines, starts)
+
+    present = np.zeros(len(newlines), dtype=bool)
+    present[records[has_value | is_flag]] = True
+    if not has_value.any():
+        return present, present
+    value_starts = starts[has_value] + len(name) + 1
+    value_ends = separators[np.searchsorted(separators, value_starts)]
+    # Copies the values into a fixed width string array, padded with null bytes
+    width = max(int((value_ends - value_starts).max()), 3)
+    positions = value_starts[:, np.newaxis] + np.arange(width)
+    padded = np.where(positions < value_ends[:, np.newaxis], data[np.minimum(positions, len(data) - 1)], 0)
+    # Values with several comma separated values are missing
+    single = ~(padded == COMMA).any(axis=1)
+    present[records[has_value][~single]] = False
+    values = np.empty(len(newlines), dtype='S%d' % width)
+    values[:] = 'nan'
+    values[records[is_flag]] = '1'
+    values[records[has_value][single]] = padded[single].astype(np.uint8).view('S%d' % width).ravel()
+    return values, present
+
+
+def _select(columns, selected):
+    """
+    :param dict columns: Dictionary of columns {name: (values, present)}
+    :param np.array selected: Boolean array of the records to select
+    :return: Columns of the selected records
+    :rtype: dict
+    """
+    return {name: (values[selected], present[selected]) for name, (values, present) in columns.iteritems()}
+
+
+def apply_filter(filter_field, filter_name, matched):
+    """
+    Updates the FILTER column of a VCF record using GATK VariantFiltration semantics. Records
+    that match the filter expression have the filter name added to their existing filters.
+    Unfiltered records that do not match are marked PASS.
+
+    :param str filter_field: FILTER column of a VCF record
+    :param str filter_name: Name of the filter
+    :param bool matched: True if the record matched the filter expression
+    :return: Updated FILTER column
+    :rtype: str
+    """
+    filters = set(x for x in filter_field.split(';') if x not in ('.', 'PASS', ''))
+    if matched:
+        filters.add(filter_name)
+    return ';'.join(sorted(filters)) if filters else 'PASS'
+
+
+def add_set_annotation(info, source, filtered):
+    """
+    Adds the set INFO field that GATK CombineVariants adds to records merged from a single source.
+    GATK writes INFO fields in sorted order, so the lowercase set field follows the GATK
+    annotations.
+
+    :param str info: INFO column of a VCF record
+    :param str source: Name of the CombineVariants source of the record
+    :param bool filtered: True if the record is filtered
+    :return: Updated INFO column
+    :rtype: str
+    """
+    value = 'set=%s%s' % ('filterIn' if filtered else '', source)
+    return value if info in ('.', '') else info + ';' + value
+
+
+def split_vcf_by_type(vcf, snp_output, indel_output):
+    """
+    Splits a VCF file into the records recalibrated by GATK ApplyRecalibration in SNP mode and
+    the records recalibrated in INDEL mode. SNP mode recalibrates SNPs and MNPs and INDEL mode
+    recalibrates INDELs, MIXED, and symbolic records. Records without variation are written to
+    the SNP output, because neither mode changes them. The header is written to both outputs.
+
+    :param file vcf: Open file handle for a VCF file
+    :param file snp_output: Open file handle for the SNP VCF file
+    :param file indel_output: Open file handle for the INDEL VCF file
+    :return: Number of records written to the SNP and INDEL outputs
+    :rtype: tuple(int, int)
+    """
+    num_snps = num_indels = 0
+    for line in vcf:
+        if line.startswith('#'):
+            snp_output.write(line)
+            indel_output.write(line)
+            continue
+        fields = line.split('\t', 5)
+        if variant_type(fields[3], fields[4].split(',')) in ('INDEL', 'MIXED', 'SYMBOLIC'):
+            indel_output.write(line)
+            num_indels += 1
+        else:
+            snp_output.write(line)
+            num_snps += 1
+    return num_snps, num_indels
+
+
+def merge_sorted_vcfs(paths, output):
+    """
+    Merges coordinate sorted VCF files into a single coordinate sorted VCF file. The header is
+    taken from the first file, and header lines that only appear in later files are added before
+    the column header line. Contigs are ordered by the ##contig header lines, or by the order
+    they first appear in the files if the header does not list them. Records at the same position
+    are written in the order the files are given.
+
+    :param list[str] paths: Paths to uncompressed or gzip compressed, coordinate sorted VCF files
+    :param file output: Open file handle for the merged VCF
+    :return: Number of records written
+    :rtype: int
+    """
+    headers = []
+    for path in paths:
+        lines = []
+        with open_vcf(path) as f:
+            for line in f:
+                if not line.startswith('#'):
+                    break
+                lines.append(line)
+        headers.append(lines)
+
+    header = [line for line in headers[0] if not line.startswith('#CHROM')]
+    for lines in headers[1:]:
+        header.extend(line for line in lines if line not in header and not line.startswith('#CHROM'))
+    header.extend(line for line in headers[0] if line.startswith('#CHROM'))
+    output.writelines(header)
+
+    contigs = {}
+    for line in header:
+        if line.startswith('##contig=<'):
+            for field in line.rstrip('>\n')[len('##contig=<'):].split(','):
+                if field.startswith('ID='):
+                    contigs.setdefault(field[3:], len(contigs))
+
+    def records(handle, index):
+        for i, line in enumerate(handle):
+            if line.startswith('#'):
+                continue
+            contig, position, _ = line.split('\t', 2)
+            yield contigs.setdefault(contig, len(contigs)), int(position), index, i, line
+
+    handles = [open_vcf(path) for path in paths]
+    num_records = 0
+    try:
+        for _, _, _, _, line in heapq.merge(*[records(handle, i) for i, handle in enumerate(handles)]):
+            output.write(line)
+            num_records += 1
+    finally:
+        for handle in handles:
+            handle.close()
+    return num_records
+
+
+def read_blocks(vcf, block_size):
+    """
+    Reads VCF records in blocks. Header lines are returned as single line blocks.
+
+    :param file vcf: Open file handle for a VCF file
+    :param int block_size: Maximum number of records in each block
+    :return: Iterator of (header line, None) or (None, list of record fields) tuples
+    :rtype: iterator
+    """
+    block = []
+    for line in vcf:
+        if line.startswith('#'):
+            yield line, None
+            continue
+        block.append(line.rstrip('\n').split('\t'))
+        if len(block) == block_size:
+            yield None, block
+            block = []
+    if block:
+        yield None, block
+
+
+def evaluate_block(block, matchers):
+    """
+    Classifies a block of VCF records and evaluates the filter expression for each record's type
+
+    :param list[list[str]] block: Fields of each VCF record
+    :param dict matchers: Dictionary of vectorized filter expressions {variant type: function}
+    :return: Variant type of each record and a boolean array that is True for records that
+             match the filter expression for their type
+    :rtype: tuple(np.array, np.array)
+    """
+    types = variant_types(map(itemgetter(3), block), map(itemgetter(4), block))
+    columns = block_columns(block, types, set().union(*[match.variables for match in matchers.itervalues()]))
+    matched = np.zeros(len(block), dtype=bool)
+    for record_type, match in matchers.iteritems():
+        selected = types == record_type
+        if selected.any():
+            matched[selected] = match(_select(columns, selected), selected.sum())
+    return types, matched
+
+
+def hard_filter_vcf(vcf, output, filters, sources=None, block_size=50000):
+    """
+    Streams a VCF file once, keeping the variant types that have a filter and applying the filter
+    expression for each record's type. This reproduces GATK SelectVariants, VariantFiltration,
+    and CombineVariants for a single sample VCF in one pass: records of any other type, such as
+    MIXED or MNP records, are dropped, and a FILTER header line is added for each filter.
+    Filter expressions are evaluated over blocks of records using NumPy.
+
+    If sources is given, then each record is annotated with the CombineVariants set INFO field:
+    the source name of its type, prefixed with filterIn if the record is filtered. GATK header
+    lines, such as GATKCommandLine lines, are not written.
+
+    :param file vcf: Open file handle for the input VCF file
+    :param file output: Open file handle for the filtered VCF file
+    :param dict filters: Dictionary of filters {variant type: (filter name, filter expression)}
+    :param dict sources: Dictionary of CombineVariants source names {variant type: name} or None
+    :param int block_size: Number of records evaluated at once
+    :return: Dictionary of record counts {'<TYPE>': records kept, '<TYPE>_filtered': records
+             that matched the filter, 'dropped': records of other types}
+    :rtype: dict
+    """
+    matchers = {}
+    counts = {'dropped': 0}
+    for record_type, (name, expression) in filters.iteritems():
+        matchers[record_type] = compile_vectorized(expression)
+        counts[record_type] = 0
+        counts[record_type + '_filtered'] = 0
+
+    for line, block in read_blocks(vcf, block_size):
+        if line is not None:
+            if line.startswith('#CHROM'):
+                for record_type in sorted(filters):
+                    name, expression = filters[record_type]
+                    output.write('##FILTER=<ID=%s,Description="%s">\n' % (name, expression.strip().strip('"\'')))
+                if sources:
+                    output.write(SET_HEADER)
+            output.write(line)
+            continue
+
+        types, matched = evaluate_block(block, matchers)
+        for fields, record_type, record_matched in zip(block, types, matched):
+            if record_type not in matchers:
+                counts['dropped'] += 1
+                continue
+            fields[6] = apply_filter(fields[6], filters[record_type][0], record_matched)
+            if sources:
+                fields[7] = add_set_annotation(fields[7], sources[record_type], fields[6] != 'PASS')
+            output.write('\t'.join(fields) + '\n')
+            counts[record_type] += 1
+            if record_matched:
+                counts[record_type + '_filtered'] += 1
+    return counts
+
+
+def filter_stats(vcf, expressions, block_size=50000):
+    """
+    Counts the records that match each filter expression without writing a filtered VCF. This
+    is used to tune hard filter thresholds on a genotyped VCF.
+
+    :param file vcf: Open file handle for a VCF file
+    :param list[tuple] expressions: List of (variant type, filter expression) tuples
+    :param int block_size: Number of records evaluated at once
+    :return: List of (records of the variant type, records that match the expression) tuples
+             in the same order as the expressions
+    :rtype: list[tuple]
+    """
+    matchers = [(record_type, compile_vectorized(expression)) for record_type, expression in expressions]
+    names = set().union(*[match.variables for _, match in matchers])
+    totals = [[0, 0] for _ in expressions]
+    for _, block in read_blocks(vcf, block_size):
+        if block is None:
+            continue
+        types = variant_types(map(itemgetter(3), block), map(itemgetter(4), block))
+        columns = block_columns(block, types, names)
+        for total, (record_type, match) in zip(totals, matchers):
+            selected = types == record_type
+            total[0] += int(selected.sum())
+            total[1] += int(match(_select(columns, selected), selected.sum()).sum())
+    return [tuple(total) for total in totals]
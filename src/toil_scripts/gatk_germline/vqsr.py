@@ -3,26 +3,40 @@ from __future__ import print_function
 import os
 
 from toil.job import PromisedRequirement
-from toil_lib.tools.variant_manipulation import gatk_variant_recalibrator, \
-    gatk_apply_variant_recalibration
 
-from toil_scripts.gatk_germline.common import output_file_job
+from toil_scripts.gatk_germline.common import compress_vcf_job, decompress_vcf_job, gatk_call, IndexedVcfOutput, \
+    OUTPUT_DISK, output_vcf_job, vcf_output_disk
+from toil_scripts.gatk_germline.resources import profiled_job, scaled_resources
+from toil_scripts.gatk_germline.vcf import COMPRESSION_RATIO, merge_sorted_vcfs, open_vcf, split_vcf_by_type
 
 
 def vqsr_pipeline(job, uuid, vcf_id, config):
     """
     Runs GATK Variant Quality Score Recalibration.
 
-    0: Start                        0 --> 1 --> 3 --> 4 --> 5
+    0: Decompress VCF               0 --> 1 --> 3 --> 4 --> 5 --> 6
     1: Recalibrate SNPs                   |      |
     2: Recalibrate INDELS                 +-> 2 -+
     3: Apply SNP Recalibration
     4: Apply INDEL Recalibration
-    5: Write VCF to output directory
+    5: Compress and index VCF
+    6: Write VCF to output directory
+
+    If config.concurrent_apply_recal is True, then the VCF is split by variant type and the SNP
+    and INDEL recalibrations are applied at the same time to their own variant types:
+
+    0: Decompress VCF               0 --> 1 --> 4 --> 6 --> 7
+    1: Recalibrate SNPs                   |     |     |
+    2: Recalibrate INDELS                 +---> 3 --> 5
+    3: Split VCF by variant type          |           |
+    4: Apply SNP Recalibration            +---> 2 ----+
+    5: Apply INDEL Recalibration
+    6: Merge SNP and INDEL VCFs into a compressed and indexed VCF
+    7: Write VCF to output directory
 
     :param JobFunctionWrappingJob job: passed automatically by Toil
     :param str uuid: unique sample identifier
-    :param str vcf_id: VCF FileStoreID
+    :param IndexedVcf vcf_id: Compressed VCF FileStoreIDs
     :param Namespace config: Pipeline configuration options and shared files
         Requires the following config attributes:
         config.genome_fasta             FilesStoreID for reference genome fasta file
@@ -33,6 +47,7 @@ def vqsr_pipeline(job, uuid, vcf_id, config):
         config.suffix                   Suffix for output filename
         config.output_dir               URL or local path to output directory
         config.ssec                     Path to key file for SSE-C encryption
+        config.concurrent_apply_recal   If True, then apply SNP and INDEL recalibration concurrently
 
         SNP VQSR attributes:
         config.snp_filter_annotations   List of GATK variant annotations
@@ -45,13 +60,25 @@ def vqsr_pipeline(job, uuid, vcf_id, config):
         config.indel_filter_annotations List of GATK variant annotations
         config.dbsnp                    FileStoreID for dbSNP resource file
         config.mills                    FileStoreID for Mills resource file
+        config.resource_model           ResourceModel for job requirements or None
+        config.resource_limits          ResourceLimits for scaled job requirements or None
+        config.reference_cache          ReferenceCache for the node-local reference cache or None
 
-    :return: SNP and INDEL VQSR VCF FileStoreID
-    :rtype: str
+    :return: SNP and INDEL VQSR VCF FileStoreIDs
+    :rtype: IndexedVcf
     """
     # Get the total size of the genome reference
     genome_ref_size = config.genome_fasta.size + config.genome_fai.size + config.genome_dict.size
 
+    # GATK VariantRecalibrator and ApplyRecalibration read uncompressed VCF files
+    compressed_vcf = vcf_id
+    decompress = profiled_job(config.resource_model, decompress_vcf_job,
+                              compressed_vcf,
+                              disk=PromisedRequirement(lambda vcf: (COMPRESSION_RATIO + 1) * vcf.size,
+                                                       compressed_vcf))
+    job.addChild(decompress)
+    vcf_id = decompress.rv()
+
     # The VariantRecalibator disk requirement depends on the input VCF, the resource files,
     # the genome reference files, and the output recalibration table, tranche file, and plots.
     # The sum of these output files are less than the input VCF.
@@ -63,21 +90,21 @@ def vqsr_pipeline(job, uuid, vcf_id, config):
                                          genome_ref_size,
                                          snp_resource_size)
 
-    snp_recal = job.wrapJobFn(gatk_variant_recalibrator,
-                              'SNP',
-                              vcf_id,
-                              config.genome_fasta,
-                              config.genome_fai,
-                              config.genome_dict,
-                              get_short_annotations(config.snp_filter_annotations),
-                              hapmap=config.hapmap,
-                              omni=config.omni,
-                              phase=config.g1k_snp,
-                              dbsnp=config.dbsnp,
-                              unsafe_mode=config.unsafe_mode,
-                              disk=snp_recal_disk,
-                              cores=config.cores,
-                              memory=config.xmx)
+    snp_recal = profiled_job(config.resource_model, gatk_variant_recalibrator,
+                             'SNP',
+                             vcf_id,
+                             config.genome_fasta,
+                             config.genome_fai,
+                             config.genome_dict,
+                             get_short_annotations(config.snp_filter_annotations),
+                             hapmap=config.hapmap,
+                             omni=config.omni,
+                             phase=config.g1k_snp,
+                             dbsnp=config.dbsnp,
+                             unsafe_mode=config.unsafe_mode,
+                             reference_cache=config.reference_cache,
+                             disk=snp_recal_disk,
+                             **scaled_resources(config, 'variant_recalibrator', vcf_id))
 
     indel_resource_size = config.mills.size + config.dbsnp.size
     indel_recal_disk = PromisedRequirement(lambda in_vcf, ref_size, resource_size:
@@ -86,19 +113,31 @@ def vqsr_pipeline(job, uuid, vcf_id, config):
                                            genome_ref_size,
                                            indel_resource_size)
 
-    indel_recal = job.wrapJobFn(gatk_variant_recalibrator,
-                                'INDEL',
-                                vcf_id,
-                                config.genome_fasta,
-                                config.genome_fai,
-                                config.genome_dict,
-                                get_short_annotations(config.indel_filter_annotations),
-                                dbsnp=config.dbsnp,
-                                mills=config.mills,
-                                unsafe_mode=config.unsafe_mode,
-                                disk=indel_recal_disk,
-                                cores=config.cores,
-                                memory=config.xmx)
+    indel_recal = profiled_job(config.resource_model, gatk_variant_recalibrator,
+                               'INDEL',
+                               vcf_id,
+                               config.genome_fasta,
+                               config.genome_fai,
+                               config.genome_dict,
+                               get_short_annotations(config.indel_filter_annotations),
+                               dbsnp=config.dbsnp,
+                               mills=config.mills,
+                               unsafe_mode=config.unsafe_mode,
+                               reference_cache=config.reference_cache,
+                               disk=indel_recal_disk,
+                               **scaled_resources(config, 'variant_recalibrator', vcf_id))
+
+    # Split the VCF into the records recalibrated by each mode, so the SNP and INDEL
+    # recalibrations can be applied independently. The split VCFs are the same size as the input VCF.
+    if config.concurrent_apply_recal:
+        split_vcf = profiled_job(config.resource_model, split_vcf_by_type_job,
+                                 compressed_vcf,
+                                 disk=PromisedRequirement(lambda in_vcf: (COMPRESSION_RATIO + 1) * in_vcf.size,
+                                                          compressed_vcf))
+        snp_vcf = split_vcf.rv(0)
+        indel_vcf = split_vcf.rv(1)
+    else:
+        snp_vcf = vcf_id
 
     # The ApplyRecalibration disk requirement depends on the input VCF size, the variant
     # recalibration table, the tranche file, the genome reference file, and the output VCF.
@@ -106,60 +145,126 @@ def vqsr_pipeline(job, uuid, vcf_id, config):
     # than the input file. Estimate a 10% increase in the VCF file size.
     apply_snp_recal_disk = PromisedRequirement(lambda in_vcf, recal, tranche, ref_size:
                                                int(2.1 * in_vcf.size + recal.size + tranche.size + ref_size),
-                                               vcf_id,
+                                               snp_vcf,
                                                snp_recal.rv(0),
                                                snp_recal.rv(1),
                                                genome_ref_size)
 
-    apply_snp_recal = job.wrapJobFn(gatk_apply_variant_recalibration,
-                                    'SNP',
-                                    vcf_id,
-                                    snp_recal.rv(0), snp_recal.rv(1),
-                                    config.genome_fasta,
-                                    config.genome_fai,
-                                    config.genome_dict,
-                                    unsafe_mode=config.unsafe_mode,
-                                    disk=apply_snp_recal_disk,
-                                    cores=config.cores,
-                                    memory=config.xmx)
+    apply_snp_recal = profiled_job(config.resource_model, gatk_apply_variant_recalibration,
+                                   'SNP',
+                                   snp_vcf,
+                                   snp_recal.rv(0), snp_recal.rv(1),
+                                   config.genome_fasta,
+                                   config.genome_fai,
+                                   config.genome_dict,
+                                   unsafe_mode=config.unsafe_mode,
+                                   reference_cache=config.reference_cache,
+                                   disk=apply_snp_recal_disk,
+                                   **scaled_resources(config, 'apply_recalibration', snp_vcf))
+
+    # Without splitting, the INDEL recalibration is applied to the SNP recalibrated VCF
+    if not config.concurrent_apply_recal:
+        indel_vcf = apply_snp_recal.rv()
 
     apply_indel_recal_disk = PromisedRequirement(lambda in_vcf, recal, tranche, ref_size:
                                                  int(2.1 * in_vcf.size + recal.size + tranche.size + ref_size),
-                                                 vcf_id,
+                                                 indel_vcf,
                                                  indel_recal.rv(0),
                                                  indel_recal.rv(1),
                                                  genome_ref_size)
 
-    apply_indel_recal = job.wrapJobFn(gatk_apply_variant_recalibration,
-                                      'INDEL',
-                                      apply_snp_recal.rv(),
-                                      indel_recal.rv(0), indel_recal.rv(1),
-                                      config.genome_fasta,
-                                      config.genome_fai,
-                                      config.genome_dict,
-                                      unsafe_mode=config.unsafe_mode,
-                                      disk=apply_indel_recal_disk,
-                                      cores=config.cores,
-                                      memory=config.xmx)
-
-    job.addChild(snp_recal)
-    job.addChild(indel_recal)
+    apply_indel_recal = profiled_job(config.resource_model, gatk_apply_variant_recalibration,
+                                     'INDEL',
+                                     indel_vcf,
+                                     indel_recal.rv(0), indel_recal.rv(1),
+                                     config.genome_fasta,
+                                     config.genome_fai,
+                                     config.genome_dict,
+                                     unsafe_mode=config.unsafe_mode,
+                                     reference_cache=config.reference_cache,
+                                     disk=apply_indel_recal_disk,
+                                     **scaled_resources(config, 'apply_recalibration', indel_vcf))
+
+    decompress.addChild(snp_recal)
+    decompress.addChild(indel_recal)
     snp_recal.addChild(apply_snp_recal)
     indel_recal.addChild(apply_indel_recal)
-    apply_snp_recal.addChild(apply_indel_recal)
+
+    if config.concurrent_apply_recal:
+        job.addChild(split_vcf)
+        split_vcf.addChild(apply_snp_recal)
+        split_vcf.addChild(apply_indel_recal)
+
+        # The merge disk requirement depends on the SNP and INDEL VCFs and the merged VCF. The
+        # merged VCF is compressed, so it is smaller than the input files.
+        recal_vcf = profiled_job(config.resource_model, merge_vcfs_job,
+                                 [apply_snp_recal.rv(), apply_indel_recal.rv()],
+                                 disk=PromisedRequirement(lambda vcf1, vcf2: vcf1.size + vcf2.size + vcf_output_disk(
+                                                              (vcf1.size + vcf2.size) / COMPRESSION_RATIO),
+                                                          apply_snp_recal.rv(),
+                                                          apply_indel_recal.rv()))
+        apply_snp_recal.addChild(recal_vcf)
+        apply_indel_recal.addChild(recal_vcf)
+    else:
+        apply_snp_recal.addChild(apply_indel_recal)
+        recal_vcf = profiled_job(config.resource_model, compress_vcf_job,
+                                 apply_indel_recal.rv(),
+                                 disk=PromisedRequirement(lambda x: 2 * x.size, apply_indel_recal.rv()))
+        apply_indel_recal.addChild(recal_vcf)
 
     # Output recalibrated VCF
     output_dir = config.output_dir
     output_dir = os.path.join(output_dir, uuid)
-    vqsr_name = '%s.vqsr%s.vcf' % (uuid, config.suffix)
-    output_vqsr = job.wrapJobFn(output_file_job,
+    vqsr_name = '%s.vqsr%s.vcf.gz' % (uuid, config.suffix)
+    output_vqsr = job.wrapJobFn(output_vcf_job,
                                 vqsr_name,
-                                apply_indel_recal.rv(),
+                                recal_vcf.rv(),
                                 output_dir,
                                 s3_key_path=config.ssec,
-                                disk=PromisedRequirement(lambda x: x.size, apply_indel_recal.rv()))
-    apply_indel_recal.addChild(output_vqsr)
-    return apply_indel_recal.rv()
+                                disk=OUTPUT_DISK)
+    recal_vcf.addChild(output_vqsr)
+    return recal_vcf.rv()
+
+
+def split_vcf_by_type_job(job, vcf_id):
+    """
+    Splits a VCF file into the records recalibrated by ApplyRecalibration in SNP mode and in INDEL mode
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param IndexedVcf vcf_id: Compressed VCF FileStoreIDs
+    :return: Uncompressed SNP and INDEL VCF FileStoreIDs
+    :rtype: tuple
+    """
+    work_dir = job.fileStore.getLocalTempDir()
+    vcf_path = job.fileStore.readGlobalFile(vcf_id.vcf, os.path.join(work_dir, 'input.vcf.gz'))
+    snp_path = os.path.join(work_dir, 'snp.vcf')
+    indel_path = os.path.join(work_dir, 'indel.vcf')
+    with open_vcf(vcf_path) as f, open(snp_path, 'w') as snps, open(indel_path, 'w') as indels:
+        num_snps, num_indels = split_vcf_by_type(f, snps, indels)
+    job.fileStore.logToMaster('Split VCF into {} SNP and {} INDEL records for recalibration'.format(num_snps,
+                                                                                                   num_indels))
+    return job.fileStore.writeGlobalFile(snp_path), job.fileStore.writeGlobalFile(indel_path)
+
+
+def merge_vcfs_job(job, vcf_ids):
+    """
+    Merges coordinate sorted VCF files into a single compressed and indexed VCF file
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param list[str] vcf_ids: VCF FileStoreIDs
+    :return: Merged VCF FileStoreIDs
+    :rtype: IndexedVcf
+    """
+    work_dir = job.fileStore.getLocalTempDir()
+    paths = [job.fileStore.readGlobalFile(vcf_id, os.path.join(work_dir, 'input.%d.vcf' % i))
+             for i, vcf_id in enumerate(vcf_ids)]
+    # The inputs are uncompressed, so the output is about COMPRESSION_RATIO times smaller
+    output = IndexedVcfOutput(job, os.path.join(work_dir, 'merged.vcf.gz'),
+                              sum(vcf_id.size for vcf_id in vcf_ids) / COMPRESSION_RATIO)
+    with output as f:
+        num_records = merge_sorted_vcfs(paths, f)
+    job.fileStore.logToMaster('Merged {} records from {} VCF files'.format(num_records, len(paths)))
+    return output.ids
 
 
 def get_short_annotations(annotations):
@@ -183,3 +288,158 @@ def get_short_annotations(annotations):
             annotation = short_name[annotation]
         short_annotations.append(annotation)
     return short_annotations
+
+
+def gatk_variant_recalibrator(job,
+                              mode,
+                              vcf,
+                              ref_fasta, ref_fai, ref_dict,
+                              annotations,
+                              hapmap=None, omni=None, phase=None, dbsnp=None, mills=None,
+                              max_gaussians=4,
+                              unsafe_mode=False,
+                              reference_cache=None):
+    """
+    Runs either SNP or INDEL variant quality score recalibration using GATK VariantRecalibrator. Because the VQSR method
+    models SNPs and INDELs differently, VQSR must be run separately for these variant types.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param str mode: Determines variant recalibration mode (SNP or INDEL)
+    :param str vcf: FileStoreID for input VCF file
+    :param str ref_fasta: FileStoreID for reference genome fasta
+    :param str ref_fai: FileStoreID for reference genome index file
+    :param str ref_dict: FileStoreID for reference genome sequence dictionary file
+    :param list[str] annotations: List of GATK variant annotations to filter on
+    :param str hapmap: FileStoreID for HapMap resource file, required for SNP VQSR
+    :param str omni: FileStoreID for Omni resource file, required for SNP VQSR
+    :param str phase: FileStoreID for 1000G resource file, required for SNP VQSR
+    :param str dbsnp: FilesStoreID for dbSNP resource file, required for SNP and INDEL VQSR
+    :param str mills: FileStoreID for Mills resource file, required for INDEL VQSR
+    :param int max_gaussians: Number of Gaussians used during training, default is 4
+    :param bool unsafe_mode: If True, runs gatk UNSAFE mode: "-U ALLOW_SEQ_DICT_INCOMPATIBILITY"
+    :param ReferenceCache reference_cache: Node-local reference cache configuration, default is None
+    :return: FileStoreID for the variant recalibration table, tranche file, and plots file
+    :rtype: tuple
+    """
+    mode = mode.upper()
+
+    # The resource files are the same for every sample, so they are localized through the reference cache
+    resources = {}
+
+    # Refer to GATK documentation for description of recommended parameters:
+    # https://software.broadinstitute.org/gatk/documentation/article?id=1259
+    # https://software.broadinstitute.org/gatk/documentation/article?id=2805
+
+    # This base command includes parameters for both INDEL and SNP VQSR.
+    command = ['-T', 'VariantRecalibrator',
+               '-R', 'genome.fa',
+               '-input', 'input.vcf',
+               '-tranche', '100.0',
+               '-tranche', '99.9',
+               '-tranche', '99.0',
+               '-tranche', '90.0',
+               '--maxGaussians', str(max_gaussians),
+               '-recalFile', 'output.recal',
+               '-tranchesFile', 'output.tranches',
+               '-rscriptFile', 'output.plots.R']
+
+    # Parameters and resource files for SNP VQSR.
+    if mode == 'SNP':
+        command.extend(
+            ['-resource:hapmap,known=false,training=true,truth=true,prior=15.0', 'hapmap.vcf',
+             '-resource:omni,known=false,training=true,truth=true,prior=12.0', 'omni.vcf',
+             '-resource:dbsnp,known=true,training=false,truth=false,prior=2.0', 'dbsnp.vcf',
+             '-resource:1000G,known=false,training=true,truth=false,prior=10.0', '1000G.vcf',
+             '-mode', 'SNP'])
+
+        resources['hapmap.vcf'] = hapmap
+        resources['omni.vcf'] = omni
+        resources['dbsnp.vcf'] = dbsnp
+        resources['1000G.vcf'] = phase
+
+    # Parameters and resource files for INDEL VQSR
+    elif mode == 'INDEL':
+        command.extend(
+            ['-resource:mills,known=false,training=true,truth=true,prior=12.0', 'mills.vcf',
+             '-resource:dbsnp,known=true,training=false,truth=false,prior=2.0', 'dbsnp.vcf',
+             '-mode', 'INDEL'])
+
+        resources['mills.vcf'] = mills
+        resources['dbsnp.vcf'] = dbsnp
+
+    else:
+        raise ValueError('Variant filter modes can be SNP or INDEL, got %s' % mode)
+
+    for annotation in annotations:
+        command.extend(['-an', annotation])
+
+    if unsafe_mode:
+        command.extend(['-U', 'ALLOW_SEQ_DICT_INCOMPATIBILITY'])
+
+    job.fileStore.logToMaster('Running GATK VariantRecalibrator on {mode}s using the following annotations:\n'
+                              '{annotations}'.format(mode=mode, annotations='\n'.join(annotations)))
+
+    work_dir = gatk_call(job, command, ref_fasta, ref_fai, ref_dict,
+                         inputs={'input.vcf': vcf},
+                         outputs=['output.recal', 'output.tranches', 'output.plots.R'],
+                         resources=resources,
+                         reference_cache=reference_cache)
+
+    recal_id = job.fileStore.writeGlobalFile(os.path.join(work_dir, 'output.recal'))
+    tranches_id = job.fileStore.writeGlobalFile(os.path.join(work_dir, 'output.tranches'))
+    plots_id = job.fileStore.writeGlobalFile(os.path.join(work_dir, 'output.plots.R'))
+    return recal_id, tranches_id, plots_id
+
+
+def gatk_apply_variant_recalibration(job,
+                                     mode,
+                                     vcf,
+                                     recal_table, tranches,
+                                     ref_fasta, ref_fai, ref_dict,
+                                     ts_filter_level=99.0,
+                                     unsafe_mode=False,
+                                     reference_cache=None):
+    """
+    Applies variant quality score recalibration to VCF file using GATK ApplyRecalibration
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param str mode: Determines variant recalibration mode (SNP or INDEL)
+    :param str vcf: FileStoreID for input VCF file
+    :param str recal_table: FileStoreID for recalibration table file
+    :param str tranches: FileStoreID for tranches file
+    :param str ref_fasta: FileStoreID for reference genome fasta
+    :param str ref_fai: FileStoreID for reference genome index file
+    :param str ref_dict: FileStoreID for reference genome sequence dictionary file
+    :param float ts_filter_level: Sensitivity expressed as a percentage, default is 99.0
+    :param bool unsafe_mode: If True, runs gatk UNSAFE mode: "-U ALLOW_SEQ_DICT_INCOMPATIBILITY"
+    :param ReferenceCache reference_cache: Node-local reference cache configuration, default is None
+    :return: FileStoreID for recalibrated VCF file
+    :rtype: str
+    """
+    mode = mode.upper()
+
+    # GATK recommended parameters:
+    # https://software.broadinstitute.org/gatk/documentation/article?id=2805
+    command = ['-T', 'ApplyRecalibration',
+               '-mode', mode,
+               '-R', 'genome.fa',
+               '-input', 'input.vcf',
+               '-o', 'vqsr.vcf',
+               '-ts_filter_level', str(ts_filter_level),
+               '-recalFile', 'recal',
+               '-tranchesFile', 'tranches']
+
+    if unsafe_mode:
+        command.extend(['-U', 'ALLOW_SEQ_DICT_INCOMPATIBILITY'])
+
+    job.fileStore.logToMaster('Running GATK ApplyRecalibration on {mode}s '
+                              'with a sensitivity of {sensitivity}%'.format(mode=mode,
+                                                                            sensitivity=ts_filter_level))
+    work_dir = gatk_call(job, command, ref_fasta, ref_fai, ref_dict,
+                         inputs={'input.vcf': vcf,
+                                 'recal': recal_table,
+                                 'tranches': tranches},
+                         outputs=['vqsr.vcf'],
+                         reference_cache=reference_cache)
+
+    return job.fileStore.writeGlobalFile(os.path.join(work_dir, 'vqsr.vcf'))
@@ -0,0 +1,158 @@
+#!/usr/bin/env python2.7
+"""
+Reads the header of a BAM file and the read counts in its index without samtools.
+
+A BAM file is a series of BGZF blocks, which are gzip members of at most 64 KB that store their
+compressed size in the gzip extra field. The BAM header is at the start of the first blocks: the
+plain text SAM header, followed by the name and length of each reference sequence. Only the blocks
+that contain the header are read, so the alignments are never decompressed.
+"""
+from collections import namedtuple
+import struct
+
+from toil_scripts.lib.bgzf import read_bgzf_block
+
+
+# Structured BAM header
+#   text: Plain text SAM header
+#   contigs: (name, length) of each reference sequence in header order
+#   sort_order: SO tag of the @HD line, or 'unknown'
+#   read_groups: Tags of each @RG line {tag: value}
+BamHeader = namedtuple('BamHeader', 'text contigs sort_order read_groups')
+
+# Reference sequence in a BAI index
+#   start, end: Virtual offsets of the first and last reads of the reference, or None without reads
+#   mapped, unmapped: Number of mapped and unmapped reads of the reference
+BaiReference = namedtuple('BaiReference', 'start end mapped unmapped')
+
+# Bin of a BAI index that stores the offsets and read counts of a reference
+BAI_PSEUDO_BIN = 37450
+
+
+class _BgzfBuffer(object):
+    """
+    Reads exact byte counts from the decompressed data of consecutive BGZF blocks
+    """
+
+    def __init__(self, f):
+        """
+        :param file f: BGZF file opened in binary mode
+        """
+        self.f = f
+        self.buf = ''
+        self.pos = 0
+
+    def read(self, n):
+        """
+        :param int n: Number of bytes
+        :return: The next n bytes
+        :rtype: str
+        """
+        while len(self.buf) - self.pos < n:
+            block = read_bgzf_block(self.f)
+            if block is None:
+                raise ValueError('BAM file ended before the end of its header')
+            self.buf = self.buf[self.pos:] + block
+            self.pos = 0
+        data = self.buf[self.pos:self.pos + n]
+        self.pos += n
+        return data
+
+    def unpack(self, fmt):
+        """
+        :param str fmt: struct format
+        :return: Unpacked values
+        :rtype: tuple
+        """
+        return struct.unpack(fmt, self.read(struct.calcsize(fmt)))
+
+
+def read_bam_header(f):
+    """
+    Reads the SAM header and the reference sequences of a BAM file
+
+    :param file f: BAM file opened in binary mode
+    :return: Structured BAM header
+    :rtype: BamHeader
+    """
+    buf = _BgzfBuffer(f)
+    if buf.read(4) != 'BAM\x01':
+        raise ValueError('Not a BAM file')
+    l_text, = buf.unpack('<i')
+    text = buf.read(l_text).rstrip('\x00')
+    n_ref, = buf.unpack('<i')
+    contigs = []
+    for _ in xrange(n_ref):
+        l_name, = buf.unpack('<i')
+        name = buf.read(l_name).rstrip('\x00')
+        l_ref, = buf.unpack('<i')
+        contigs.append((name, l_ref))
+    sort_order, read_groups = parse_header_text(text)
+    return BamHeader(text, contigs, sort_order, read_groups)
+
+
+def parse_header_text(text):
+    """
+    Parses the sort order and read groups from a SAM header
+
+    :param str text: SAM header text
+    :return: Sort order and list of read group dictionaries {tag: value}
+    :rtype: tuple(str, list[dict])
+    """
+    sort_order = 'unknown'
+    read_groups = []
+    for line in text.splitlines():
+        fields = line.split('\t')
+        tags = dict(field.split(':', 1) for field in fields[1:] if ':' in field)
+        if fields[0] == '@HD':
+            sort_order = tags.get('SO', sort_order)
+        elif fields[0] == '@RG':
+            read_groups.append(tags)
+    return sort_order, read_groups
+
+
+def read_bai(f):
+    """
+    Reads the file offsets and read counts of each reference sequence from a BAI index. The counts
+    are the same counts that samtools idxstats reports.
+
+    :param file f: BAI index opened in binary mode
+    :return: Offsets and counts of each reference sequence in header order
+    :rtype: list[BaiReference]
+    """
+    def unpack(fmt):
+        size = struct.calcsize(fmt)
+        data = f.read(size)
+        if len(data) < size:
+            raise ValueError('BAI index is truncated')
+        return struct.unpack(fmt, data)
+
+    if f.read(4) != 'BAI\x01':
+        raise ValueError('Not a BAI index')
+    n_ref, = unpack('<i')
+    references = []
+    for _ in xrange(n_ref):
+        # References without reads have no pseudo bin
+        reference = BaiReference(None, None, 0, 0)
+        n_bin, = unpack('<i')
+        for _ in xrange(n_bin):
+            bin_number, n_chunk = unpack('<Ii')
+            chunks = unpack('<{}Q'.format(2 * n_chunk))
+            # The pseudo bin has two chunks: the virtual offsets of the reference and its read counts
+            if bin_number == BAI_PSEUDO_BIN and n_chunk == 2:
+                reference = BaiReference(*chunks)
+        n_intv, = unpack('<i')
+        f.read(8 * n_intv)
+        references.append(reference)
+    return references
+
+
+def read_bai_counts(f):
+    """
+    Reads the number of mapped and unmapped reads of each reference sequence from a BAI index
+
+    :param file f: BAI index opened in binary mode
+    :return: (mapped, unmapped) of each reference sequence in header order
+    :rtype: list[tuple(int, int)]
+    """
+    return [(reference.mapped, reference.unmapped) for reference in read_bai(f)]
@@ -0,0 +1,176 @@
+#!/usr/bin/env python2.7
+"""
+Reads and writes BGZF files, the block compressed gzip format used by BAM files and tabix indexed
+VCF files.
+
+A BGZF file is a series of gzip members that each hold at most 64 KB of data and store their
+compressed size in the gzip extra field, followed by an empty end-of-file block. Positions in a
+BGZF file are virtual offsets: the offset of a compressed block in the file shifted left 16 bits,
+plus the offset of the position within the uncompressed block.
+"""
+import struct
+import zlib
+
+BGZF_MAGIC = '\x1f\x8b\x08\x04'
+
+# Empty block that marks the end of a BGZF file
+BGZF_EOF = ('\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00'
+            '\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00')
+
+# Uncompressed bytes per block. Leaves room for incompressible data in a 64 KB block.
+BLOCK_SIZE = 0xff00
+
+
+def read_bgzf_block(f):
+    """
+    Reads and decompresses the next BGZF block
+
+    :param file f: BGZF file opened in binary mode
+    :return: Decompressed block, or None at the end of the file
+    :rtype: str|None
+    """
+    header = f.read(12)
+    if not header:
+        return None
+    if len(header) < 12 or header[:4] != BGZF_MAGIC:
+        raise ValueError('Not a BGZF compressed file')
+    xlen, = struct.unpack('<H', header[10:12])
+    extra = f.read(xlen)
+    # Find the BC subfield, which stores the total block size minus one
+    block_size = None
+    i = 0
+    while i + 4 <= len(extra):
+        si1, si2, slen = struct.unpack('<BBH', extra[i:i + 4])
+        if si1 == 66 and si2 == 67 and slen == 2:
+            block_size, = struct.unpack('<H', extra[i + 4:i + 6])
+            break
+        i += 4 + slen
+    if block_size is None:
+        raise ValueError('BGZF block is missing the BC extra subfield')
+    # The remaining block is the deflate stream followed by the CRC32 and ISIZE fields
+    data = f.read(block_size + 1 - 12 - xlen)
+    return zlib.decompress(data[:-8], -zlib.MAX_WBITS)
+
+
+def compress_block(data, level=6):
+    """
+    :param str data: Up to 64 KB of uncompressed data
+    :param int level: zlib compression level
+    :return: BGZF block
+    :rtype: str
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush()
+    # 18 byte header with the BC subfield, then the deflate stream, CRC32, and ISIZE
+    block_size = 18 + len(deflated) + 8
+    return (BGZF_MAGIC + '\x00\x00\x00\x00\x00\xff' + struct.pack('<HBBHH', 6, 66, 67, 2, block_size - 1) +
+            deflated + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data)))
+
+
+class BgzfWriter(object):
+    """
+    Writes a BGZF file and reports virtual offsets of the data written so far, so that an index
+    can be built while the file is written.
+    """
+
+    def __init__(self, path, level=6):
+        """
+        :param str path: Path to the output file
+        :param int level: zlib compression level
+        """
+        self.path = path
+        self.level = level
+        self._handle = open(path, 'wb')
+        self._buffer = []
+        self._buffered = 0
+        self._address = 0
+
+    def tell(self):
+        """
+        :return: Virtual offset of the next byte written
+        :rtype: int
+        """
+        if self._buffered >= BLOCK_SIZE:
+            self._flush_blocks()
+        return (self._address << 16) | self._buffered
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= BLOCK_SIZE:
+            self._flush_blocks()
+
+    def _flush_blocks(self, final=False):
+        data = ''.join(self._buffer)
+        start = 0
+        while len(data) - start >= BLOCK_SIZE or (final and start < len(data)):
+            block = compress_block(data[start:start + BLOCK_SIZE], self.level)
+            self._handle.write(block)
+            self._address += len(block)
+            start += BLOCK_SIZE
+        data = data[start:]
+        self._buffer = [data] if data else []
+        self._buffered = len(data)
+
+    def close(self):
+        if self._handle.closed:
+            return
+        self._flush_blocks(final=True)
+        self._handle.write(BGZF_EOF)
+        self._handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class GzipReader(object):
+    """
+    Iterates over the lines of a gzip file, including BGZF files and other files with more than
+    one gzip member
+    """
+
+    def __init__(self, path, chunk_size=1024 * 1024):
+        """
+        :param str path: Path to the gzip file
+        :param int chunk_size: Number of compressed bytes read at a time
+        """
+        self._handle = open(path, 'rb')
+        self.chunk_size = chunk_size
+
+    def _chunks(self):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        while True:
+            data = self._handle.read(self.chunk_size)
+            if not data:
+                break
+            while data:
+                yield decompressor.decompress(data)
+                # Start a new decompressor at the next gzip member
+                data = decompressor.unused_data
+                if data:
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        yield decompressor.flush()
+
+    def __iter__(self):
+        partial = ''
+        for chunk in self._chunks():
+            if not chunk:
+                continue
+            lines = (partial + chunk).split('\n')
+            partial = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        if partial:
+            yield partial
+
+    def close(self):
+        self._handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
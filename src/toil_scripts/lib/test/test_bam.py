@@ -0,0 +1,54 @@
+from StringIO import StringIO
+import struct
+from unittest import TestCase
+
+from toil_scripts.lib.bam import parse_header_text, read_bai, read_bai_counts, read_bam_header
+from toil_scripts.lib.bgzf import compress_block
+
+
+def bam(text, block_size=None, contigs=()):
+    data = 'BAM\x01' + struct.pack('<i', len(text)) + text + struct.pack('<i', len(contigs))
+    for name, length in contigs:
+        data += struct.pack('<i', len(name) + 1) + name + '\x00' + struct.pack('<i', length)
+    block_size = block_size or len(data)
+    return ''.join(compress_block(data[i:i + block_size]) for i in range(0, len(data), block_size))
+
+
+class BamTest(TestCase):
+
+    def test_parse_header_text(self):
+        text = '@HD\tVN:1.4\tSO:coordinate\n@SQ\tSN:1\tLN:100\n@RG\tID:foo\tSM:bar\n@RG\tID:baz\tSM:bar\n'
+        sort_order, read_groups = parse_header_text(text)
+        self.assertEqual(sort_order, 'coordinate')
+        self.assertEqual([rg['ID'] for rg in read_groups], ['foo', 'baz'])
+        self.assertEqual(parse_header_text('@SQ\tSN:1\tLN:100\n'), ('unknown', []))
+
+    def test_read_bam_header(self):
+        text = '@HD\tVN:1.4\tSO:queryname\n@SQ\tSN:1\tLN:100\n@SQ\tSN:MT\tLN:16569\n@RG\tID:foo\tSM:bar\n'
+        contigs = [('1', 100), ('MT', 16569)]
+        # Header in one BGZF block and split across several blocks
+        for block_size in (None, 7):
+            header = read_bam_header(StringIO(bam(text, block_size=block_size, contigs=contigs)))
+            self.assertEqual(header.text, text)
+            self.assertEqual(header.contigs, contigs)
+            self.assertEqual(header.sort_order, 'queryname')
+            self.assertEqual(header.read_groups, [{'ID': 'foo', 'SM': 'bar'}])
+        with self.assertRaises(ValueError):
+            read_bam_header(StringIO('@HD\tVN:1.4\n'))
+        # Header without the reference sequences
+        with self.assertRaises(ValueError):
+            read_bam_header(StringIO(compress_block('BAM\x01' + struct.pack('<i', len(text)) + text)))
+
+    def test_read_bai_counts(self):
+        # The first reference has a bin with one chunk and the pseudo bin, the second has no reads
+        bai = 'BAI\x01' + struct.pack('<i', 2)
+        bai += struct.pack('<i', 2) + struct.pack('<Ii2Q', 4681, 1, 0, 100)
+        bai += struct.pack('<Ii4Q', 37450, 2, 0, 100, 7, 3) + struct.pack('<iQ', 1, 0)
+        bai += struct.pack('<ii', 0, 0) + struct.pack('<Q', 5)
+        self.assertEqual(read_bai_counts(StringIO(bai)), [(7, 3), (0, 0)])
+        self.assertEqual(read_bai(StringIO(bai))[0], (0, 100, 7, 3))
+        self.assertIsNone(read_bai(StringIO(bai))[1].start)
+        with self.assertRaises(ValueError):
+            read_bai_counts(StringIO(bai[:30]))
+        with self.assertRaises(ValueError):
+            read_bai_counts(StringIO('BAM\x01'))
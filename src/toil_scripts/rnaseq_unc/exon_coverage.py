@@ -0,0 +1,282 @@
+#!/usr/bin/env python2.7
+"""
+Counts reads on composite exons with NumPy, as an alternative to bedtools coverage -split -abam.
+
+The exons of each contig are loaded into arrays sorted by start position. Each contig is read by a
+worker process, which seeks to the first read of the contig using the BAM index and decodes reads
+in chunks. The record boundaries of a chunk are found by a Python loop over the record lengths,
+because the offset of each record depends on the length of the one before it. The rest of the
+chunk is decoded with NumPy: the CIGAR operations are decoded into aligned blocks, which are split
+at skipped regions (N) and extend across deletions (D), the same as bedtools -split, and overlaps
+between blocks and exons are found with searchsorted.
+
+For each exon, the number of reads with a block that overlaps the exon is counted once per read,
+and the bases covered by at least one block are merged into intervals across chunks.
+"""
+import multiprocessing
+import struct
+
+import numpy as np
+
+from toil_scripts.lib.bam import read_bai, read_bam_header
+from toil_scripts.lib.bgzf import read_bgzf_block
+
+# Decompressed bytes of reads decoded at once by a worker
+CHUNK_SIZE = 16 * 1024 * 1024
+
+# CIGAR operations that are part of an aligned block, and the operation that splits blocks
+BLOCK_OPS = (0, 2, 7, 8)  # M, D, =, X
+SKIP_OP = 3  # N
+
+# Flag of unmapped reads
+UNMAPPED = 0x4
+
+
+class Exons(object):
+    """
+    Composite exons of each contig, sorted by start position
+    """
+
+    def __init__(self, bed):
+        """
+        :param str bed: Path to a bed file of exons
+        """
+        self.lines = []
+        rows = {}
+        with open(bed, 'r') as f:
+            for line in f:
+                if line.startswith(('#', 'track', 'browser')) or not line.strip():
+                    continue
+                fields = line.rstrip('\n').split('\t')
+                rows.setdefault(fields[0], []).append((int(fields[1]), int(fields[2]), len(self.lines)))
+                self.lines.append(line.rstrip('\n'))
+        self.contigs = {}
+        for contig, intervals in rows.iteritems():
+            starts, ends, index = (np.array(x, dtype=np.int64) for x in zip(*intervals))
+            order = np.argsort(starts, kind='mergesort')
+            self.contigs[contig] = (starts[order], ends[order], index[order])
+
+    def __len__(self):
+        return len(self.lines)
+
+
+def exon_coverage(bam, bai, bed, cores=1):
+    """
+    Counts the reads on each exon and the bases of each exon that are covered by reads
+
+    :param str bam: Path to a coordinate sorted BAM file
+    :param str bai: Path to the BAM index
+    :param str bed: Path to a bed file of exons
+    :param int cores: Number of worker processes
+    :return: Exons, and the read count and covered bases of each exon in bed file order
+    :rtype: tuple(Exons, np.array, np.array)
+    """
+    exons = Exons(bed)
+    with open(bam, 'rb') as f:
+        header = read_bam_header(f)
+    with open(bai, 'rb') as f:
+        references = read_bai(f)
+    if len(references) != len(header.contigs):
+        raise ValueError('Index of {} does not match its header'.format(bam))
+    tasks = []
+    for ref_id, ((contig, _), reference) in enumerate(zip(header.contigs, references)):
+        if contig in exons.contigs and reference.start is not None:
+            starts, ends, index = exons.contigs[contig]
+            tasks.append((bam, ref_id, reference.start, starts, ends, index))
+    counts = np.zeros(len(exons), dtype=np.int64)
+    covered = np.zeros(len(exons), dtype=np.int64)
+    pool = multiprocessing.Pool(max(1, min(cores, len(tasks))))
+    try:
+        for index, contig_counts, contig_covered in pool.imap_unordered(_contig_coverage, tasks):
+            counts[index] = contig_counts
+            covered[index] = contig_covered
+    finally:
+        pool.terminate()
+    return exons, counts, covered
+
+
+def coverage_lines(exons, counts, covered):
+    """
+    Formats exon coverage like bedtools coverage: the bed fields, the read count, the covered
+    bases, the exon length, and the covered fraction of the exon
+
+    :param Exons exons: Exons in bed file order
+    :param np.array counts: Read count of each exon
+    :param np.array covered: Covered bases of each exon
+    :return: Lines of bedtools coverage output
+    :rtype: iter[str]
+    """
+    for line, count, bases in zip(exons.lines, counts, covered):
+        fields = line.split('\t')
+        length = int(fields[2]) - int(fields[1])
+        yield '{}\t{}\t{}\t{}\t{:.7f}\n'.format(line, count, bases, length, float(bases) / length if length else 0)
+
+
+def _contig_coverage(task):
+    """
+    Counts the reads and covered bases of the exons of one contig. Runs in a worker process.
+
+    :param tuple task: BAM path, reference ID, virtual offset of the first read, and the sorted
+                       exon starts, ends, and bed file rows of the contig
+    :return: Bed file rows, read counts, and covered bases of the exons
+    :rtype: tuple(np.array, np.array, np.array)
+    """
+    bam, ref_id, virtual_offset, starts, ends, index = task
+    # Exons that end before a position are the exons before the first running maximum end after it
+    max_ends = np.maximum.accumulate(ends)
+    # Separates the covered intervals of each exon when intervals of all exons are merged at once
+    stride = int(max_ends[-1]) + 1
+    counts = np.zeros(len(starts), dtype=np.int64)
+    intervals = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    with open(bam, 'rb') as f:
+        for data, offsets in _read_chunks(f, virtual_offset):
+            ref_ids = _gather(data, offsets + 4, '<i4')
+            last = ref_ids[-1] != ref_id
+            offsets = offsets[ref_ids == ref_id]
+            if len(offsets):
+                read, block_starts, block_ends = _aligned_blocks(data, offsets)
+                read, exon, clip_starts, clip_ends = _overlaps(read, block_starts, block_ends, starts, ends, max_ends)
+                # Each read is counted once per exon, even if several of its blocks overlap the exon
+                pairs = np.unique(read * len(starts) + exon)
+                counts += np.bincount(pairs % len(starts), minlength=len(starts))
+                intervals = _merge_intervals(np.concatenate([intervals[0], exon * stride + clip_starts]),
+                                             np.concatenate([intervals[1], exon * stride + clip_ends]))
+            if last:
+                break
+    covered = np.bincount(intervals[0] // stride, weights=intervals[1] - intervals[0], minlength=len(starts))
+    return index, counts, covered.astype(np.int64)
+
+
+def _read_chunks(f, virtual_offset):
+    """
+    Decompresses the reads of a BAM file from a virtual offset in chunks of whole records. The
+    record offsets are found one record at a time, which is the only per-read Python loop.
+
+    :param file f: BAM file opened in binary mode
+    :param int virtual_offset: Virtual offset of the first read
+    :return: Decompressed records and the offset of each record in the chunk
+    :rtype: iter[tuple(np.array, np.array)]
+    """
+    f.seek(virtual_offset >> 16)
+    block = read_bgzf_block(f)
+    buf = block[virtual_offset & 0xffff:] if block else ''
+    while block is not None:
+        blocks = [buf]
+        size = len(buf)
+        while size < CHUNK_SIZE:
+            block = read_bgzf_block(f)
+            if block is None:
+                break
+            blocks.append(block)
+            size += len(block)
+        buf = ''.join(blocks)
+        offsets = []
+        pos = 0
+        while pos + 4 <= len(buf):
+            end = pos + 4 + struct.unpack_from('<i', buf, pos)[0]
+            if end > len(buf):
+                break
+            offsets.append(pos)
+            pos = end
+        if offsets:
+            yield np.frombuffer(buf, dtype=np.uint8, count=pos), np.array(offsets, dtype=np.int64)
+        buf = buf[pos:]
+
+
+def _gather(data, offsets, dtype):
+    """
+    :param np.array data: Decompressed records
+    :param np.array offsets: Byte offset of each value
+    :param str dtype: Little-endian type of the values
+    :return: Values at the offsets
+    :rtype: np.array
+    """
+    size = np.dtype(dtype).itemsize
+    return data[offsets[:, np.newaxis] + np.arange(size)].view(dtype).ravel()
+
+
+def _aligned_blocks(data, offsets):
+    """
+    Decodes the aligned blocks of the mapped reads in a chunk of records
+
+    :param np.array data: Decompressed records
+    :param np.array offsets: Offset of each record
+    :return: Read index, start, and end of each block
+    :rtype: tuple(np.array, np.array, np.array)
+    """
+    flags = _gather(data, offsets + 18, '<u2')
+    n_cigar = _gather(data, offsets + 16, '<u2').astype(np.int64)
+    mapped = ((flags & UNMAPPED) == 0) & (n_cigar > 0)
+    offsets, n_cigar = offsets[mapped], n_cigar[mapped]
+    positions = _gather(data, offsets + 8, '<i4').astype(np.int64)
+    # The CIGAR follows the 32 fixed bytes and the read name
+    cigar_offsets = offsets + 36 + data[offsets + 12].astype(np.int64)
+
+    # Index of each CIGAR operation within its read
+    read = np.repeat(np.arange(len(offsets)), n_cigar)
+    first_op = np.cumsum(n_cigar) - n_cigar
+    op_index = np.arange(len(read)) - first_op[read]
+    cigar = _gather(data, cigar_offsets[read] + 4 * op_index, '<u4')
+    ops, lengths = cigar & 0xf, (cigar >> 4).astype(np.int64)
+
+    # Reference position of each operation
+    ref_lengths = np.where(np.in1d(ops, BLOCK_OPS + (SKIP_OP,)), lengths, 0)
+    op_ends = np.cumsum(ref_lengths)
+    op_ends += positions[read] - (op_ends[first_op] - ref_lengths[first_op])[read]
+    op_starts = op_ends - ref_lengths
+
+    # A block starts at the first operation of a read and after each skipped region
+    new_block = op_index == 0
+    new_block[1:] |= ops[:-1] == SKIP_OP
+    block_index = np.flatnonzero(new_block)
+    in_block = np.in1d(ops, BLOCK_OPS)
+    block_starts = np.minimum.reduceat(np.where(in_block, op_starts, np.iinfo(np.int64).max), block_index)
+    block_ends = np.maximum.reduceat(np.where(in_block, op_ends, np.iinfo(np.int64).min), block_index)
+    nonempty = block_ends > block_starts
+    return read[block_index][nonempty], block_starts[nonempty], block_ends[nonempty]
+
+
+def _overlaps(read, block_starts, block_ends, starts, ends, max_ends):
+    """
+    Finds the exons that overlap each block
+
+    :param np.array read: Read index of each block
+    :param np.array block_starts: Start of each block
+    :param np.array block_ends: End of each block
+    :param np.array starts: Sorted exon starts
+    :param np.array ends: Exon ends
+    :param np.array max_ends: Running maximum of exon ends
+    :return: Read index, exon, and start and end of the overlap for each overlapping block and exon
+    :rtype: tuple(np.array, np.array, np.array, np.array)
+    """
+    # Candidate exons start before the end of the block and are not followed only by exons that end
+    # before the start of the block
+    first = np.searchsorted(max_ends, block_starts, side='right')
+    last = np.searchsorted(starts, block_ends, side='left')
+    n = np.maximum(last - first, 0)
+    block = np.repeat(np.arange(len(n)), n)
+    exon = np.repeat(first, n) + np.arange(len(block)) - np.repeat(np.cumsum(n) - n, n)
+    overlap = ends[exon] > block_starts[block]
+    block, exon = block[overlap], exon[overlap]
+    return (read[block], exon,
+            np.maximum(starts[exon], block_starts[block]), np.minimum(ends[exon], block_ends[block]))
+
+
+def _merge_intervals(interval_starts, interval_ends):
+    """
+    Merges overlapping and adjacent intervals
+
+    :param np.array interval_starts: Interval starts
+    :param np.array interval_ends: Interval ends
+    :return: Sorted starts and ends of the merged intervals
+    :rtype: tuple(np.array, np.array)
+    """
+    if not len(interval_starts):
+        return interval_starts, interval_ends
+    order = np.lexsort((interval_ends, interval_starts))
+    interval_starts, interval_ends = interval_starts[order], interval_ends[order]
+    max_ends = np.maximum.accumulate(interval_ends)
+    new_interval = np.ones(len(interval_starts), dtype=bool)
+    new_interval[1:] = interval_starts[1:] > max_ends[:-1]
+    merged = np.flatnonzero(new_interval)
+    return interval_starts[merged], np.maximum.reduceat(interval_ends, merged)
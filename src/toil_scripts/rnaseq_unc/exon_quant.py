@@ -0,0 +1,16 @@
+#!/usr/bin/env python2.7
+"""
+Writes exon_quant.bed from the exon_quant output of normalizeBedToolsExonQuant.pl.
+
+exon_quant.bed is exon_quant with ':' and '-' replaced by tabs and cut to the first four fields,
+the same as the tr and cut commands it replaces.
+"""
+
+
+def exon_quant_bed_line(line):
+    """
+    :param str line: Line of exon_quant without the newline
+    :return: Line of exon_quant.bed: chrom, start, end, and strand or raw count
+    :rtype: str
+    """
+    return '\t'.join(line.replace(':', '\t').replace('-', '\t').split('\t')[:4]) + '\n'
@@ -22,9 +22,7 @@ Tree Structure of RNA-Seq Pipeline (per sample)
                 |
                 11
                 |
-                12
-                |
-               *13
+               *12
 
 0 = Start Node
 1 = Download Sample
@@ -38,10 +36,9 @@ Tree Structure of RNA-Seq Pipeline (per sample)
 9 = Exon Quantification
 10 = Transcriptome
 11 = Filter
-12 = RSEM
-13 = RSEM Post-Process
+12 = RSEM and RSEM Post-Process
 
-7,9,13 contribute to producing the final output
+7,9,12 contribute to producing the final output
 
 Dependencies
 Curl:       apt-get install curl
@@ -69,6 +66,19 @@ from urlparse import urlparse
 
 from toil.job import Job
 
+from toil_scripts.lib.bam import read_bai_counts, read_bam_header
+from toil_scripts.rnaseq_unc.exon_coverage import coverage_lines, exon_coverage
+from toil_scripts.rnaseq_unc.exon_quant import exon_quant_bed_line
+
+# Memory of samtools sort per read when sorting by name. Contigs with more reads spill to temporary files.
+SORT_BYTES_PER_READ = 500
+SORT_MIN_MEMORY = 100 * 1024 * 1024
+SORT_MAX_MEMORY = 3000000000
+# Memory used by samtools view and sort in addition to the sort buffer
+SORT_MEMORY_OVERHEAD = 512 * 1024 * 1024
+# Consecutive contigs are sorted by the same job up to this many reads
+SORT_GROUP_READS = 20000000
+
 
 def build_parser():
     parser = argparse.ArgumentParser(description=main.__doc__, add_help=True)
@@ -91,6 +101,9 @@ def build_parser():
                         default='https://s3-us-west-2.amazonaws.com/cgl-pipeline-inputs/rna-seq/composite_exons.bed')
     parser.add_argument('--normalize', help='URL to normalizeBedToolsExonQuant.pl',
                         default='https://s3-us-west-2.amazonaws.com/cgl-pipeline-inputs/rna-seq/normalizeBedToolsExonQuant.pl')
+    parser.add_argument('--exon_quantifier', default='bedtools', choices=['bedtools', 'numpy'],
+                        help='Counts reads on composite exons with bedtools coverage, or with NumPy in parallel '
+                             'over contigs.')
     parser.add_argument('--rsem_ref', help='RSEM_REF URL',
                         default='https://s3-us-west-2.amazonaws.com/cgl-pipeline-inputs/rna-seq/rsem_ref.zip')
     parser.add_argument('--chromosomes', help='Chromosomes Directory',
@@ -627,7 +640,9 @@ def rseq_qc(job, job_vars):
 
 def sort_bam_by_reference(job, job_vars):
     """
-    Sorts the bam by reference
+    Sorts the bam by reference: reads are name sorted within each contig and the contigs are kept in
+    header order. Consecutive contigs are grouped by their read counts from the bam index and each
+    group is sorted by a child job. A follow-on job concatenates the sorted groups.
 
     job_vars: tuple     Tuple of dictionaries: input_args and ids
     """
@@ -636,36 +651,140 @@ def sort_bam_by_reference(job, job_vars):
     work_dir = job.fileStore.getLocalTempDir()
     # I/O
     sorted_bam, sorted_bai = return_input_paths(job, work_dir, ids, 'sorted.bam', 'sorted.bam.bai')
-    output = os.path.join(work_dir, 'sort_by_ref.bam')
-    # Call: Samtools
-    ref_seqs = []
-    handle = subprocess.Popen(["samtools", "view", "-H", sorted_bam], stdout=subprocess.PIPE).stdout
-    for line in handle:
-        if line.startswith("@SQ"):
-            tmp = line.split("\t")
-            chrom = tmp[1].split(":")[1]
-            ref_seqs.append(chrom)
-    handle.close()
-    # Iterate through chromosomes to create mini-bams
-    for chrom in ref_seqs:
-        # job.addChildJobFn(sbbr_child, chrom, os.path.join(work_dir, chrom), sorted_bam)
-        cmd_view = ["samtools", "view", "-b", sorted_bam, chrom]
-        cmd_sort = ["samtools", "sort", "-m", "3000000000", "-n", "-", os.path.join(work_dir, chrom)]
+    bam_size = os.path.getsize(sorted_bam)
+    index_size = os.path.getsize(sorted_bai)
+    # Read counts from the bam header and index
+    counts = read_counts(sorted_bam, sorted_bai)
+    total_reads = max(sum(reads for _, reads in counts), 1)
+    groups = group_contigs(counts, SORT_GROUP_READS)
+    job.fileStore.logToMaster('Sorting {} contigs with {} reads by name in {} jobs'.format(len(counts), total_reads,
+                                                                                          len(groups)))
+    group_ids = []
+    for contigs in groups:
+        group_reads = sum(reads for _, reads in contigs)
+        # Each job reads the whole bam and writes the sort temporary files and sorted bam for its contigs
+        disk = bam_size + index_size + int(3 * bam_size * float(group_reads) / total_reads)
+        memory = max(sort_memory(reads) for _, reads in contigs) + SORT_MEMORY_OVERHEAD
+        group_ids.append(job.addChildJobFn(sort_contigs_by_name, job_vars, contigs, disk=disk, memory=memory).rv())
+    return job.addFollowOnJobFn(merge_sorted_contigs, job_vars, group_ids, disk=3 * bam_size).rv()
+
+
+def read_counts(bam, bai):
+    """
+    Returns the number of reads on each contig from the bam header and index, without samtools
+
+    bam: str            Path to bam file
+    bai: str            Path to bam index
+
+    Returns: list       (contig, reads) for each contig in header order
+    """
+    with open(bam, 'rb') as f:
+        header = read_bam_header(f)
+    with open(bai, 'rb') as f:
+        counts = read_bai_counts(f)
+    if len(counts) != len(header.contigs):
+        raise RuntimeError('Index of {} does not match its header'.format(bam))
+    # Reads without a contig are not sorted by reference
+    return [(contig, mapped + unmapped) for (contig, _), (mapped, unmapped) in zip(header.contigs, counts)]
+
+
+def group_contigs(counts, max_reads):
+    """
+    Groups consecutive contigs with up to max_reads reads. Contigs with more reads are in a group
+    by themselves.
+
+    counts: list        (contig, reads) for each contig in header order
+    max_reads: int      Maximum number of reads in a group of contigs
+
+    Returns: list       Lists of (contig, reads) in header order
+    """
+    groups = []
+    group_reads = 0
+    for contig, reads in counts:
+        if not groups or group_reads + reads > max_reads:
+            groups.append([])
+            group_reads = 0
+        groups[-1].append((contig, reads))
+        group_reads += reads
+    return groups
+
+
+def sort_memory(reads):
+    """
+    Returns the memory for name sorting a contig, so small contigs are sorted with small buffers
+
+    reads: int          Number of reads on the contig
+
+    Returns: int        Memory in bytes for samtools sort -m
+    """
+    return min(max(reads * SORT_BYTES_PER_READ, SORT_MIN_MEMORY), SORT_MAX_MEMORY)
+
+
+def sort_contigs_by_name(job, job_vars, contigs):
+    """
+    Sorts the reads of each contig in a group by name and concatenates them in header order
+
+    job_vars: tuple     Tuple of dictionaries: input_args and ids
+    contigs: list       (contig, reads) for each contig in header order
+
+    Returns: str        FileStoreID for the sorted bam of the group
+    """
+    input_args, ids = job_vars
+    work_dir = job.fileStore.getLocalTempDir()
+    # I/O
+    sorted_bam, _ = return_input_paths(job, work_dir, ids, 'sorted.bam', 'sorted.bam.bai')
+    output = os.path.join(work_dir, 'sort_by_ref.group.bam')
+    # Call: Samtools -- second argument of sort is "Output Prefix"
+    sorted_files = []
+    for i, (contig, reads) in enumerate(contigs):
+        prefix = os.path.join(work_dir, 'contig.{}'.format(i))
+        cmd_view = ['samtools', 'view', '-b', sorted_bam, contig]
+        cmd_sort = ['samtools', 'sort', '-m', str(sort_memory(reads)), '-n', '-', prefix]
         p1 = subprocess.Popen(cmd_view, stdout=subprocess.PIPE)
         subprocess.check_call(cmd_sort, stdin=p1.stdout)
-    sorted_files = [os.path.join(work_dir, chrom) + '.bam' for chrom in ref_seqs]
-    cmd = ["samtools", "cat", "-o", output] + sorted_files
-    subprocess.check_call(cmd)
-    # Write to FileStore
-    ids['sort_by_ref.bam'] = job.fileStore.writeGlobalFile(output)
+        p1.stdout.close()
+        if p1.wait():
+            raise subprocess.CalledProcessError(p1.returncode, cmd_view)
+        sorted_files.append(prefix + '.bam')
+    if len(sorted_files) == 1:
+        os.rename(sorted_files[0], output)
+    else:
+        subprocess.check_call(['samtools', 'cat', '-o', output] + sorted_files)
+    return job.fileStore.writeGlobalFile(output)
+
+
+def merge_sorted_contigs(job, job_vars, group_ids):
+    """
+    Concatenates the sorted bams of each group of contigs in header order
+
+    job_vars: tuple     Tuple of dictionaries: input_args and ids
+    group_ids: list     FileStoreIDs for the sorted bam of each group of contigs
+    """
+    input_args, ids = job_vars
+    work_dir = job.fileStore.getLocalTempDir()
+    if len(group_ids) == 1:
+        ids['sort_by_ref.bam'] = group_ids[0]
+    else:
+        # I/O
+        sorted_files = [job.fileStore.readGlobalFile(group_id, os.path.join(work_dir, 'group.{}.bam'.format(i)))
+                        for i, group_id in enumerate(group_ids)]
+        output = os.path.join(work_dir, 'sort_by_ref.bam')
+        # Call: Samtools
+        subprocess.check_call(['samtools', 'cat', '-o', output] + sorted_files)
+        # Write to FileStore
+        ids['sort_by_ref.bam'] = job.fileStore.writeGlobalFile(output)
     rsem_id = job.addChildJobFn(transcriptome, job_vars, disk='30 G', memory='30 G').rv()
-    exon_id = job.addChildJobFn(exon_count, job_vars, disk='30 G').rv()
+    if input_args['exon_quantifier'] == 'numpy':
+        exon_id = job.addChildJobFn(exon_count, job_vars, cores=input_args['cpu_count'], disk='30 G').rv()
+    else:
+        exon_id = job.addChildJobFn(exon_count, job_vars, disk='30 G').rv()
     return exon_id, rsem_id
 
 
 def exon_count(job, job_vars):
     """
-    Produces exon counts
+    Produces exon counts with bedtools coverage, or with exon_coverage if exon_quantifier is numpy.
+    The coverage is normalized with normalizeBedToolsExonQuant.pl.
 
     job_vars: tuple     Tuple of dictionaries: input_args and ids
     """
@@ -674,31 +793,41 @@ def exon_count(job, job_vars):
     uuid = input_args['uuid']
     sudo = input_args['sudo']
     # I/O
-    sort_by_ref, normalize_pl, composite_bed = return_input_paths(job, work_dir, ids, 'sort_by_ref.bam',
-                                                                  'normalize.pl', 'composite_exons.bed')
-    # Command
-    tool = 'jvivian/bedtools'
-    cmd_1 = ['coverage',
-             '-split',
-             '-abam', docker_path(sort_by_ref),
-             '-b', docker_path(composite_bed)]
-    cmd_2 = ['perl',
-             os.path.join(work_dir, 'normalize.pl'),
-             sort_by_ref,
-             composite_bed]
-
-    popen_docker = ['docker', 'run', '-v', '{}:/data'.format(work_dir), tool]
-    if sudo:
-        popen_docker = ['sudo'] + popen_docker
-    p = subprocess.Popen(popen_docker + cmd_1, stdout=subprocess.PIPE)
-    with open(os.path.join(work_dir, 'exon_quant'), 'w') as f:
-        subprocess.check_call(cmd_2, stdin=p.stdout, stdout=f)
-
-    p1 = subprocess.Popen(['cat', os.path.join(work_dir, 'exon_quant')], stdout=subprocess.PIPE)
-    p2 = subprocess.Popen(['tr', '":"', '"\t"'], stdin=p1.stdout, stdout=subprocess.PIPE)
-    p3 = subprocess.Popen(['tr', '"-"', '"\t"'], stdin=p2.stdout, stdout=subprocess.PIPE)
-    with open(os.path.join(work_dir, 'exon_quant.bed'), 'w') as f:
-        subprocess.check_call(['cut', '-f1-4'], stdin=p3.stdout, stdout=f)
+    sort_by_ref, sorted_bai, composite_bed = return_input_paths(job, work_dir, ids, 'sort_by_ref.bam',
+                                                                'sorted.bam.bai', 'composite_exons.bed')
+    exon_quant = os.path.join(work_dir, 'exon_quant')
+    exon_quant_bed = os.path.join(work_dir, 'exon_quant.bed')
+    p = None
+    if input_args['exon_quantifier'] == 'numpy':
+        # Counts reads from the coordinate sorted bam, whose index locates the reads of each contig
+        sorted_bam = return_input_paths(job, work_dir, ids, 'sorted.bam')
+        exons, counts, covered = exon_coverage(sorted_bam, sorted_bai, composite_bed, cores=input_args['cpu_count'])
+        coverage = coverage_lines(exons, counts, covered)
+    else:
+        # Command
+        tool = 'jvivian/bedtools'
+        cmd = ['coverage',
+               '-split',
+               '-abam', docker_path(sort_by_ref),
+               '-b', docker_path(composite_bed)]
+
+        popen_docker = ['docker', 'run', '-v', '{}:/data'.format(work_dir), tool]
+        if sudo:
+            popen_docker = ['sudo'] + popen_docker
+        p = subprocess.Popen(popen_docker + cmd, stdout=subprocess.PIPE)
+        coverage = p.stdout
+    cmd = ['perl', return_input_paths(job, work_dir, ids, 'normalize.pl'), sort_by_ref, composite_bed]
+    with open(exon_quant, 'w') as f:
+        perl = subprocess.Popen(cmd, stdin=subprocess.PIPE if p is None else coverage, stdout=f)
+        if p is None:
+            perl.stdin.writelines(coverage)
+            perl.stdin.close()
+        if perl.wait() != 0:
+            raise RuntimeError('normalizeBedToolsExonQuant.pl returned a non-zero exit status.')
+    with open(exon_quant, 'r') as f_quant, open(exon_quant_bed, 'w') as f_bed:
+        f_bed.writelines(exon_quant_bed_line(line.rstrip('\n')) for line in f_quant)
+    if p is not None and p.wait() != 0:
+        raise RuntimeError('docker command returned a non-zero exit status. Check error logs.')
     # Create zip, upload to fileStore, and move to output_dir as a backup
     output_files = ['exon_quant.bed', 'exon_quant']
     tarball_files(work_dir, tar_name='exon.tar.gz', uuid=uuid, files=output_files)
@@ -791,34 +920,29 @@ def rsem(job, job_vars):
 
     docker_call(tool='quay.io/ucsc_cgl/rsem:1.2.25--4e8d1b31d4028f464b3409c6558fb9dfcad73f88',
                 tool_parameters=parameters, work_dir=work_dir, sudo=sudo)
-    os.rename(os.path.join(work_dir, output_prefix + '.genes.results'), os.path.join(work_dir, 'rsem_gene.tab'))
-    os.rename(os.path.join(work_dir, output_prefix + '.isoforms.results'), os.path.join(work_dir, 'rsem_isoform.tab'))
-    # Write to FileStore
-    ids['rsem_gene.tab'] = job.fileStore.writeGlobalFile(os.path.join(work_dir, 'rsem_gene.tab'))
-    ids['rsem_isoform.tab'] = job.fileStore.writeGlobalFile(os.path.join(work_dir, 'rsem_isoform.tab'))
-    # Run child jobs
-    return job.addChildJobFn(rsem_postprocess, job_vars).rv()
+    return rsem_postprocess(job, job_vars, work_dir, output_prefix)
 
 
-def rsem_postprocess(job, job_vars):
+def rsem_postprocess(job, job_vars, work_dir, output_prefix):
     """
-    Parses RSEMs output to produce the separate .tab files (TPM, FPKM, counts) for both gene and isoform
+    Produces the separate .tab files (TPM, FPKM, counts) for both gene and isoform from RSEM's output,
+    in the same job that ran RSEM, with the jvivian/rsem_postprocess container.
 
     job_vars: tuple     Tuple of dictionaries: input_args and ids
+    work_dir: str       Directory with RSEM's output
+    output_prefix: str  RSEM output prefix
+
+    Returns: str        FileStoreID for the tarball of tables
     """
     input_args, ids = job_vars
-    work_dir = job.fileStore.getLocalTempDir()
     uuid = input_args['uuid']
-    sudo = input_args['sudo']
-    # I/O
-    return_input_paths(job, work_dir, ids, 'rsem_gene.tab', 'rsem_isoform.tab')
-    # Command
-    sample = input_args['uuid']
-    docker_call(tool='jvivian/rsem_postprocess', tool_parameters=[sample], work_dir=work_dir, sudo=sudo)
-    # Tar output files together and store in fileStore
+    os.rename(os.path.join(work_dir, output_prefix + '.genes.results'), os.path.join(work_dir, 'rsem_gene.tab'))
+    os.rename(os.path.join(work_dir, output_prefix + '.isoforms.results'), os.path.join(work_dir, 'rsem_isoform.tab'))
+    docker_call(tool='jvivian/rsem_postprocess', tool_parameters=[uuid], work_dir=work_dir, sudo=input_args['sudo'])
     output_files = ['rsem.genes.norm_counts.tab', 'rsem.genes.raw_counts.tab', 'rsem.genes.norm_fpkm.tab',
                     'rsem.genes.norm_tpm.tab', 'rsem.isoform.norm_counts.tab', 'rsem.isoform.raw_counts.tab',
                     'rsem.isoform.norm_fpkm.tab', 'rsem.isoform.norm_tpm.tab']
+    # Tar output files together and store in fileStore
     tarball_files(work_dir, tar_name='rsem.tar.gz', uuid=uuid, files=output_files)
     return job.fileStore.writeGlobalFile(os.path.join(work_dir, 'rsem.tar.gz'))
 
@@ -933,7 +1057,6 @@ def main():
               'unc.bed': args.unc,
               'hg19.transcripts.fa': args.fasta,
               'composite_exons.bed': args.composite_exons,
-              'normalize.pl': args.normalize,
               'output_dir': args.output_dir,
               'rsem_ref.zip': args.rsem_ref,
               'chromosomes.zip': args.chromosomes,
@@ -943,6 +1066,8 @@ def main():
               'sudo': args.sudo,
               'single_end_reads': args.single_end_reads,
               'upload_bam_to_s3': args.upload_bam_to_s3,
+              'normalize.pl': args.normalize,
+              'exon_quantifier': args.exon_quantifier,
               'uuid': None,
               'sample.tar': None,
               'cpu_count': None}
@@ -0,0 +1,127 @@
+import os
+import random
+import re
+import shutil
+import struct
+import tempfile
+from unittest import TestCase
+
+from toil_scripts.lib.bgzf import compress_block
+from toil_scripts.rnaseq_unc import exon_coverage
+
+
+def bam_record(ref_id, pos, cigar, flag=0, name='read'):
+    ops = [(int(length), 'MIDNSHP=X'.index(op)) for length, op in re.findall(r'(\d+)(\D)', cigar)]
+    data = struct.pack('<iiBBHHHiiii', ref_id, pos, len(name) + 1, 60, 0, len(ops), flag, 0, -1, -1, 0)
+    data += name + '\x00' + ''.join(struct.pack('<I', length << 4 | op) for length, op in ops)
+    return struct.pack('<i', len(data)) + data
+
+
+def blocks(pos, cigar):
+    """
+    Aligned blocks of a read the way bedtools -split finds them
+    """
+    result = [[pos, pos]]
+    for length, op in re.findall(r'(\d+)(\D)', cigar):
+        length = int(length)
+        if op in 'MD=X':
+            result[-1][1] += length
+        elif op == 'N':
+            result.append([result[-1][1] + length] * 2)
+    return [(start, end) for start, end in result if end > start]
+
+
+class ExonCoverageTest(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def _write_bam(self, contigs, reads, records_per_block=3):
+        """
+        Writes a coordinate sorted BAM file and a BAI index with only the pseudo bins
+        """
+        text = ''.join('@SQ\tSN:{}\tLN:{}\n'.format(name, length) for name, length in contigs)
+        header = 'BAM\x01' + struct.pack('<i', len(text)) + text + struct.pack('<i', len(contigs))
+        for name, length in contigs:
+            header += struct.pack('<i', len(name) + 1) + name + '\x00' + struct.pack('<i', length)
+        data = compress_block(header)
+        first_block = {}
+        reads = sorted(reads)
+        for i in range(0, len(reads), records_per_block):
+            chunk = reads[i:i + records_per_block]
+            for read in chunk:
+                first_block.setdefault(read[0], len(data))
+            data += compress_block(''.join(bam_record(*read) for read in chunk))
+        bai = 'BAI\x01' + struct.pack('<i', len(contigs))
+        for ref_id in range(len(contigs)):
+            if ref_id in first_block:
+                bai += struct.pack('<iIi4Q', 1, 37450, 2, first_block[ref_id] << 16, 0, 1, 0)
+            else:
+                bai += struct.pack('<i', 0)
+            bai += struct.pack('<i', 0)
+        with open(os.path.join(self.work_dir, 'sorted.bam'), 'wb') as f:
+            f.write(data + compress_block(''))
+        with open(os.path.join(self.work_dir, 'sorted.bam.bai'), 'wb') as f:
+            f.write(bai)
+
+    def _coverage(self, cores=1):
+        return exon_coverage.exon_coverage(os.path.join(self.work_dir, 'sorted.bam'),
+                                           os.path.join(self.work_dir, 'sorted.bam.bai'),
+                                           os.path.join(self.work_dir, 'exons.bed'), cores=cores)
+
+    def test_exon_coverage(self):
+        with open(os.path.join(self.work_dir, 'exons.bed'), 'w') as f:
+            f.write('chr1\t100\t200\ta\t0\t+\nchr1\t150\t160\tb\t0\t+\nchr1\t300\t400\tc\t0\t-\n'
+                    'chr2\t0\t50\td\t0\t+\nchr3\t0\t50\te\t0\t+\n')
+        self._write_bam([('chr1', 1000), ('chr2', 1000), ('chr3', 1000)],
+                        [(0, 90, '20M'),
+                         # Spliced over exon b, and overlaps exon a with both blocks
+                         (0, 140, '5S5M30N10M2D5M'),
+                         (0, 190, '20M100N10M'),
+                         (0, 500, '10M'),
+                         (0, 120, '10M', 0x4),
+                         (1, 10, '5M1I5M')])
+        exons, counts, covered = self._coverage()
+        self.assertEqual(list(counts), [3, 0, 1, 1, 0])
+        self.assertEqual(list(covered), [10 + 5 + 25, 0, 10, 10, 0])
+        lines = list(exon_coverage.coverage_lines(exons, counts, covered))
+        self.assertEqual(lines[0], 'chr1\t100\t200\ta\t0\t+\t3\t40\t100\t0.4000000\n')
+
+    def test_random_reads(self):
+        random.seed(1)
+        exons = sorted((random.randint(0, 5000), random.randint(10, 300)) for _ in range(200))
+        exons = [(start, start + length) for start, length in exons]
+        with open(os.path.join(self.work_dir, 'exons.bed'), 'w') as f:
+            for start, end in exons:
+                f.write('chr1\t{}\t{}\n'.format(start, end))
+        reads = []
+        for _ in range(500):
+            cigar = '{}M'.format(random.randint(1, 50))
+            for _ in range(random.randint(0, 2)):
+                cigar += '{}{}{}M'.format(random.randint(1, 200), random.choice('NDI'), random.randint(1, 50))
+            reads.append((0, random.randint(0, 5500), cigar))
+        self._write_bam([('chr1', 10000)], reads, records_per_block=7)
+
+        expected_counts = [0] * len(exons)
+        expected_bases = [set() for _ in exons]
+        for _, pos, cigar in reads:
+            hits = set()
+            for block_start, block_end in blocks(pos, cigar):
+                for i, (start, end) in enumerate(exons):
+                    if block_start < end and block_end > start:
+                        hits.add(i)
+                        expected_bases[i].update(range(max(start, block_start), min(end, block_end)))
+            for i in hits:
+                expected_counts[i] += 1
+
+        chunk_size = exon_coverage.CHUNK_SIZE
+        exon_coverage.CHUNK_SIZE = 1000
+        try:
+            _, counts, covered = self._coverage(cores=2)
+        finally:
+            exon_coverage.CHUNK_SIZE = chunk_size
+        self.assertEqual(list(counts), expected_counts)
+        self.assertEqual(list(covered), [len(bases) for bases in expected_bases])
@@ -0,0 +1,17 @@
+import subprocess
+from unittest import TestCase
+
+from toil_scripts.rnaseq_unc.exon_quant import exon_quant_bed_line
+
+
+class ExonQuantTest(TestCase):
+
+    def test_exon_quant_bed_line(self):
+        exon_quant = 'chr1:1-100\t10\t15\t50\nchr2:100-299:-\t4\t3\t10\nchr3:1-50\t0\t0\t0\nheader\n'
+        # The output of the commands it replaces
+        p = subprocess.Popen("tr ':' '\\t' | tr '-' '\\t' | cut -f1-4", shell=True, stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE)
+        expected = p.communicate(exon_quant)[0]
+        self.assertEqual(''.join(exon_quant_bed_line(line) for line in exon_quant.splitlines()), expected)
+        # Like tr '-' '\t', a minus strand becomes an empty field
+        self.assertEqual(exon_quant_bed_line('chr2:100-299:-\t4\t3\t10'), 'chr2\t100\t299\t\n')